@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+"""
+功能：链接克隆的共享基础镜像
+
+同一模板链接克隆出的虚拟机，其硬盘都是模板基础硬盘之上的差异磁盘
+基础硬盘在本节点只下载、转换一次，各虚拟机的硬盘转换为以其为backing file的qcow2差异镜像
+1.目录    按基础硬盘的数据存储路径计算，同一基础硬盘的所有会话共用
+2.文件锁  迁移会话运行在不同的子进程中，通过文件锁保证只有一个会话构建，其余会话等待构建完成后直接复用
+3.引用    各会话使用期间在refs目录下登记，便于清理时判断是否仍被使用
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+
+from core.logger import logger
+
+from tools.time_tool import TimeTool
+
+
+class SharedBaseImage:
+    """共享基础镜像"""
+
+    def __init__(self, base_file_path, base_dir, lock_dir):
+        self.base_file_path = base_file_path
+        self.key = hashlib.sha1(base_file_path.encode("utf-8")).hexdigest()[:16]
+        self.image_dir = os.path.join(base_dir, self.key)
+        self.lock_path = os.path.join(lock_dir, f"base-{self.key}.lock")
+        self.vmdk_path = os.path.join(self.image_dir, "base.vmdk")
+        self.qcow2_path = os.path.join(self.image_dir, "base.qcow2")
+        self.ready_path = os.path.join(self.image_dir, "ready.json")
+        self.refs_dir = os.path.join(self.image_dir, "refs")
+
+    @contextlib.contextmanager
+    def _lock(self):
+        """进程间互斥，持有锁的进程退出时由内核自动释放"""
+        os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+        with open(self.lock_path, "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def is_ready(self):
+        return os.path.isfile(self.ready_path) and os.path.isfile(self.qcow2_path)
+
+    def acquire(self, session_id, build_func):
+        """登记引用并确保基础镜像已构建，构建失败时抛出异常，下一个会话重新构建"""
+        with self._lock():
+            os.makedirs(self.refs_dir, exist_ok=True)
+            with open(os.path.join(self.refs_dir, session_id), "w"):
+                pass
+
+            if self.is_ready():
+                logger.info(
+                    f"shared base image is ready, reuse it, session id: {session_id}, base file path: {self.base_file_path}, qcow2 path: {self.qcow2_path}"
+                )
+                return
+
+            logger.info(
+                f"build shared base image start, session id: {session_id}, base file path: {self.base_file_path}, image dir: {self.image_dir}"
+            )
+            build_func(self)
+            with open(self.ready_path, "w", encoding="utf-8") as f:
+                json.dump(
+                    dict(base_file_path=self.base_file_path, session_id=session_id,
+                         end_time=TimeTool.get_now_datetime_str()),
+                    f,
+                )
+            logger.info(
+                f"build shared base image end, session id: {session_id}, base file path: {self.base_file_path}, qcow2 path: {self.qcow2_path}"
+            )
+
+    def release(self, session_id, keep=True):
+        """取消引用，keep为False且没有其他会话引用时删除基础镜像"""
+        with self._lock():
+            ref_path = os.path.join(self.refs_dir, session_id)
+            if os.path.isfile(ref_path):
+                os.remove(ref_path)
+            if keep or (os.path.isdir(self.refs_dir) and os.listdir(self.refs_dir)):
+                return
+
+            shutil.rmtree(self.image_dir, ignore_errors=True)
+            logger.info(
+                f"shared base image removed, session id: {session_id}, base file path: {self.base_file_path}"
+            )
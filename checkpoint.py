@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+"""
+功能：迁移断点
+
+按session_id将迁移进度持久化到本地文件，迁移失败后重新执行时跳过已完成的步骤，从断点处继续
+1.steps   已完成的步骤及其结果，步骤名称形如"export_image"、"deal_image.convert_image.Hard disk 1"
+2.state   最近一个步骤完成时迁移器的状态快照（镜像路径、哈希值、目标虚拟机磁盘信息等），续迁时恢复
+"""
+
+import json
+import os
+import threading
+
+from core.logger import logger
+
+from tools.time_tool import TimeTool
+
+
+class MigrateCheckpoint:
+    """迁移断点"""
+
+    def __init__(self, session_id, checkpoint_dir):
+        self.session_id = session_id
+        self.checkpoint_path = os.path.join(checkpoint_dir, f"{session_id}.json")
+        self._lock = threading.Lock()
+        self._data = dict(session_id=session_id, steps=dict(), state=dict())
+        self.load()
+
+    @property
+    def state(self):
+        return self._data["state"]
+
+    @property
+    def done_steps(self):
+        return list(self._data["steps"])
+
+    def load(self):
+        """加载断点文件，文件不存在或已损坏时从头开始"""
+        if not os.path.isfile(self.checkpoint_path):
+            return
+
+        try:
+            with open(self.checkpoint_path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(
+                f"load checkpoint failed, start from scratch, session id: {self.session_id}, checkpoint path: {self.checkpoint_path}, err: {e}"
+            )
+            return
+
+        if data.get("session_id") == self.session_id:
+            self._data.update(data)
+
+    def is_done(self, step):
+        with self._lock:
+            return step in self._data["steps"]
+
+    def get_result(self, step):
+        """获取已完成步骤的结果"""
+        with self._lock:
+            return self._data["steps"].get(step, dict()).get("result")
+
+    def mark_done(self, step, result=None, state=None):
+        """标记步骤已完成并立即落盘"""
+        with self._lock:
+            self._data["steps"][step] = dict(result=result, end_time=TimeTool.get_now_datetime_str())
+            if state is not None:
+                self._data["state"] = state
+            self._save()
+
+    def update_state(self, state):
+        """只更新状态快照并立即落盘，用于步骤执行过程中保存阶段性进展"""
+        with self._lock:
+            self._data["state"] = state
+            self._save()
+
+    def clear(self):
+        """删除断点，下次迁移从头开始"""
+        with self._lock:
+            self._data = dict(session_id=self.session_id, steps=dict(), state=dict())
+            if os.path.isfile(self.checkpoint_path):
+                os.remove(self.checkpoint_path)
+
+    def _save(self):
+        """先写临时文件再原子替换，避免进程中途退出导致断点文件损坏"""
+        os.makedirs(os.path.dirname(self.checkpoint_path), exist_ok=True)
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._data, f, ensure_ascii=False, default=str)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.checkpoint_path)
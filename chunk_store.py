@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+
+"""
+功能：按内容寻址的分块缓存
+
+同一虚拟机通常先做一次测试迁移，数天后再做正式割接迁移，两次迁移的硬盘大部分数据相同
+下载的硬盘文件按固定大小分块，以块的sha256为键保存，并按虚拟机记录每个文件由哪些块组成（清单）
+1.chunks   块数据，路径为 chunks/<sha256前两位>/<sha256>，全零的块不保存
+2.recipes  文件清单，路径为 recipes/<src_vm_id>/<文件键的sha1>.json，记录文件大小、远端版本信息、CBT变更标识和块列表
+3.index    SQLite索引index.db，记录每个块的大小和最近使用时间，并维护块的总大小，淘汰时无需遍历目录
+4.写入     下载时数据按顺序传入ChunkWriter，边下载边分块，下载完成后写入清单，不再重新读取本地文件
+5.淘汰     块的总大小超出上限时按最近使用时间从旧到新淘汰
+再次迁移时，远端文件的大小和版本信息与清单一致则直接由块重建本地文件；
+版本不一致但清单记录了CBT变更标识时，只下载变更标识以来变化的块，其余块由缓存重建
+Note:多个迁移子进程可同时使用同一缓存目录，索引的写入在SQLite的写事务中串行执行
+"""
+
+import contextlib
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from core.logger import logger
+
+from tools.time_tool import TimeTool
+
+
+class ChunkStore:
+    """分块缓存"""
+
+    # 每次淘汰从索引中取出的块数
+    EVICT_BATCH_SIZE = 1000
+
+    def __init__(self, store_dir, max_bytes, chunk_size=4 * 1024 * 1024):
+        self.store_dir = store_dir
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.chunks_dir = os.path.join(store_dir, "chunks")
+        self.recipes_dir = os.path.join(store_dir, "recipes")
+        self.index_path = os.path.join(store_dir, "index.db")
+        # SQLite连接只能在创建它的线程中使用
+        self._local = threading.local()
+
+    def _get_chunk_path(self, digest):
+        return os.path.join(self.chunks_dir, digest[:2], digest)
+
+    def _get_recipe_path(self, vm_id, key):
+        return os.path.join(self.recipes_dir, vm_id, f"{hashlib.sha1(key.encode('utf-8')).hexdigest()}.json")
+
+    def _get_conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(self.store_dir, exist_ok=True)
+            conn = sqlite3.connect(self.index_path, timeout=60, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._init_index(conn)
+        return conn
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """写事务，多个进程同时写入时排队等待"""
+        conn = self._get_conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _init_index(self, conn):
+        """创建索引，没有总大小记录时（新建的缓存或升级前的缓存）遍历一次块目录重建索引"""
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunks (digest TEXT PRIMARY KEY, size INTEGER NOT NULL, atime REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS chunks_atime ON chunks (atime)")
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        if conn.execute("SELECT value FROM meta WHERE name = 'total_bytes'").fetchone():
+            return
+
+        with self._transaction() as conn:
+            if conn.execute("SELECT value FROM meta WHERE name = 'total_bytes'").fetchone():
+                return
+            row_list = list()
+            for root, _, files in os.walk(self.chunks_dir):
+                for file_name in files:
+                    if file_name.endswith(".tmp"):
+                        continue
+                    try:
+                        stat = os.stat(os.path.join(root, file_name))
+                    except OSError:
+                        continue
+                    row_list.append((file_name, stat.st_size, stat.st_mtime))
+            conn.executemany("INSERT OR REPLACE INTO chunks (digest, size, atime) VALUES (?, ?, ?)", row_list)
+            conn.execute(
+                "INSERT INTO meta (name, value) VALUES ('total_bytes', (SELECT COALESCE(SUM(size), 0) FROM chunks))"
+            )
+        logger.info(f"chunk store index built, store dir: {self.store_dir}, chunk count: {len(row_list)}")
+
+    def get_total_bytes(self):
+        row = self._get_conn().execute("SELECT value FROM meta WHERE name = 'total_bytes'").fetchone()
+        return row[0] if row else 0
+
+    def put_chunk(self, data):
+        """保存块，返回sha256，全零的块返回空字符串"""
+        if not data.strip(b"\0"):
+            return ""
+
+        digest = hashlib.sha256(data).hexdigest()
+        chunk_path = self._get_chunk_path(digest)
+        with self._transaction() as conn:
+            indexed = conn.execute("UPDATE chunks SET atime = ? WHERE digest = ?", (time.time(), digest)).rowcount
+        if indexed and os.path.isfile(chunk_path):
+            return digest
+
+        # 先写临时文件再原子替换，多个会话同时写入同一个块时互不影响
+        os.makedirs(os.path.dirname(chunk_path), exist_ok=True)
+        tmp_path = f"{chunk_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, chunk_path)
+        with self._transaction() as conn:
+            if conn.execute(
+                "INSERT OR IGNORE INTO chunks (digest, size, atime) VALUES (?, ?, ?)", (digest, len(data), time.time())
+            ).rowcount:
+                conn.execute("UPDATE meta SET value = value + ? WHERE name = 'total_bytes'", (len(data),))
+        return digest
+
+    def read_chunk(self, digest, size):
+        """读取块，全零的块返回size个零字节，块已被淘汰时抛出OSError"""
+        if not digest:
+            return bytes(size)
+        with open(self._get_chunk_path(digest), "rb") as f:
+            return f.read()
+
+    def touch_chunks(self, digest_list):
+        """更新块的最近使用时间"""
+        now = time.time()
+        with self._transaction() as conn:
+            conn.executemany(
+                "UPDATE chunks SET atime = ? WHERE digest = ?", [(now, digest) for digest in set(digest_list) if digest]
+            )
+
+    def has_chunks(self, digest_list):
+        return all(not digest or os.path.isfile(self._get_chunk_path(digest)) for digest in digest_list)
+
+    def open_writer(self, vm_id, key):
+        """创建文件的分块写入器，见ChunkWriter"""
+        return ChunkWriter(self, vm_id, key)
+
+    def save_recipe(self, vm_id, key, size, chunks, version=None, digest_map=None, change_id=""):
+        """记录文件清单
+        version为远端文件的版本信息（大小、修改时间等），用于下次迁移时判断远端文件是否变化
+        change_id为下载时硬盘的CBT变更标识，用于下次迁移时查询变化的区间
+        """
+        recipe = dict(
+            key=key,
+            size=size,
+            chunk_size=self.chunk_size,
+            version=version or dict(),
+            digest_map=digest_map or dict(),
+            change_id=change_id or "",
+            chunks=chunks,
+            update_time=TimeTool.get_now_datetime_str(),
+        )
+        recipe_path = self._get_recipe_path(vm_id, key)
+        os.makedirs(os.path.dirname(recipe_path), exist_ok=True)
+        tmp_path = f"{recipe_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(recipe, f)
+        os.replace(tmp_path, recipe_path)
+        return recipe
+
+    def load_recipe(self, vm_id, key):
+        recipe_path = self._get_recipe_path(vm_id, key)
+        if not os.path.isfile(recipe_path):
+            return None
+        try:
+            with open(recipe_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def get_valid_recipe(self, vm_id, key, version):
+        """获取与远端文件版本一致且块均未被淘汰的文件清单，不满足时返回None"""
+        recipe = self.load_recipe(vm_id, key)
+        if not recipe or not version or recipe["version"] != version:
+            return None
+        if not self.has_chunks(recipe["chunks"]):
+            return None
+        return recipe
+
+    def restore_file(self, recipe, dst_path):
+        """由块重建文件，全零的块保留为文件空洞
+        块在重建过程中被淘汰时抛出异常，由调用方改为下载
+        """
+        with open(dst_path, "wb") as f:
+            for index, digest in enumerate(recipe["chunks"]):
+                if not digest:
+                    continue
+                f.seek(index * recipe["chunk_size"])
+                f.write(self.read_chunk(digest, recipe["chunk_size"]))
+            f.truncate(recipe["size"])
+        self.touch_chunks(recipe["chunks"])
+
+    def evict(self):
+        """块的总大小超出上限时，按最近使用时间从旧到新淘汰"""
+        if self.get_total_bytes() <= self.max_bytes:
+            return
+
+        evict_bytes = 0
+        with self._transaction() as conn:
+            total_bytes = conn.execute("SELECT value FROM meta WHERE name = 'total_bytes'").fetchone()[0]
+            while total_bytes - evict_bytes > self.max_bytes:
+                row_list = conn.execute(
+                    "SELECT digest, size FROM chunks ORDER BY atime LIMIT ?", (self.EVICT_BATCH_SIZE,)
+                ).fetchall()
+                if not row_list:
+                    break
+                evict_digest_list = list()
+                for digest, size in row_list:
+                    if total_bytes - evict_bytes <= self.max_bytes:
+                        break
+                    try:
+                        os.remove(self._get_chunk_path(digest))
+                    except FileNotFoundError:
+                        pass
+                    evict_digest_list.append((digest,))
+                    evict_bytes += size
+                conn.executemany("DELETE FROM chunks WHERE digest = ?", evict_digest_list)
+            conn.execute("UPDATE meta SET value = value - ? WHERE name = 'total_bytes'", (evict_bytes,))
+        logger.info(
+            f"chunk store evicted, store dir: {self.store_dir}, evict bytes: {evict_bytes}, "
+            f"total bytes: {total_bytes - evict_bytes}, max bytes: {self.max_bytes}"
+        )
+
+
+class ChunkWriter:
+    """文件的分块写入器，下载时按顺序传入文件的全部内容，边下载边分块保存
+    1.reset   下载重试时从头开始，已保存的块按内容去重，不会重复写入
+    2.update  传入下一段数据，凑满一个块时保存
+    3.finish  保存最后不足一个块的数据，写入文件清单并按需淘汰
+    """
+
+    def __init__(self, store, vm_id, key):
+        self.store = store
+        self.vm_id = vm_id
+        self.key = key
+        self.reset()
+
+    def reset(self):
+        self.size = 0
+        self.chunks = list()
+        self._buffer = bytearray()
+
+    def update(self, data):
+        self.size += len(data)
+        self._buffer += data
+        chunk_size = self.store.chunk_size
+        if len(self._buffer) < chunk_size:
+            return
+        view = memoryview(self._buffer)
+        offset = 0
+        while len(self._buffer) - offset >= chunk_size:
+            self.chunks.append(self.store.put_chunk(bytes(view[offset:offset + chunk_size])))
+            offset += chunk_size
+        view.release()
+        del self._buffer[:offset]
+
+    def finish(self, version=None, digest_map=None, change_id=""):
+        """返回文件清单"""
+        if self._buffer:
+            self.chunks.append(self.store.put_chunk(bytes(self._buffer)))
+            self._buffer = bytearray()
+        recipe = self.store.save_recipe(
+            self.vm_id, self.key, self.size, self.chunks, version, digest_map, change_id
+        )
+        self.store.evict()
+        return recipe
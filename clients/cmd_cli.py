@@ -1,39 +1,226 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
 import time
-import datetime
+import signal
 import tempfile
+import selectors
 import subprocess
-from typing import ClassVar, Optional, Tuple, Union
+from typing import Callable, ClassVar, Optional, Tuple, Union
+
+
+# 输出回调，参数为输出流名称（stdout/stderr）和本次读取到的数据
+OutputCallback = Callable[[str, bytes], None]
+
+
+class SupervisedProcess:
+    """ 被监管的子进程 """
+
+    def __init__(self, argv: Union[str, list[str]], timeout: int, on_output: Optional[OutputCallback] = None,
+                 shell: bool = True) -> None:
+        self.argv = argv
+        self.timeout = timeout
+        self.on_output = on_output
+
+        # 子进程作为新会话的组长启动，超时时可以连同其派生的进程一起终止
+        self.popen: subprocess.Popen = subprocess.Popen(argv,
+                                                        stdout=subprocess.PIPE,
+                                                        stderr=subprocess.PIPE,
+                                                        shell=shell,
+                                                        start_new_session=True)
+        self.deadline: float = time.monotonic() + timeout
+        self.kill_deadline: Optional[float] = None
+        self.timed_out: bool = False
+        self.exited: bool = False
+        self.open_stream_num: int = 2
+        self.stdout_chunks: list[bytes] = list()
+        self.stderr_chunks: list[bytes] = list()
+        self.pidfd: Optional[int] = None
+
+    @property
+    def pid(self) -> int:
+        return self.popen.pid
+
+    @property
+    def done(self) -> bool:
+        """ 进程已退出且输出已读取完毕 """
+        return self.exited and self.open_stream_num == 0
+
+    @property
+    def returncode(self) -> Optional[int]:
+        return self.popen.returncode
+
+    @property
+    def stdout(self) -> bytes:
+        return b"".join(self.stdout_chunks)
+
+    @property
+    def stderr(self) -> bytes:
+        return b"".join(self.stderr_chunks)
+
+    def kill_group(self, sig: int) -> None:
+        """ 向子进程所在的进程组发送信号 """
+        try:
+            os.killpg(self.popen.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+
+class ProcessSupervisor:
+    """ 事件驱动的子进程监管器
+    在单个线程中使用selectors同时监管多个子进程：
+    1.增量读取stdout/stderr，避免管道缓冲区写满导致子进程阻塞
+    2.使用pidfd感知子进程退出，不支持pidfd时退化为定时检查
+    3.超时后先向进程组发送SIGTERM，超过宽限时间仍未退出则发送SIGKILL
+    """
+
+    READ_SIZE: ClassVar[int] = 64 * 1024
+    EXIT_POLL_INTERVAL: ClassVar[float] = 0.5
+
+    def __init__(self, kill_grace_seconds: int = 10) -> None:
+        self.kill_grace_seconds = kill_grace_seconds
+        self.selector = selectors.DefaultSelector()
+        self.processes: list[SupervisedProcess] = list()
+
+    def spawn(self, argv: Union[str, list[str]], timeout: int = 60, on_output: Optional[OutputCallback] = None,
+              shell: bool = True) -> SupervisedProcess:
+        """ 启动并监管子进程 """
+        proc = SupervisedProcess(argv, timeout, on_output, shell)
+        self.selector.register(proc.popen.stdout, selectors.EVENT_READ, (proc, "stdout"))
+        self.selector.register(proc.popen.stderr, selectors.EVENT_READ, (proc, "stderr"))
+
+        if hasattr(os, "pidfd_open"):
+            try:
+                proc.pidfd = os.pidfd_open(proc.pid)
+                self.selector.register(proc.pidfd, selectors.EVENT_READ, (proc, "exit"))
+            except OSError:
+                proc.pidfd = None
+
+        self.processes.append(proc)
+        return proc
+
+    def run(self) -> None:
+        """ 监管所有子进程直至全部结束 """
+        try:
+            while any(not proc.done for proc in self.processes):
+                self._check_deadline()
+                for key, _ in self.selector.select(self._next_wait_seconds()):
+                    proc, stream_name = key.data
+                    if stream_name == "exit":
+                        self._handle_exit(proc)
+                    else:
+                        self._handle_output(proc, stream_name, key.fileobj)
+                self._check_exit()
+        finally:
+            for proc in self.processes:
+                if not proc.done:
+                    proc.kill_group(signal.SIGKILL)
+                    proc.popen.wait()
+                self._close(proc)
+
+    def _handle_output(self, proc: SupervisedProcess, stream_name: str, fileobj) -> None:
+        data = os.read(fileobj.fileno(), self.READ_SIZE)
+        if not data:
+            self.selector.unregister(fileobj)
+            fileobj.close()
+            proc.open_stream_num -= 1
+            return
+
+        if stream_name == "stdout":
+            proc.stdout_chunks.append(data)
+        else:
+            proc.stderr_chunks.append(data)
+        if proc.on_output:
+            proc.on_output(stream_name, data)
+
+    def _handle_exit(self, proc: SupervisedProcess) -> None:
+        self.selector.unregister(proc.pidfd)
+        os.close(proc.pidfd)
+        proc.pidfd = None
+        proc.popen.wait()
+        proc.exited = True
+
+    def _check_exit(self) -> None:
+        """ 不支持pidfd时，定时检查子进程是否退出 """
+        for proc in self.processes:
+            if not proc.exited and proc.pidfd is None and proc.popen.poll() is not None:
+                proc.exited = True
+
+    def _check_deadline(self) -> None:
+        now = time.monotonic()
+        for proc in self.processes:
+            if proc.done:
+                continue
+
+            if proc.kill_deadline is None and now >= proc.deadline:
+                proc.timed_out = True
+                proc.kill_group(signal.SIGTERM)
+                proc.kill_deadline = now + self.kill_grace_seconds
+            elif proc.kill_deadline is not None and now >= proc.kill_deadline:
+                proc.kill_group(signal.SIGKILL)
+                proc.kill_deadline = float("inf")
+
+    def _next_wait_seconds(self) -> float:
+        now = time.monotonic()
+        wait_seconds = float("inf")
+        for proc in self.processes:
+            if proc.done:
+                continue
+            next_deadline = proc.deadline if proc.kill_deadline is None else proc.kill_deadline
+            wait_seconds = min(wait_seconds, next_deadline - now)
+            if not proc.exited and proc.pidfd is None:
+                wait_seconds = min(wait_seconds, self.EXIT_POLL_INTERVAL)
+        return max(0.0, min(wait_seconds, self.EXIT_POLL_INTERVAL * 120))
+
+    def _close(self, proc: SupervisedProcess) -> None:
+        for fileobj in (proc.popen.stdout, proc.popen.stderr):
+            if fileobj and not fileobj.closed:
+                try:
+                    self.selector.unregister(fileobj)
+                except KeyError:
+                    pass
+                fileobj.close()
+        if proc.pidfd is not None:
+            try:
+                self.selector.unregister(proc.pidfd)
+            except KeyError:
+                pass
+            os.close(proc.pidfd)
+            proc.pidfd = None
 
 
 class CMDClient:
 
     @classmethod
-    def normal_exec(cls, argv: Union[str, list[str]], timeout: int = 60) -> tuple[int, bytes, bytes]:
-        """ 普通执行 """
-        start_time = datetime.datetime.now()
-        pipe = subprocess.Popen(argv,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE,
-                                shell=True)
-
-        # pipe.poll()为None, 说明没有执行完毕
-        while pipe.poll() is None:
-            end_time = datetime.datetime.now()
-            total_seconds = (end_time - start_time).total_seconds()
-            if total_seconds > timeout:
-                pipe.terminate()
-                raise Exception(
-                    "exec cmd timeout, cmd: %s, timeout: %s" % (argv, timeout))
-            time.sleep(0.1)
-
-        stdout, stderr = pipe.communicate()
-        return pipe.returncode, stdout.strip(), stderr.strip()
+    def normal_exec(cls, argv: Union[str, list[str]], timeout: int = 60,
+                    on_output: Optional[OutputCallback] = None) -> tuple[int, bytes, bytes]:
+        """ 普通执行
+        on_output用于实时处理输出，例如解析进度
+        """
+        supervisor = ProcessSupervisor()
+        proc = supervisor.spawn(argv, timeout, on_output)
+        supervisor.run()
+
+        if proc.timed_out:
+            raise Exception(
+                "exec cmd timeout, cmd: %s, timeout: %s" % (argv, timeout))
+        return proc.returncode, proc.stdout.strip(), proc.stderr.strip()
+
+    @classmethod
+    def multi_exec(cls, argv_list: list[Union[str, list[str]]], timeout: int = 60) -> list[tuple[int, bytes, bytes]]:
+        """ 在当前线程中并发执行多条命令，超时的命令返回码为None """
+        supervisor = ProcessSupervisor()
+        proc_list = [supervisor.spawn(argv, timeout) for argv in argv_list]
+        supervisor.run()
+        return [
+            (None if proc.timed_out else proc.returncode, proc.stdout.strip(), proc.stderr.strip())
+            for proc in proc_list
+        ]
 
     @classmethod
-    def bash_exec(cls, cmd: str, timeout: int = 60, dir: str = '/tmp', bin: str = '/bin/bash -x ') -> tuple[int, bytes, bytes]:
+    def bash_exec(cls, cmd: str, timeout: int = 60, dir: str = '/tmp', bin: str = '/bin/bash -x ',
+                  on_output: Optional[OutputCallback] = None) -> tuple[int, bytes, bytes]:
         """ 使用bash命令执行 """
         tmp_file_path = tempfile.mktemp(suffix='.sh', prefix='_v2v_', dir=dir)
         with open(tmp_file_path, 'w') as f:
@@ -41,4 +228,4 @@ class CMDClient:
         cmd = f"{bin} {tmp_file_path} "
 
         # eg: /bin/bash -x /tmp/v2v_bash/_v2v_xMn1i_.sh
-        return cls.normal_exec(cmd, timeout)
+        return cls.normal_exec(cmd, timeout, on_output)
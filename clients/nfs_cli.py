@@ -1,32 +1,301 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from typing import Any, Union
-import libnfs
+import os
+import queue
+import contextlib
+import threading
+import time
+import posixpath
+from typing import Any, Callable, ClassVar, Iterable, Iterator, Optional, Union
+
+from tools.time_tool import TimeTool
+
+try:
+    import libnfs
+except ImportError:
+    # 只有上传镜像模式需要libnfs，未安装时不影响其他迁移模式
+    libnfs = None
+
+
+# 拷贝进度回调，参数为已拷贝字节数和文件总字节数
+CopyCallback = Callable[[int, int], None]
+
+
+class NFSConnectionPool:
+    """ NFS连接池
+    按NFS地址（服务器和导出目录）缓存已挂载的libnfs连接，同一进程内的会话和线程复用，避免每次操作都重新挂载
+    libnfs的连接不能被多个线程同时使用，连接借出期间由借用方独占，出错的连接直接丢弃
+    """
+
+    def __init__(self, max_idle_per_address: int = 8, idle_timeout: int = 300) -> None:
+        self.max_idle_per_address = max_idle_per_address
+        self.idle_timeout = idle_timeout
+        # key为NFS地址，value为空闲连接及其归还时间，后归还的连接优先借出
+        self._idle_map: dict[str, list[tuple[float, Any]]] = dict()
+        self._lock = threading.Lock()
+
+    def acquire(self, address: str) -> Any:
+        """ 借出连接，没有空闲连接时新建，空闲超过idle_timeout秒的连接可能已被服务端断开，直接丢弃 """
+        now = time.monotonic()
+        with self._lock:
+            idle_list = self._idle_map.get(address, list())
+            while idle_list:
+                release_time, nfs = idle_list.pop()
+                if now - release_time < self.idle_timeout:
+                    return nfs
+        if libnfs is None:
+            raise Exception("libnfs is not installed, please install python-libnfs")
+        return libnfs.NFS(address)
+
+    def release(self, address: str, nfs: Any, discard: bool = False) -> None:
+        """ 归还连接，discard为True或空闲连接已满时丢弃，libnfs在连接对象回收时卸载 """
+        if discard:
+            return
+        with self._lock:
+            idle_list = self._idle_map.setdefault(address, list())
+            if len(idle_list) < self.max_idle_per_address:
+                idle_list.append((time.monotonic(), nfs))
+
+    @contextlib.contextmanager
+    def connection(self, address: str) -> Iterator[Any]:
+        nfs = self.acquire(address)
+        try:
+            yield nfs
+        except Exception:
+            self.release(address, nfs, discard=True)
+            raise
+        self.release(address, nfs)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._idle_map.clear()
+
+
+# 进程内共享的连接池
+nfs_connection_pool = NFSConnectionPool()
+
+
+class NFSFile:
+    """ NFS文件句柄
+    按chunk_size分块流式读写，不会一次性将整个文件读入内存；关闭时关闭句柄并归还连接，支持with语句
+    """
+
+    def __init__(self, pool: NFSConnectionPool, address: str, nfs: Any, handle: Any, chunk_size: int) -> None:
+        self.pool = pool
+        self.address = address
+        self.chunk_size = chunk_size
+        self._nfs = nfs
+        self._handle = handle
+
+    @property
+    def closed(self) -> bool:
+        return self._handle is None
+
+    def read(self, size: int = -1) -> Union[str, bytes]:
+        """ 读取size字节，size小于0时读取到文件末尾，每次向服务端请求不超过chunk_size字节 """
+        chunks: list[Union[str, bytes]] = list()
+        remain = size
+        while remain != 0:
+            chunk = self._handle.read(self.chunk_size if remain < 0 else min(self.chunk_size, remain))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remain = remain - len(chunk) if remain > 0 else remain
+        return chunks[0][:0].join(chunks) if chunks else b''
+
+    def readinto(self, buffer: Union[bytearray, memoryview]) -> int:
+        """ 读取数据到调用方提供的缓冲区，返回读取的字节数，到达文件末尾时返回0 """
+        view = memoryview(buffer).cast('B')
+        data = self.read(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    def pread(self, offset: int, length: int) -> bytes:
+        """ 从指定偏移读取，读满length字节或到达文件末尾时返回 """
+        self._handle.seek(offset)
+        return self.read(length)
+
+    def iter_chunks(self, chunk_size: Optional[int] = None) -> Iterator[bytes]:
+        """ 从当前位置起按块迭代读取，直到文件末尾 """
+        while chunk := self.read(chunk_size or self.chunk_size):
+            yield chunk
+
+    def __iter__(self) -> Iterator[bytes]:
+        return self.iter_chunks()
+
+    def write(self, data: Union[str, bytes]) -> int:
+        """ 分块写入，返回写入的字节数 """
+        written_size = 0
+        for offset in range(0, len(data), self.chunk_size):
+            written_size += self._handle.write(data[offset:offset + self.chunk_size])
+        return written_size
+
+    def write_from(self, chunks: Iterable[bytes]) -> int:
+        """ 写入迭代器产生的数据块，例如另一个文件的iter_chunks，返回写入的字节数 """
+        return sum(self.write(chunk) for chunk in chunks)
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> None:
+        self._handle.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._handle.tell()
+
+    def close(self, discard: bool = False) -> None:
+        """ 关闭句柄并归还连接，出错后的连接状态未知，discard为True时丢弃，重复调用不报错 """
+        if self._handle is None:
+            return
+        handle, self._handle = self._handle, None
+        try:
+            handle.close()
+        except Exception:
+            discard = True
+        self.pool.release(self.address, self._nfs, discard=discard)
+        self._nfs = None
+
+    def __enter__(self) -> "NFSFile":
+        return self
+
+    def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> None:
+        self.close(discard=exc_type is not None)
 
 
 class NFSInterface:
 
-    def __init__(self, address: str) -> None:
+    # 单次读写请求的默认字节数
+    CHUNK_SIZE: ClassVar[int] = 1024 * 1024
+
+    def __init__(self, address: str, chunk_size: int = CHUNK_SIZE, pool: Optional[NFSConnectionPool] = None) -> None:
         if not address.startswith('nfs://'):
             address = 'nfs://' + address
-        self.nfs: libnfs.NFS = libnfs.NFS(address)
+        self.address = address
+        self.chunk_size = chunk_size
+        self.pool = pool or nfs_connection_pool
+
+    def open(self, path: str, mode: str = 'rb') -> NFSFile:
+        """ 打开文件，返回的句柄独占一个连接，使用完毕后须关闭（推荐使用with语句） """
+        nfs = self.pool.acquire(self.address)
+        try:
+            handle = nfs.open(path, mode)
+        except Exception:
+            self.pool.release(self.address, nfs, discard=True)
+            raise
+        return NFSFile(self.pool, self.address, nfs, handle, self.chunk_size)
 
     def readfile(self, path: str, mode: str = 'r') -> Union[str, bytes]:
-        nfs_file = self.nfs.open(path, mode)
-        data: Union[str, bytes] = nfs_file.read()
-        nfs_file.close()
-        return data
+        with self.open(path, mode) as nfs_file:
+            return nfs_file.read()
 
     def writefile(self, path: str, data: Union[str, bytes], mode: str = 'w') -> int:
-        nfs_file = self.nfs.open(path, mode)
-        bytes_written: int = nfs_file.write(data)
-        return bytes_written
+        with self.open(path, mode) as nfs_file:
+            return nfs_file.write(data)
 
     def listdirs(self, path: str) -> list[str]:
-        dirs: list[str] = self.nfs.listdir(path)
+        with self.pool.connection(self.address) as nfs:
+            dirs: list[str] = nfs.listdir(path)
         tmp_dirs: list[str] = list()
         for d in dirs:
             if not (d == '.' or d == '..'):
                 tmp_dirs.append(d)
         return tmp_dirs
+
+    def getsize(self, path: str) -> int:
+        with self.pool.connection(self.address) as nfs:
+            return nfs.stat(path)['size']
+
+    @classmethod
+    def download_file(cls, address: str, path: str, dst_path: str, concurrency: int = 4,
+                      chunk_size: int = 8 * 1024 * 1024, timeout: int = 86400, max_retry_times: int = 5,
+                      backoff_base_seconds: float = 10, backoff_max_seconds: float = 600,
+                      on_progress: Optional[CopyCallback] = None) -> int:
+        """ 将NFS上的文件并行分块拷贝到本地，返回文件总字节数
+        1.文件按chunk_size切分，concurrency个工作线程各自从连接池借用连接（libnfs的连接不能跨线程共享），
+          按偏移读取块并写入本地文件的对应位置，内存占用不超过concurrency * chunk_size
+        2.失败时只重新拷贝未完成的块，连续失败（期间没有任何进展）超过max_retry_times次时抛出异常，重试前按指数退避等待
+        3.整个文件的拷贝时间超过timeout秒时抛出异常
+        """
+        deadline = time.monotonic() + timeout
+        nfs = cls(address)
+        total_size = nfs.getsize(path)
+        with open(dst_path, 'wb') as f:
+            f.truncate(total_size)
+
+        pending_offsets = list(range(0, total_size, chunk_size))
+        progress = dict(done_size=0)
+        progress_lock = threading.Lock()
+        retry_times = 0
+        while True:
+            failed_offsets, errors = cls._download_chunks(
+                nfs, path, dst_path, pending_offsets, total_size, concurrency, chunk_size, deadline,
+                on_progress, progress, progress_lock)
+            if not failed_offsets:
+                return total_size
+            if time.monotonic() >= deadline:
+                raise Exception(
+                    f"download file failed, timeout: {timeout}s, url: {posixpath.join(address, path)}, err: {errors[:1]}")
+
+            # 本次有进展则重新计数，只有连续失败才会耗尽重试次数
+            retry_times = 1 if len(failed_offsets) < len(pending_offsets) else retry_times + 1
+            if retry_times > max_retry_times:
+                raise Exception(
+                    f"download file failed, retry times has out of limit, url: {posixpath.join(address, path)}, "
+                    f"failed chunk count: {len(failed_offsets)}, err: {errors[:1]}")
+            pending_offsets = failed_offsets
+            time.sleep(TimeTool.get_backoff_seconds(retry_times, backoff_base_seconds, backoff_max_seconds))
+
+    @classmethod
+    def _download_chunks(cls, nfs: "NFSInterface", path: str, dst_path: str, offsets: list[int], total_size: int,
+                         concurrency: int, chunk_size: int, deadline: float, on_progress: Optional[CopyCallback],
+                         progress: dict[str, int], progress_lock: threading.Lock) -> tuple[list[int], list[str]]:
+        """ 多线程拷贝指定的块，返回失败的块偏移和错误信息 """
+        offset_queue: queue.Queue = queue.Queue()
+        for offset in offsets:
+            offset_queue.put(offset)
+        failed_offsets: list[int] = list()
+        errors: list[str] = list()
+
+        def worker() -> None:
+            nfs_file = None
+            dst_fd = os.open(dst_path, os.O_WRONLY)
+            try:
+                while True:
+                    try:
+                        offset = offset_queue.get_nowait()
+                    except queue.Empty:
+                        return
+                    try:
+                        if time.monotonic() >= deadline:
+                            raise Exception("download file timeout")
+                        if nfs_file is None:
+                            nfs_file = nfs.open(path, 'rb')
+                        length = min(chunk_size, total_size - offset)
+                        data = nfs_file.pread(offset, length)
+                        if len(data) != length:
+                            raise Exception(f"short read, offset: {offset}, expected: {length}, actual: {len(data)}")
+                        os.pwrite(dst_fd, data, offset)
+                    except Exception as e:
+                        with progress_lock:
+                            failed_offsets.append(offset)
+                            errors.append(str(e))
+                        # 连接可能已损坏，丢弃后后续的块使用新的连接
+                        if nfs_file is not None:
+                            nfs_file.close(discard=True)
+                        nfs_file = None
+                        continue
+
+                    with progress_lock:
+                        progress['done_size'] += length
+                        done_size = progress['done_size']
+                    if on_progress:
+                        on_progress(done_size, total_size)
+            finally:
+                os.close(dst_fd)
+                if nfs_file is not None:
+                    nfs_file.close()
+
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(max(1, min(concurrency, len(offsets))))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return sorted(failed_offsets), errors
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+from typing import Any, ClassVar, Optional
+
+from core.config import config
+
+try:
+    import redis
+except ImportError:
+    # 只有使用redis等待队列或状态存储时需要redis，未安装时不影响其他功能
+    redis = None
+
+
+class RedisClient:
+    """ Redis客户端
+    按config.redis创建，同一进程内共享连接池，连接数不超过max_connections
+    redis-py的连接池在fork出的子进程中首次使用时自动重建，迁移子进程可以直接使用
+    """
+
+    _pool: ClassVar[Optional[Any]] = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def get_pool(cls) -> Any:
+        with cls._lock:
+            if cls._pool is None:
+                if redis is None:
+                    raise Exception("redis is not installed, please install redis")
+                cls._pool = redis.ConnectionPool(
+                    host=config.redis.host,
+                    port=config.redis.port,
+                    password=config.redis.password or None,
+                    db=config.redis.db,
+                    max_connections=config.redis.max_connections,
+                    socket_timeout=config.redis.socket_timeout,
+                    socket_connect_timeout=config.redis.socket_connect_timeout,
+                    decode_responses=True,
+                )
+            return cls._pool
+
+    @classmethod
+    def get_client(cls) -> Any:
+        """ 获取使用共享连接池的客户端，返回的值均已解码为str """
+        return redis.Redis(connection_pool=cls.get_pool())
+
+    @staticmethod
+    def get_key(*names: Any) -> str:
+        """ 拼接带key_prefix的键名，eg: get_key("session", "queue") -> v2v_session_queue """
+        return config.redis.key_prefix + "_".join(str(name) for name in names)
+
+    @classmethod
+    def set_pool(cls, pool: Optional[Any]) -> None:
+        """ 替换共享连接池，例如指向本地的redis-server或进程内的替身，传入None时下次使用重新按配置创建 """
+        with cls._lock:
+            cls._pool = pool
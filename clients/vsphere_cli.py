@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import ssl
+import time
+import base64
+import socket
+import hashlib
+import http.client
+import http.cookiejar
+import urllib.error
+import urllib.parse
+import urllib.request
+from typing import Any, Callable, ClassVar, Iterator, Optional, Tuple
+from xml.sax.saxutils import escape as xml_escape
+
+import xmltodict
+
+from tools.time_tool import TimeTool
+
+
+# 下载进度回调，参数为已下载字节数和文件总字节数
+DownloadCallback = Callable[[int, int], None]
+
+
+class DatastoreClient:
+    """ vSphere数据存储文件访问客户端
+    通过 https://{host}:{port}/folder/{path}?dcPath={datacenter}&dsName={datastore} 访问数据存储中的文件
+    """
+
+    READ_SIZE: ClassVar[int] = 4 * 1024 * 1024
+    RETRY_EXCEPTIONS: ClassVar[tuple] = (urllib.error.URLError, http.client.HTTPException, socket.timeout, OSError)
+
+    def __init__(self, host: str, user: str, password: str, datacenter: str, port: int = 443,
+                 timeout: int = 200) -> None:
+        self.host = host
+        self.port = port
+        self.datacenter = datacenter
+        self.timeout = timeout
+        token = base64.b64encode(f"{user}:{password}".encode("utf-8")).decode("ascii")
+        self.auth_header = f"Basic {token}"
+
+        # 与ovftool的--noSSLVerify保持一致，不校验vCenter/ESXi证书
+        self.ssl_context = ssl.create_default_context()
+        self.ssl_context.check_hostname = False
+        self.ssl_context.verify_mode = ssl.CERT_NONE
+
+    @staticmethod
+    def parse_datastore_path(file_path: str) -> Tuple[str, str]:
+        """ 解析数据存储路径
+        eg: "[datastore1] test-vm-01/test-vm-01.vmdk" -> ("datastore1", "test-vm-01/test-vm-01.vmdk")
+        """
+        file_path = file_path.strip()
+        if not file_path.startswith("[") or "]" not in file_path:
+            raise ValueError(f"invalid datastore path: {file_path}")
+        datastore, path = file_path[1:].split("]", 1)
+        return datastore, path.strip()
+
+    def get_file_url(self, datastore: str, path: str) -> str:
+        query = urllib.parse.urlencode(dict(dcPath=self.datacenter, dsName=datastore))
+        return f"https://{self.host}:{self.port}/folder/{urllib.parse.quote(path)}?{query}"
+
+    def get_file_size(self, datastore: str, path: str) -> int:
+        """ 获取文件大小 """
+        with self._open(datastore, path, method="HEAD") as response:
+            return int(response.headers["Content-Length"])
+
+    def get_file_version(self, datastore: str, path: str) -> Optional[dict[str, object]]:
+        """ 获取文件的版本信息，用于判断文件自上次下载后是否变化
+        服务端不返回Last-Modified和ETag时无法判断，返回None
+        """
+        with self._open(datastore, path, method="HEAD") as response:
+            last_modified = response.headers.get("Last-Modified", "")
+            etag = response.headers.get("ETag", "")
+            if not last_modified and not etag:
+                return None
+            return dict(size=int(response.headers["Content-Length"]), last_modified=last_modified, etag=etag)
+
+    def read_file(self, datastore: str, path: str) -> bytes:
+        """ 读取小文件的全部内容，例如vmdk描述文件 """
+        with self._open(datastore, path) as response:
+            return response.read()
+
+    def download_file(self, datastore: str, path: str, dst_path: str, max_retry_times: int = 5,
+                      backoff_base_seconds: float = 10, backoff_max_seconds: float = 600,
+                      on_progress: Optional[DownloadCallback] = None,
+                      algorithms: tuple[str, ...] = (), sink: Optional[Any] = None) -> Tuple[int, dict[str, str]]:
+        """ 下载文件到本地，支持断点续传
+        1.本地已存在的部分通过Range请求跳过，失败重试时只下载剩余部分
+        2.连续失败（期间没有任何进展）超过max_retry_times次时抛出异常，重试前按指数退避等待
+        3.下载的同时计算哈希值，续传时先读取本地已下载的部分
+        4.sink为带reset和update方法的对象（例如分块缓存的写入器），每次尝试前调用reset，之后与哈希值一样按顺序传入文件的全部内容
+        返回文件总字节数和哈希值
+        """
+        retry_times = 0
+        while True:
+            local_size = self._get_local_size(dst_path)
+            hashes = {algorithm: hashlib.new(algorithm) for algorithm in algorithms}
+            consumers = list(hashes.values())
+            if sink is not None:
+                sink.reset()
+                consumers.append(sink)
+            try:
+                total_size = self.get_file_size(datastore, path)
+                self._download_range(datastore, path, dst_path, total_size, on_progress, consumers)
+                if self._get_local_size(dst_path) == total_size:
+                    return total_size, {algorithm: hash_obj.hexdigest() for algorithm, hash_obj in hashes.items()}
+                raise http.client.IncompleteRead(b"", total_size - self._get_local_size(dst_path))
+            except self.RETRY_EXCEPTIONS as e:
+                # 客户端错误（认证失败、文件不存在等）重试也无法恢复
+                if isinstance(e, urllib.error.HTTPError) and 400 <= e.code < 500 and e.code not in (408, 429):
+                    raise
+                # 本次有进展则重新计数，只有连续失败才会耗尽重试次数
+                retry_times = 1 if self._get_local_size(dst_path) > local_size else retry_times + 1
+                if retry_times > max_retry_times:
+                    raise Exception(
+                        "download file failed, retry times has out of limit, url: %s, err: %s"
+                        % (self.get_file_url(datastore, path), e))
+                time.sleep(TimeTool.get_backoff_seconds(retry_times, backoff_base_seconds, backoff_max_seconds))
+
+    def iter_range(self, datastore: str, path: str, offset: int, length: int, max_retry_times: int = 5,
+                   backoff_base_seconds: float = 1, backoff_max_seconds: float = 60) -> Iterator[bytes]:
+        """ 按块迭代读取文件中从offset开始的length字节，失败时从中断的位置继续请求
+        连续失败（期间没有任何进展）超过max_retry_times次时抛出异常，超出文件末尾的部分被截断
+        """
+        end = offset + length
+        retry_times = 0
+        while offset < end:
+            try:
+                with self._open(datastore, path, headers={"Range": f"bytes={offset}-{end - 1}"}) as response:
+                    # 服务端不支持Range时返回200和完整内容，无法按区间读取
+                    if response.status != 206:
+                        raise Exception(f"range request is not supported, url: {self.get_file_url(datastore, path)}")
+                    while offset < end and (chunk := response.read(min(self.READ_SIZE, end - offset))):
+                        offset += len(chunk)
+                        retry_times = 0
+                        yield chunk
+                return
+            except self.RETRY_EXCEPTIONS as e:
+                # 416表示起始位置已超出文件末尾
+                if isinstance(e, urllib.error.HTTPError) and e.code == 416:
+                    return
+                if isinstance(e, urllib.error.HTTPError) and 400 <= e.code < 500 and e.code not in (408, 429):
+                    raise
+                retry_times += 1
+                if retry_times > max_retry_times:
+                    raise Exception(
+                        "read file range failed, retry times has out of limit, url: %s, offset: %s, err: %s"
+                        % (self.get_file_url(datastore, path), offset, e))
+                time.sleep(TimeTool.get_backoff_seconds(retry_times, backoff_base_seconds, backoff_max_seconds))
+
+    def read_range(self, datastore: str, path: str, offset: int, length: int, **kwargs) -> bytes:
+        """ 读取文件中从offset开始的length字节，参数同iter_range """
+        return b"".join(self.iter_range(datastore, path, offset, length, **kwargs))
+
+    @staticmethod
+    def _get_local_size(dst_path: str) -> int:
+        return os.path.getsize(dst_path) if os.path.isfile(dst_path) else 0
+
+    def _download_range(self, datastore: str, path: str, dst_path: str, total_size: int,
+                        on_progress: Optional[DownloadCallback], consumers: list) -> int:
+        """ 从本地文件的末尾续传，返回本次下载的字节数，consumers依次传入文件的全部内容 """
+        offset = self._get_local_size(dst_path)
+        if offset > total_size:
+            offset = 0
+
+        # 本地文件已完整时无需再请求，只需读取本地文件传入consumers
+        response = None
+        if not offset or offset < total_size:
+            headers = {"Range": f"bytes={offset}-"} if offset else dict()
+            response = self._open(datastore, path, headers=headers)
+        downloaded_size = 0
+        # 服务端不支持Range时返回200和完整内容，只能从头下载
+        if response and offset and response.status != 206:
+            offset = 0
+        try:
+            with open(dst_path, "r+b" if offset else "wb") as f:
+                while consumers and f.tell() < offset:
+                    chunk = f.read(min(self.READ_SIZE, offset - f.tell()))
+                    for consumer in consumers:
+                        consumer.update(chunk)
+                f.seek(offset)
+                f.truncate()
+                while response and (chunk := response.read(self.READ_SIZE)):
+                    for consumer in consumers:
+                        consumer.update(chunk)
+                    f.write(chunk)
+                    downloaded_size += len(chunk)
+                    if on_progress:
+                        on_progress(offset + downloaded_size, total_size)
+        finally:
+            if response:
+                response.close()
+        return downloaded_size
+
+    def _open(self, datastore: str, path: str, method: str = "GET", headers: Optional[dict[str, str]] = None):
+        request = urllib.request.Request(self.get_file_url(datastore, path), method=method)
+        request.add_header("Authorization", self.auth_header)
+        for key, value in (headers or dict()).items():
+            request.add_header(key, value)
+        return urllib.request.urlopen(request, timeout=self.timeout, context=self.ssl_context)
+
+
+class VSphereFault(Exception):
+    """ vSphere API返回的错误，fault_type为错误类型，eg: "InvalidArgument"、"FileFault" """
+
+    def __init__(self, method: str, fault_type: str, message: str) -> None:
+        super(VSphereFault, self).__init__(f"vsphere api {method} failed, fault type: {fault_type}, message: {message}")
+        self.method = method
+        self.fault_type = fault_type
+
+
+class VSphereClient:
+    """ vSphere Web Services（SOAP）客户端
+    只实现增量同步需要的少量方法：快照、变更块跟踪（CBT）查询和开关机，会话通过cookie保持
+    返回值为xmltodict解析后的字典，命名空间已去掉，xsi:type保留为"@xsi:type"，托管对象引用为{"@type": ..., "#text": ...}
+    """
+
+    API_VERSION: ClassVar[str] = "6.5"
+    NAMESPACES: ClassVar[dict[str, Optional[str]]] = {
+        "http://schemas.xmlsoap.org/soap/envelope/": None,
+        "urn:vim25": None,
+        "http://www.w3.org/2001/XMLSchema-instance": "xsi",
+    }
+    # 可能出现多次的元素，解析为列表
+    FORCE_LIST: ClassVar[tuple[str, ...]] = ("objects", "propSet", "changedArea", "VirtualDevice")
+
+    def __init__(self, host: str, user: str, password: str, port: int = 443, timeout: int = 200) -> None:
+        self.url = f"https://{host}:{port}/sdk"
+        self.user = user
+        self.password = password
+        self.timeout = timeout
+        self.service_content: dict[str, Any] = dict()
+
+        # 与ovftool的--noSSLVerify保持一致，不校验vCenter/ESXi证书
+        ssl_context = ssl.create_default_context()
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPSHandler(context=ssl_context),
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+        )
+
+    @staticmethod
+    def text(node: Any) -> str:
+        """ 获取元素的文本，托管对象引用等带属性的元素解析为字典 """
+        if isinstance(node, dict):
+            return node.get("#text", "")
+        return "" if node is None else str(node)
+
+    @staticmethod
+    def mor(mor_type: str, value: str, tag: str = "_this") -> str:
+        """ 托管对象引用，eg: <_this type="VirtualMachine">vm-123</_this> """
+        return f'<{tag} type="{mor_type}">{xml_escape(value)}</{tag}>'
+
+    def invoke(self, method: str, this_type: str, this_value: str, body: str = "") -> Any:
+        """ 调用API方法，返回returnval，没有返回值时返回None """
+        envelope = (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" '
+            'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">'
+            f'<soapenv:Body><{method} xmlns="urn:vim25">{self.mor(this_type, this_value)}{body}</{method}>'
+            '</soapenv:Body></soapenv:Envelope>'
+        )
+        request = urllib.request.Request(self.url, data=envelope.encode("utf-8"), method="POST")
+        request.add_header("Content-Type", "text/xml; charset=utf-8")
+        request.add_header("SOAPAction", f"urn:vim25/{self.API_VERSION}")
+        try:
+            with self.opener.open(request, timeout=self.timeout) as response:
+                data = response.read()
+        except urllib.error.HTTPError as e:
+            # SOAP错误以HTTP 500返回
+            data = e.read()
+            if e.code != 500 or not data:
+                raise
+            fault = self._parse(data)["Envelope"]["Body"]["Fault"]
+            detail = next(iter((fault.get("detail") or dict()).values()), dict())
+            fault_type = detail.get("@xsi:type", "") if isinstance(detail, dict) else ""
+            raise VSphereFault(method, fault_type, self.text(fault.get("faultstring")))
+        result = self._parse(data)["Envelope"]["Body"][f"{method}Response"]
+        return result.get("returnval") if isinstance(result, dict) else None
+
+    def _parse(self, data: bytes) -> dict[str, Any]:
+        return xmltodict.parse(
+            data, process_namespaces=True, namespaces=self.NAMESPACES, force_list=self.FORCE_LIST
+        )
+
+    def login(self) -> None:
+        self.service_content = self.invoke("RetrieveServiceContent", "ServiceInstance", "ServiceInstance")
+        session_manager = self.service_content["sessionManager"]
+        self.invoke(
+            "Login", session_manager["@type"], self.text(session_manager),
+            f"<userName>{xml_escape(self.user)}</userName><password>{xml_escape(self.password)}</password>",
+        )
+
+    def logout(self) -> None:
+        if not self.service_content:
+            return
+        session_manager = self.service_content["sessionManager"]
+        self.invoke("Logout", session_manager["@type"], self.text(session_manager))
+        self.service_content = dict()
+
+    def retrieve_properties(self, obj_type: str, obj_value: str, path_list: list[str]) -> dict[str, Any]:
+        """ 获取托管对象的属性，返回属性路径和值的映射，值未设置的属性不在结果中 """
+        property_collector = self.service_content["propertyCollector"]
+        path_set = "".join(f"<pathSet>{path}</pathSet>" for path in path_list)
+        body = (
+            f"<specSet><propSet><type>{obj_type}</type>{path_set}</propSet>"
+            f"<objectSet>{self.mor(obj_type, obj_value, 'obj')}</objectSet></specSet><options/>"
+        )
+        result = self.invoke("RetrievePropertiesEx", property_collector["@type"], self.text(property_collector), body)
+        if not result:
+            return dict()
+        return {prop["name"]: prop.get("val") for obj in result["objects"] for prop in obj.get("propSet", list())}
+
+    def wait_for_task(self, task: Any, timeout: int = 3600, interval: float = 1) -> Any:
+        """ 等待任务结束，返回任务结果，任务失败或超时时抛出异常 """
+        deadline = time.monotonic() + timeout
+        while True:
+            info = self.retrieve_properties("Task", self.text(task), ["info"])["info"]
+            if info["state"] == "success":
+                return info.get("result")
+            if info["state"] == "error":
+                error = info.get("error") or dict()
+                raise Exception(f"vsphere task failed, task: {self.text(task)}, error reason: {error.get('localizedMessage', '')}")
+            if time.monotonic() >= deadline:
+                raise Exception(f"vsphere task timeout, task: {self.text(task)}, timeout: {timeout}")
+            time.sleep(interval)
+
+    def create_snapshot(self, vm: str, name: str, description: str = "", quiesce: bool = False) -> str:
+        """ 创建不含内存的快照，返回快照的id """
+        body = (
+            f"<name>{xml_escape(name)}</name><description>{xml_escape(description)}</description>"
+            f"<memory>false</memory><quiesce>{str(quiesce).lower()}</quiesce>"
+        )
+        task = self.invoke("CreateSnapshot_Task", "VirtualMachine", vm, body)
+        return self.text(self.wait_for_task(task))
+
+    def remove_snapshot(self, snapshot: str) -> None:
+        """ 删除快照，快照中的数据合并到父磁盘 """
+        task = self.invoke(
+            "RemoveSnapshot_Task", "VirtualMachineSnapshot", snapshot,
+            "<removeChildren>false</removeChildren><consolidate>true</consolidate>",
+        )
+        self.wait_for_task(task)
+
+    def enable_change_tracking(self, vm: str) -> None:
+        """ 开启变更块跟踪，下一次创建快照后生效 """
+        task = self.invoke(
+            "ReconfigVM_Task", "VirtualMachine", vm, "<spec><changeTrackingEnabled>true</changeTrackingEnabled></spec>"
+        )
+        self.wait_for_task(task)
+
+    def query_changed_disk_areas(self, vm: str, snapshot: Optional[str], device_key: int, start_offset: int,
+                                 change_id: str) -> dict[str, Any]:
+        """ 查询硬盘自change_id以来变化的区间，change_id为"*"时返回全部已分配的区间
+        一次调用只返回从start_offset开始的一部分，返回值中的startOffset和length为本次覆盖的范围
+        snapshot为None时查询硬盘的当前状态，只适用于已关机的虚拟机
+        """
+        body = self.mor("VirtualMachineSnapshot", snapshot, "snapshot") if snapshot else ""
+        body += f"<deviceKey>{device_key}</deviceKey><startOffset>{start_offset}</startOffset><changeId>{xml_escape(change_id)}</changeId>"
+        return self.invoke("QueryChangedDiskAreas", "VirtualMachine", vm, body)
+
+    def iter_changed_disk_areas(self, vm: str, snapshot: Optional[str], device_key: int, disk_size: int,
+                                change_id: str) -> Iterator[dict[str, int]]:
+        """ 逐次调用QueryChangedDiskAreas，迭代整个硬盘中变化的区间，区间为包含start和length的字典 """
+        offset = 0
+        while offset < disk_size:
+            change_info = self.query_changed_disk_areas(vm, snapshot, device_key, offset, change_id)
+            for area in change_info.get("changedArea", list()):
+                yield dict(start=int(area["start"]), length=int(area["length"]))
+            next_offset = int(change_info["startOffset"]) + int(change_info["length"])
+            if next_offset <= offset:
+                break
+            offset = next_offset
+
+    def get_virtual_disks(self, obj_type: str, obj_value: str) -> list[dict[str, Any]]:
+        """ 获取虚拟机或快照配置中的硬盘，eg: obj_type为"VirtualMachineSnapshot"时返回快照时刻的硬盘 """
+        devices = self.retrieve_properties(obj_type, obj_value, ["config.hardware.device"]).get("config.hardware.device")
+        return [
+            device for device in (devices or dict()).get("VirtualDevice", list())
+            if device.get("@xsi:type") == "VirtualDisk"
+        ]
+
+    def power_off(self, vm: str) -> None:
+        self.wait_for_task(self.invoke("PowerOffVM_Task", "VirtualMachine", vm))
+
+    def shutdown_guest(self, vm: str) -> None:
+        """ 通过VMware Tools关闭客户机操作系统，不等待关机完成 """
+        self.invoke("ShutdownGuest", "VirtualMachine", vm)
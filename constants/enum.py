@@ -2,6 +2,7 @@
 
 """功能：枚举定义"""
 
+import copy
 from enum import Enum
 
 
@@ -67,6 +68,15 @@ class MigratePattern(DescribedEnum):
 
     EXPORT_IMAGE = "export_image"  # 导出镜像
     UPLOAD_IMAGE = "upload_image"  # 上传镜像
+    DELTA_SYNC = "delta_sync"  # 增量同步
+
+
+class CoverImageMode(DescribedEnum):
+    """覆盖镜像时写入目标卷的方式"""
+
+    MOVE = "move"  # 剪切，镜像文件直接作为卷
+    DD = "dd"  # 只写入qcow2中已分配的数据
+    DIRECT_CONVERT = "direct_convert"  # 从vmdk直接转换到卷
 
 
 class MigrateStep(DescribedEnum):
@@ -94,6 +104,8 @@ class MigrateProcess(DescribedEnum):
     # 处理镜像
     START_DEAL_IMAGE_PROCESS = 30  # 开始处理镜像进度
     END_DEAL_IMAGE_PROCESS = 50  # 结束处理镜像进度
+    START_CONVERT_IMAGE_PROCESS = 35  # 开始转换镜像进度
+    END_CONVERT_IMAGE_PROCESS = 48  # 结束转换镜像进度，与END_DEAL_IMAGE_PROCESS取值不同，避免成为其别名
 
     # 创建虚拟机
     START_CREATE_INSTANCE_PROCESS = 55  # 开始创建虚拟机进度
@@ -130,7 +142,13 @@ class MigrateStatus(DescribedEnum):
 
 
 class RunningDetailMigrateStatus(DescribedEnum):
-    """迁移中时详细的子步骤进度和状态"""
+    """迁移中时详细的子步骤进度和状态
+    Note:状态模板为所有会话共享，须通过copy获取副本后再修改
+    """
+
+    def copy(self):
+        """返回状态模板的深拷贝"""
+        return copy.deepcopy(self.value)
 
     # 开始导出镜像时的详细状态
     START_EXPORT_IMAGE_DETAIL_STATUS = dict(
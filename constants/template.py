@@ -18,12 +18,18 @@ EXPORT_IMAGE_CMD_TEMPLATE = '''{ovf_tool_path} {common_params} {advanced_params}
 # 上传镜像
 ###############################################################################
 UPLOAD_IMAGE_COMPILE_NFS_CMD_TEMPLATE = '''gcc -fPIC -shared -o {ld_nfs_so_file_path} {ld_nfs_c_file_path} -ldl -lnfs'''
+# NFS上的vmdk发布为本地unix socket上的NBD导出，qemu-img直接读取，无需拷贝落盘，也无需预加载ld_nfs.so
+UPLOAD_IMAGE_NBD_SOURCE_URI_TEMPLATE = '''nbd+unix:///?socket={socket_path}'''
 ###############################################################################
 
 
 # 处理镜像
 ###############################################################################
 DEAL_IMAGE_CONVERT_IMAGE_CMD_TEMPLATE = '''{qemu_img_path} {qemu_img_action} -p -f {src_image_format} -O {dst_image_format} {src_image_path} {dst_image_path} '''
+# 链接克隆的差异磁盘转换为以共享基础镜像为backing file的qcow2，只写入差异磁盘中已分配的数据
+DEAL_IMAGE_CONVERT_OVERLAY_CMD_TEMPLATE = '''{qemu_img_path} convert -p -f {src_image_format} -O {dst_image_format} -B {base_image_path} -F {base_image_format} {src_image_path} {dst_image_path} '''
+# OVA内tar成员的偏移读取地址，qemu-img可直接从OVA中读取VMDK，无需解压落盘
+DEAL_IMAGE_OVA_MEMBER_URI_TEMPLATE = """'json:{{"file": {{"driver": "raw", "offset": {offset}, "size": {size}, "file": {{"driver": "file", "filename": "{ova_path}"}}}}}}' """
 # DEAL_IMAGE_SANC_COMMON_CMD_TEMPLATE = '''{qemu_img_path} {qemu_img_action} -O {image_format} {image_path} {volume_path} '''
 ###############################################################################
 
@@ -95,6 +101,12 @@ CREATE_INSTANCE_STOP_INSTANCE_CMD_TEMPLATE = '''virsh destroy {instance_id}'''
 # 覆盖镜像
 ###############################################################################
 CONVERT_IMAGE_SANC_VOS_CMD_TEMPLATE = '''{qemu_img_qbd_path} {qemu_img_action} -p -n {image_path} -O raw qbd:vol/{volume_id}.img:conf=/etc/neonsan/qbd.conf:type=tcp '''
+# 镜像的数据分配信息，用于只拷贝已分配的数据
+COVER_IMAGE_MAP_CMD_TEMPLATE = '''{qemu_img_path} map --output=json -f {image_format} {image_path} '''
+# 无法解析数据分配信息时，退化为全量拷贝到块设备
+COVER_IMAGE_FULL_COPY_CMD_TEMPLATE = '''{qemu_img_path} convert -p -n -f {image_format} -O raw {image_path} {dev_path} '''
+# 合并backing file中的数据，使qcow2不再依赖共享基础镜像
+COVER_IMAGE_FLATTEN_CMD_TEMPLATE = '''{qemu_img_path} rebase -f {image_format} -b "" {image_path} '''
 ###############################################################################
 
 
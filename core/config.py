@@ -16,6 +16,8 @@ class ProjectConfig:
 class MigrationConfig:
     indeed_start_migrate_timeout: int = 300
     indeed_end_migrate_timeout: int = 86400
+    progress_report_interval: int = 30
+    checkpoint_base_dir: str = "v2v_checkpoint"
     
     export_image_log_path: str = "/x-v2v/log/ovftool.log"
     export_image_log_level: str = "warning"
@@ -24,6 +26,15 @@ class MigrationConfig:
     export_image_dst_format_ova: str = "ova"
     export_image_timeout: int = 86400
     export_image_max_retry_times: int = 5
+    export_image_retry_backoff_base: int = 10
+    export_image_retry_backoff_max: int = 600
+    export_image_per_disk: bool = False
+    export_image_disk_concurrency: int = 4
+    export_image_datastore_concurrency: int = 2
+    export_image_chunk_cache: bool = False
+    export_image_chunk_cache_dir: str = "v2v_chunk"
+    export_image_chunk_cache_max_gb: int = 500
+    export_image_chunk_cache_chunk_size: int = 4194304
     export_image_cmd_vi_prefix: str = "vi://"
     export_image_cmd_nosslverify: str = "--noSSLVerify"
     export_image_cmd_overwrite: str = "--overwrite"
@@ -34,15 +45,36 @@ class MigrationConfig:
     export_image_cmd_nonvramfile: str = "--noNvramFile"
     export_image_cmd_acceptalleulas: str = "--acceptAllEulas"
     
+    delta_sync_reader: str = "vsphere"
+    delta_sync_file_reader_dir: str = "v2v_delta"
+    delta_sync_max_rounds: int = 5
+    delta_sync_final_threshold_mb: int = 1024
+    delta_sync_snapshot_quiesce: bool = False
+    delta_sync_guest_shutdown_timeout: int = 300
+    
     upload_image_ld_nfs_so_path: str = "/x-v2v/iaas/lib/ld_nfs.so"
     upload_image_dst_base_dir: str = "v2v_upload"
     upload_image_timeout: int = 86400
+    upload_image_concurrency: int = 4
+    upload_image_chunk_size: int = 8388608
+    upload_image_max_retry_times: int = 5
+    upload_image_retry_backoff_base: int = 10
+    upload_image_retry_backoff_max: int = 600
+    upload_image_stream_convert: bool = False
     
     deal_image_src_format_vmdk: str = "vmdk"
     deal_image_dst_format_qcow2: str = "qcow2"
     deal_image_convert_image_timeout: int = 86400
+    deal_image_convert_concurrency: int = 4
     deal_image_mount_base_dir: str = "v2v_mount"
     deal_image_file_lock_base_dir: str = "v2v_lock"
+    deal_image_stream_convert: bool = False
+    deal_image_direct_convert_data_disk: bool = False
+    deal_image_identify_os_disk_by_partition: bool = True
+    deal_image_disk_size_align_gb: int = 10
+    deal_image_linked_clone: bool = False
+    deal_image_linked_clone_base_dir: str = "v2v_base"
+    deal_image_linked_clone_keep_base: bool = True
     
     create_instance_image_file_path: str = "template.lz4"
     create_instance_run_instance_timeout: int = 1800
@@ -53,6 +85,13 @@ class MigrationConfig:
     create_instance_attach_volumes_timeout: int = 600
     
     cover_image_timeout: int = 86400
+    cover_image_sparse_copy: bool = True
+    cover_image_hole_mode: str = "discard"
+    cover_image_copy_buffer_size: int = 8388608
+    cover_image_storage_backend: str = "qbd"
+    cover_image_block_dev_path_template: str = "/dev/disk/by-id/{volume_id}"
+    cover_image_file_backend_dir: str = "v2v_volume"
+    cover_image_file_volume_format: str = "raw"
 
 
 @dataclass
@@ -127,6 +166,20 @@ class SettingConfig:
     max_migrating_num: int = 10
     clean_after_failed: bool = True
     vm_max_migrate_timeout: int = 86400
+    admission_enabled: bool = True
+    admission_thin_provisioned_ratio: float = 0.6
+    admission_disk_reserved_gb: int = 50
+    admission_uplink_bandwidth_mbps: int = 0
+    admission_export_bandwidth_per_session_mbps: int = 1000
+    admission_max_load_ratio: float = 0.9
+    status_store: str = "sqlite"
+    status_store_sqlite_path: str = "v2v_status.db"
+    status_store_pg_dsn: str = ""
+    status_store_flush_interval: float = 1.0
+    status_store_batch_size: int = 100
+    session_queue: str = "memory"
+    session_queue_node_id: str = ""
+    session_queue_visibility_timeout: int = 300
 
 
 @dataclass
@@ -186,6 +239,8 @@ class Config:
         self._migration = MigrationConfig(
             indeed_start_migrate_timeout=migration_data.get('indeed_start_migrate_timeout', 300),
             indeed_end_migrate_timeout=migration_data.get('indeed_end_migrate_timeout', 86400),
+            progress_report_interval=migration_data.get('progress_report_interval', 30),
+            checkpoint_base_dir=migration_data.get('checkpoint_base_dir', 'v2v_checkpoint'),
             
             export_image_log_path=migration_data.get('export_image_log_path', '/x-v2v/log/ovftool.log'),
             export_image_log_level=migration_data.get('export_image_log_level', 'warning'),
@@ -194,6 +249,15 @@ class Config:
             export_image_dst_format_ova=migration_data.get('export_image_dst_format_ova', 'ova'),
             export_image_timeout=migration_data.get('export_image_timeout', 86400),
             export_image_max_retry_times=migration_data.get('export_image_max_retry_times', 5),
+            export_image_retry_backoff_base=migration_data.get('export_image_retry_backoff_base', 10),
+            export_image_retry_backoff_max=migration_data.get('export_image_retry_backoff_max', 600),
+            export_image_per_disk=migration_data.get('export_image_per_disk', False),
+            export_image_disk_concurrency=migration_data.get('export_image_disk_concurrency', 4),
+            export_image_datastore_concurrency=migration_data.get('export_image_datastore_concurrency', 2),
+            export_image_chunk_cache=migration_data.get('export_image_chunk_cache', False),
+            export_image_chunk_cache_dir=migration_data.get('export_image_chunk_cache_dir', 'v2v_chunk'),
+            export_image_chunk_cache_max_gb=migration_data.get('export_image_chunk_cache_max_gb', 500),
+            export_image_chunk_cache_chunk_size=migration_data.get('export_image_chunk_cache_chunk_size', 4194304),
             export_image_cmd_vi_prefix=migration_data.get('export_image_cmd_vi_prefix', 'vi://'),
             export_image_cmd_nosslverify=migration_data.get('export_image_cmd_nosslverify', '--noSSLVerify'),
             export_image_cmd_overwrite=migration_data.get('export_image_cmd_overwrite', '--overwrite'),
@@ -204,15 +268,36 @@ class Config:
             export_image_cmd_nonvramfile=migration_data.get('export_image_cmd_nonvramfile', '--noNvramFile'),
             export_image_cmd_acceptalleulas=migration_data.get('export_image_cmd_acceptalleulas', '--acceptAllEulas'),
             
+            delta_sync_reader=migration_data.get('delta_sync_reader', 'vsphere'),
+            delta_sync_file_reader_dir=migration_data.get('delta_sync_file_reader_dir', 'v2v_delta'),
+            delta_sync_max_rounds=migration_data.get('delta_sync_max_rounds', 5),
+            delta_sync_final_threshold_mb=migration_data.get('delta_sync_final_threshold_mb', 1024),
+            delta_sync_snapshot_quiesce=migration_data.get('delta_sync_snapshot_quiesce', False),
+            delta_sync_guest_shutdown_timeout=migration_data.get('delta_sync_guest_shutdown_timeout', 300),
+            
             upload_image_ld_nfs_so_path=migration_data.get('upload_image_ld_nfs_so_path', '/x-v2v/iaas/lib/ld_nfs.so'),
             upload_image_dst_base_dir=migration_data.get('upload_image_dst_base_dir', 'v2v_upload'),
             upload_image_timeout=migration_data.get('upload_image_timeout', 86400),
+            upload_image_concurrency=migration_data.get('upload_image_concurrency', 4),
+            upload_image_chunk_size=migration_data.get('upload_image_chunk_size', 8388608),
+            upload_image_max_retry_times=migration_data.get('upload_image_max_retry_times', 5),
+            upload_image_retry_backoff_base=migration_data.get('upload_image_retry_backoff_base', 10),
+            upload_image_retry_backoff_max=migration_data.get('upload_image_retry_backoff_max', 600),
+            upload_image_stream_convert=migration_data.get('upload_image_stream_convert', False),
             
             deal_image_src_format_vmdk=migration_data.get('deal_image_src_format_vmdk', 'vmdk'),
             deal_image_dst_format_qcow2=migration_data.get('deal_image_dst_format_qcow2', 'qcow2'),
             deal_image_convert_image_timeout=migration_data.get('deal_image_convert_image_timeout', 86400),
+            deal_image_convert_concurrency=migration_data.get('deal_image_convert_concurrency', 4),
             deal_image_mount_base_dir=migration_data.get('deal_image_mount_base_dir', 'v2v_mount'),
             deal_image_file_lock_base_dir=migration_data.get('deal_image_file_lock_base_dir', 'v2v_lock'),
+            deal_image_stream_convert=migration_data.get('deal_image_stream_convert', False),
+            deal_image_direct_convert_data_disk=migration_data.get('deal_image_direct_convert_data_disk', False),
+            deal_image_identify_os_disk_by_partition=migration_data.get('deal_image_identify_os_disk_by_partition', True),
+            deal_image_disk_size_align_gb=migration_data.get('deal_image_disk_size_align_gb', 10),
+            deal_image_linked_clone=migration_data.get('deal_image_linked_clone', False),
+            deal_image_linked_clone_base_dir=migration_data.get('deal_image_linked_clone_base_dir', 'v2v_base'),
+            deal_image_linked_clone_keep_base=migration_data.get('deal_image_linked_clone_keep_base', True),
             
             create_instance_image_file_path=migration_data.get('create_instance_image_file_path', 'template.lz4'),
             create_instance_run_instance_timeout=migration_data.get('create_instance_run_instance_timeout', 1800),
@@ -222,7 +307,16 @@ class Config:
             create_instance_create_volumes_timeout=migration_data.get('create_instance_create_volumes_timeout', 1200),
             create_instance_attach_volumes_timeout=migration_data.get('create_instance_attach_volumes_timeout', 600),
             
-            cover_image_timeout=migration_data.get('cover_image_timeout', 86400)
+            cover_image_timeout=migration_data.get('cover_image_timeout', 86400),
+            cover_image_sparse_copy=migration_data.get('cover_image_sparse_copy', True),
+            cover_image_hole_mode=migration_data.get('cover_image_hole_mode', 'discard'),
+            cover_image_copy_buffer_size=migration_data.get('cover_image_copy_buffer_size', 8388608),
+            cover_image_storage_backend=migration_data.get('cover_image_storage_backend', 'qbd'),
+            cover_image_block_dev_path_template=migration_data.get(
+                'cover_image_block_dev_path_template', '/dev/disk/by-id/{volume_id}'
+            ),
+            cover_image_file_backend_dir=migration_data.get('cover_image_file_backend_dir', 'v2v_volume'),
+            cover_image_file_volume_format=migration_data.get('cover_image_file_volume_format', 'raw')
         )
         
         hyper_data = self._config_data.get('hyper', {})
@@ -298,7 +392,21 @@ class Config:
             concurrency_migrate=setting_data.get('concurrency_migrate', 3),
             max_migrating_num=setting_data.get('max_migrating_num', 10),
             clean_after_failed=setting_data.get('clean_after_failed', True),
-            vm_max_migrate_timeout=setting_data.get('vm_max_migrate_timeout', 86400)
+            vm_max_migrate_timeout=setting_data.get('vm_max_migrate_timeout', 86400),
+            admission_enabled=setting_data.get('admission_enabled', True),
+            admission_thin_provisioned_ratio=setting_data.get('admission_thin_provisioned_ratio', 0.6),
+            admission_disk_reserved_gb=setting_data.get('admission_disk_reserved_gb', 50),
+            admission_uplink_bandwidth_mbps=setting_data.get('admission_uplink_bandwidth_mbps', 0),
+            admission_export_bandwidth_per_session_mbps=setting_data.get('admission_export_bandwidth_per_session_mbps', 1000),
+            admission_max_load_ratio=setting_data.get('admission_max_load_ratio', 0.9),
+            status_store=setting_data.get('status_store', 'sqlite'),
+            status_store_sqlite_path=setting_data.get('status_store_sqlite_path', 'v2v_status.db'),
+            status_store_pg_dsn=setting_data.get('status_store_pg_dsn', ''),
+            status_store_flush_interval=setting_data.get('status_store_flush_interval', 1.0),
+            status_store_batch_size=setting_data.get('status_store_batch_size', 100),
+            session_queue=setting_data.get('session_queue', 'memory'),
+            session_queue_node_id=setting_data.get('session_queue_node_id', ''),
+            session_queue_visibility_timeout=setting_data.get('session_queue_visibility_timeout', 300)
         )
         
         resource_data = self._config_data.get('resource', {})
@@ -415,6 +523,30 @@ class Config:
     def deal_image_file_lock_base_dir_full(self) -> str:
         return os.path.join(self._self.data_dir, self._migration.deal_image_file_lock_base_dir)
 
+    @property
+    def export_image_chunk_cache_dir_full(self) -> str:
+        return os.path.join(self._self.data_dir, self._migration.export_image_chunk_cache_dir)
+
+    @property
+    def delta_sync_file_reader_dir_full(self) -> str:
+        return os.path.join(self._self.data_dir, self._migration.delta_sync_file_reader_dir)
+
+    @property
+    def deal_image_linked_clone_base_dir_full(self) -> str:
+        return os.path.join(self._self.data_dir, self._migration.deal_image_linked_clone_base_dir)
+
+    @property
+    def cover_image_file_backend_dir_full(self) -> str:
+        return os.path.join(self._self.data_dir, self._migration.cover_image_file_backend_dir)
+
+    @property
+    def status_store_sqlite_path_full(self) -> str:
+        return os.path.join(self._self.data_dir, self._setting.status_store_sqlite_path)
+
+    @property
+    def checkpoint_base_dir_full(self) -> str:
+        return os.path.join(self._self.data_dir, self._migration.checkpoint_base_dir)
+
     @property
     def create_instance_image_file_path_full(self) -> str:
         return os.path.join(self._self.deploy_dir, "statics", self._migration.create_instance_image_file_path)
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+
+"""
+功能：增量同步的硬盘读取器
+
+增量同步模式在源虚拟机运行期间完成全量基线拷贝，之后多轮拷贝变化的数据，只在最后一轮前关闭源虚拟机
+读取器负责查询硬盘自某个变更标识以来变化的区间并读取区间内的数据，按名称注册，由delta_sync_reader选择
+1.变更标识  "*"表示查询硬盘中全部已分配的区间，用于基线拷贝；查询同时返回最新的变更标识，作为下一轮查询的起点
+2.区间      与BlockTool的数据区间一致，为包含start和length的字典，按start升序且互不重叠
+3.vsphere  每轮创建快照，通过变更块跟踪（CBT）查询变化的区间，经数据存储的HTTP Range请求读取快照时刻的父磁盘，
+           最后一轮前关闭源虚拟机
+4.file     本地替身，从文件读取硬盘数据和变更列表，不会关闭源虚拟机，只用于在没有源平台的环境中验证增量同步流程
+"""
+
+import abc
+import json
+import os
+import posixpath
+import threading
+import time
+
+from core.logger import logger
+from core.config import config
+
+from clients.vsphere_cli import DatastoreClient, VSphereClient, VSphereFault
+from tools.file_tool import FileTool
+from tools.registry_tool import Registry
+from tools.vmdk_tool import VmdkTool
+
+
+# 已注册的读取器，key为读取器名称
+DELTA_READER_REGISTRY = Registry("delta reader")
+register_delta_reader = DELTA_READER_REGISTRY.register
+
+
+def get_delta_reader(name, vm_session):
+    """按名称创建读取器"""
+    return DELTA_READER_REGISTRY.create(name, vm_session)
+
+
+class InvalidChangeIdError(Exception):
+    """变更标识已失效（例如源平台重置了变更跟踪），需重新进行基线拷贝"""
+
+
+class DeltaReader(abc.ABC):
+    """读取器基类"""
+
+    name = ""
+    # 查询全部已分配区间的变更标识
+    ALL_CHANGE_ID = "*"
+    # 单次读取的最大字节数
+    READ_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, vm_session):
+        self.vm_session = vm_session
+
+    @abc.abstractmethod
+    def get_disk_size(self, src_vm_disk):
+        """硬盘的容量字节数"""
+
+    @abc.abstractmethod
+    def query_changed_areas(self, src_vm_disk, change_id):
+        """查询硬盘自change_id以来变化的区间，返回区间列表和最新的变更标识
+        Note:最新的变更标识须在读取数据之前确定，读取期间写入的数据由下一轮重新拷贝
+        """
+
+    @abc.abstractmethod
+    def read(self, src_vm_disk, offset, length):
+        """读取硬盘数据"""
+
+    @abc.abstractmethod
+    def stop_source(self):
+        """关闭源虚拟机，最后一轮增量同步前调用，之后硬盘数据不再变化，重复调用不报错"""
+
+    def begin_round(self):
+        """每轮同步开始前调用，本轮各硬盘的查询和读取基于同一时刻的数据"""
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def merge_areas(areas):
+        """按起始位置排序，合并重叠或相邻的区间"""
+        merged = list()
+        for area in sorted(areas, key=lambda area: area["start"]):
+            if merged and area["start"] <= merged[-1]["start"] + merged[-1]["length"]:
+                last = merged[-1]
+                last["length"] = max(last["length"], area["start"] + area["length"] - last["start"])
+                continue
+            merged.append(dict(start=area["start"], length=area["length"]))
+        return merged
+
+
+@register_delta_reader("file")
+class FileDeltaReader(DeltaReader):
+    """本地替身
+    目录为delta_sync_file_reader_dir/<src_vm_id>，每块硬盘按device_key对应两个文件：
+    1.disk-<device_key>.img      硬盘的当前数据，raw格式
+    2.disk-<device_key>.changes  变更列表，写入硬盘数据后追加一行，eg: {"change_id": "2", "areas": [[0, 4096], [1048576, 512]]}
+    关闭源虚拟机时在目录下创建powered_off文件，写入方据此停止写入
+    """
+
+    def __init__(self, vm_session):
+        super(FileDeltaReader, self).__init__(vm_session)
+        self.root_dir = os.path.join(config.delta_sync_file_reader_dir_full, str(vm_session.src_vm_id))
+        logger.warning(
+            f"file delta reader is a local stand-in, source vm is not powered off, session id: {vm_session.session_id}"
+        )
+        self._fd_map = dict()
+        self._lock = threading.Lock()
+
+    def _get_image_path(self, src_vm_disk):
+        return os.path.join(self.root_dir, f"disk-{src_vm_disk['device_key']}.img")
+
+    def _get_changes_path(self, src_vm_disk):
+        return os.path.join(self.root_dir, f"disk-{src_vm_disk['device_key']}.changes")
+
+    def get_disk_size(self, src_vm_disk):
+        return os.path.getsize(self._get_image_path(src_vm_disk))
+
+    def query_changed_areas(self, src_vm_disk, change_id):
+        changes = self._load_changes(src_vm_disk)
+        latest_change_id = changes[-1]["change_id"] if changes else ""
+        if change_id == self.ALL_CHANGE_ID:
+            with open(self._get_image_path(src_vm_disk), "rb") as f:
+                return FileTool.get_data_extents(f.fileno()), latest_change_id
+
+        # 空的变更标识表示基线拷贝时还没有任何变更
+        change_id_list = [change["change_id"] for change in changes]
+        if change_id and change_id not in change_id_list:
+            raise InvalidChangeIdError(
+                f"change id is not found, device key: {src_vm_disk['device_key']}, change id: {change_id}"
+            )
+        index = change_id_list.index(change_id) + 1 if change_id else 0
+        areas = [dict(start=start, length=length) for change in changes[index:] for start, length in change["areas"]]
+        return self.merge_areas(areas), latest_change_id
+
+    def read(self, src_vm_disk, offset, length):
+        image_path = self._get_image_path(src_vm_disk)
+        with self._lock:
+            if image_path not in self._fd_map:
+                self._fd_map[image_path] = os.open(image_path, os.O_RDONLY)
+            fd = self._fd_map[image_path]
+        return os.pread(fd, length, offset)
+
+    def stop_source(self):
+        with open(os.path.join(self.root_dir, "powered_off"), "w"):
+            pass
+
+    def close(self):
+        with self._lock:
+            for fd in self._fd_map.values():
+                os.close(fd)
+            self._fd_map.clear()
+
+    def _load_changes(self, src_vm_disk):
+        """读取变更列表，最后一行正在写入、尚不完整时忽略，由下一轮读取"""
+        changes = list()
+        changes_path = self._get_changes_path(src_vm_disk)
+        if not os.path.isfile(changes_path):
+            return changes
+
+        with open(changes_path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    changes.append(json.loads(line))
+                except ValueError:
+                    break
+        return changes
+
+
+@register_delta_reader("vsphere")
+class VSphereDeltaReader(DeltaReader):
+    """vSphere源平台
+    1.每轮开始时删除上一轮的快照并创建新快照，快照后源虚拟机的写入进入新的差异磁盘，父磁盘在本轮内不再变化
+    2.QueryChangedDiskAreas按快照查询变化的区间，最新的变更标识为快照中硬盘的changeId
+    3.数据从快照配置中硬盘的数据文件（父磁盘的flat extent）按区间读取
+    4.源虚拟机未开启CBT时自动开启，在下一次创建快照后生效
+    Note:源虚拟机已有快照时硬盘为差异磁盘，无法按区间读取，需先合并快照
+    """
+
+    SNAPSHOT_NAME = "x-v2v-delta-sync"
+
+    def __init__(self, vm_session):
+        super(VSphereDeltaReader, self).__init__(vm_session)
+        src_platform = vm_session.task.src_platform
+        timeout = config.vmware_vsphere.timeout_connect_to_vmware_vsphere
+        self.vm = vm_session.src_vm_id
+        self.client = VSphereClient(
+            src_platform.ip, src_platform.user, src_platform.password, port=src_platform.port, timeout=timeout
+        )
+        self.datastore_client = DatastoreClient(
+            src_platform.ip,
+            src_platform.user,
+            src_platform.password,
+            vm_session.task.src_datacenter_name,
+            port=src_platform.port,
+            timeout=timeout,
+        )
+        self.snapshot = None
+        # 当前快照中的硬盘，key为device_key
+        self._disk_map = dict()
+        self._lock = threading.Lock()
+        self.client.login()
+
+    def begin_round(self):
+        with self._lock:
+            properties = self.client.retrieve_properties(
+                "VirtualMachine", self.vm, ["config.changeTrackingEnabled"]
+            )
+            if self.client.text(properties.get("config.changeTrackingEnabled")) != "true":
+                self.client.enable_change_tracking(self.vm)
+                logger.info(f"change tracking enabled, session id: {self.vm_session.session_id}, src vm id: {self.vm}")
+
+            self._remove_snapshot()
+            self.snapshot = self.client.create_snapshot(
+                self.vm,
+                self.SNAPSHOT_NAME,
+                f"delta sync of session {self.vm_session.session_id}",
+                quiesce=config.migration.delta_sync_snapshot_quiesce,
+            )
+            self._disk_map = {
+                int(disk["key"]): disk for disk in self.client.get_virtual_disks("VirtualMachineSnapshot", self.snapshot)
+            }
+            logger.info(
+                f"delta sync snapshot created, session id: {self.vm_session.session_id}, src vm id: {self.vm}, snapshot: {self.snapshot}"
+            )
+
+    def _get_disk(self, src_vm_disk):
+        disk = self._disk_map.get(int(src_vm_disk["device_key"]))
+        if disk is None:
+            raise Exception(
+                f"disk is not found in snapshot, device key: {src_vm_disk['device_key']}, snapshot: {self.snapshot}"
+            )
+        if disk["backing"].get("parent"):
+            raise Exception(
+                f"disk has snapshot, please consolidate snapshots, device key: {src_vm_disk['device_key']}, "
+                f"file name: {disk['backing']['fileName']}"
+            )
+        if "extent" not in disk:
+            # 快照时刻的父磁盘只读，描述文件和数据文件在本轮内不变
+            datastore, descriptor_path = DatastoreClient.parse_datastore_path(disk["backing"]["fileName"])
+            descriptor = self.datastore_client.read_file(datastore, descriptor_path).decode("utf-8")
+            extents = VmdkTool.parse_descriptor_extents(descriptor)
+            if len(extents) != 1 or extents[0]["type"] not in ("VMFS", "FLAT"):
+                raise Exception(
+                    f"unsupported disk extents, device key: {src_vm_disk['device_key']}, extents: {extents}"
+                )
+            disk["extent"] = dict(
+                datastore=datastore,
+                path=posixpath.join(posixpath.dirname(descriptor_path), extents[0]["file_name"]),
+                offset=extents[0]["offset"] * 512,
+            )
+        return disk
+
+    def get_disk_size(self, src_vm_disk):
+        disk = self._get_disk(src_vm_disk)
+        if disk.get("capacityInBytes"):
+            return int(disk["capacityInBytes"])
+        return int(disk["capacityInKB"]) * 1024
+
+    def query_changed_areas(self, src_vm_disk, change_id):
+        disk = self._get_disk(src_vm_disk)
+        try:
+            areas = list(self.client.iter_changed_disk_areas(
+                self.vm, self.snapshot, int(src_vm_disk["device_key"]), self.get_disk_size(src_vm_disk), change_id
+            ))
+        except VSphereFault as e:
+            # 变更标识对应的CBT记录已重置（例如硬盘迁移、CBT被关闭再开启）
+            if change_id != self.ALL_CHANGE_ID and e.fault_type in ("InvalidArgument", "FileFault"):
+                raise InvalidChangeIdError(str(e))
+            raise
+        return self.merge_areas(areas), disk["backing"]["changeId"]
+
+    def read(self, src_vm_disk, offset, length):
+        extent = self._get_disk(src_vm_disk)["extent"]
+        return self.datastore_client.read_range(
+            extent["datastore"],
+            extent["path"],
+            extent["offset"] + offset,
+            length,
+            max_retry_times=config.migration.export_image_max_retry_times,
+        )
+
+    def stop_source(self):
+        """先通过VMware Tools正常关机，超时或未运行VMware Tools时强制关机"""
+        properties = self.client.retrieve_properties(
+            "VirtualMachine", self.vm, ["runtime.powerState", "guest.toolsRunningStatus"]
+        )
+        if self.client.text(properties.get("runtime.powerState")) == "poweredOff":
+            return
+
+        timeout = config.migration.delta_sync_guest_shutdown_timeout
+        if timeout and self.client.text(properties.get("guest.toolsRunningStatus")) == "guestToolsRunning":
+            self.client.shutdown_guest(self.vm)
+            deadline = time.monotonic() + timeout
+            while time.monotonic() < deadline:
+                time.sleep(5)
+                properties = self.client.retrieve_properties("VirtualMachine", self.vm, ["runtime.powerState"])
+                if self.client.text(properties.get("runtime.powerState")) == "poweredOff":
+                    logger.info(f"source vm shutdown, session id: {self.vm_session.session_id}, src vm id: {self.vm}")
+                    return
+            logger.warning(
+                f"shutdown guest timeout, power off, session id: {self.vm_session.session_id}, src vm id: {self.vm}, timeout: {timeout}"
+            )
+        self.client.power_off(self.vm)
+        logger.info(f"source vm powered off, session id: {self.vm_session.session_id}, src vm id: {self.vm}")
+
+    def _remove_snapshot(self):
+        if self.snapshot is None:
+            return
+        snapshot, self.snapshot = self.snapshot, None
+        self.client.remove_snapshot(snapshot)
+
+    def close(self):
+        with self._lock:
+            try:
+                self._remove_snapshot()
+            finally:
+                self.client.logout()
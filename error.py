@@ -12,6 +12,7 @@ class ErrorCode(Enum):
     ERROR_WORKER_SERVICE_RESET = 2
     ERROR_DISPATCH_START_MIGRATE_TIMEOUT = 4
     ERROR_DISPATCH_END_MIGRATE_TIMEOUT = 5
+    ERROR_DISPATCH_DISK_SPACE_NOT_ENOUGH = 8
     ERROR_DST_VM_TYPE_INVALID = 6
     ERROR_DST_VM_VOLUME_TYPE_INVALID = 7
 
@@ -31,6 +32,8 @@ class ErrorCode(Enum):
     # 导出镜像
     EXPORT_IMAGE_ERROR_COMMON = 2000
     EXPORT_IMAGE_ERROR_OVA_NOT_EXISTS = 2001
+    EXPORT_IMAGE_ERROR_DOWNLOAD_DISK_FAILED = 2002
+    EXPORT_IMAGE_ERROR_SYNC_DISK_FAILED = 2003
 
     # 上传镜像
     UPLOAD_IMAGE_ERROR_COMMON = 3000
@@ -94,6 +97,7 @@ class ErrorMsg(Enum):
     ERROR_WORKER_SERVICE_RESET = _ErrorDict("worker service reset", "迁移服务被重置")
     ERROR_DISPATCH_START_MIGRATE_TIMEOUT = _ErrorDict("dispatch start migrate timeout", "调度开始迁移超时")
     ERROR_DISPATCH_END_MIGRATE_TIMEOUT = _ErrorDict("dispatch end migrate timeout", "调度结束迁移超时")
+    ERROR_DISPATCH_DISK_SPACE_NOT_ENOUGH = _ErrorDict("dispatch disk space not enough", "迁移所需的暂存空间超出节点的可用空间")
     ERROR_DST_VM_TYPE_INVALID = _ErrorDict("dst vm type invalid", "目标虚拟机类型非法")
     ERROR_DST_VM_VOLUME_TYPE_INVALID = _ErrorDict("dst vm volume type invalid", "目标虚拟机硬盘类型非法")
 
@@ -113,6 +117,8 @@ class ErrorMsg(Enum):
     # 导出镜像
     EXPORT_IMAGE_ERROR_COMMON = _ErrorDict("export image failed", "导出镜像失败")
     EXPORT_IMAGE_ERROR_OVA_NOT_EXISTS = _ErrorDict("ova file not exists", "OVA文件不存在")
+    EXPORT_IMAGE_ERROR_DOWNLOAD_DISK_FAILED = _ErrorDict("download disk failed", "下载硬盘失败")
+    EXPORT_IMAGE_ERROR_SYNC_DISK_FAILED = _ErrorDict("sync disk failed", "同步硬盘数据失败")
 
     # 上传镜像
     UPLOAD_IMAGE_ERROR_COMMON = _ErrorDict("upload image failed", "上传镜像失败")
@@ -3,6 +3,7 @@
 
 from core.logger import logger
 from vm_session import VMSession
+from scheduler import MigrateScheduler, MemorySessionQueue
 
 
 class MigrateHandler:
@@ -28,6 +29,49 @@ class MigrateHandler:
         vm_session.migrate()
 
 
+class BatchMigrateHandler:
+    """ 批量迁移Handler类
+    同一模板链接克隆出的虚拟机（src_vm_disk中base_file_path相同）分为一组，
+    开启migration.deal_image_linked_clone后，组内共享基础镜像，只下载、转换一次
+    每组的第一个会话优先调度，由其构建基础镜像，组内其余会话等待构建完成后直接复用
+    """
+
+    action = "batch_migrate"
+
+    def __init__(self, params_list):
+        self.vm_session_info_list = params_list
+
+    @staticmethod
+    def get_group_key(vm_session_info):
+        """链接克隆依赖的基础硬盘，完整克隆的虚拟机返回空元组"""
+        return tuple(sorted(
+            disk["base_file_path"] for disk in vm_session_info.get("src_vm_disk", list()) if disk.get("base_file_path")
+        ))
+
+    def group(self):
+        group_map = dict()
+        for vm_session_info in self.vm_session_info_list:
+            group_map.setdefault(self.get_group_key(vm_session_info), list()).append(vm_session_info)
+        return group_map
+
+    def start(self):
+        """发起批量迁移，直到所有会话结束"""
+        group_map = self.group()
+        logger.info("=====================================")
+        logger.info(
+            f"vm start batch migrate, action: {self.action}, session count: {len(self.vm_session_info_list)}, "
+            f"group: { {key: len(group) for key, group in group_map.items()} }"
+        )
+
+        scheduler = MigrateScheduler(MemorySessionQueue())
+        for key, group in group_map.items():
+            for index, vm_session_info in enumerate(group):
+                if key and index == 0:
+                    vm_session_info["priority"] = vm_session_info.get("priority", 0) + 1
+                scheduler.submit(vm_session_info)
+        scheduler.run_until_empty()
+
+
 if __name__ == "__main__":
     params = {
         # ===== 核心标识 =====
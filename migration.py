@@ -12,33 +12,83 @@
 """
 
 import os
+import json
+import hashlib
 import datetime
+import contextlib
+import itertools
+import posixpath
 import shutil
 import tarfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from core.logger import logger
 from core.config import config
 
-# from clients.nfs_cli import NFSInterface
-from tools.convert_tool import ConvertTool
 from tools.time_tool import TimeTool
 from tools.file_tool import FileTool
+from tools.vmdk_tool import VmdkTool
+from tools.ovf_tool import OvfTool
+from tools.block_tool import BlockTool
+from tools.image_tool import ImageTool, VMDK_SPARSE_MAGIC
+from tools.partition_tool import PartitionTool
+from tools.progress_tool import (
+    ProgressReporter,
+    QemuImgProgressParser,
+    OvfToolProgressParser,
+)
 from clients.cmd_cli import CMDClient
+from clients.vsphere_cli import DatastoreClient, VSphereClient, VSphereFault
+from clients.nfs_cli import NFSInterface
+
+from checkpoint import MigrateCheckpoint
+from chunk_store import ChunkStore
+from base_image import SharedBaseImage
+from delta_reader import DeltaReader, InvalidChangeIdError, get_delta_reader
+from source_reader import NFSSourceReader, NBDExport
+from storage_backend import get_storage_backend
 
 
 from constants.enum import (
     RunningDetailMigrateStatus,
     QemuImgAction,
     MigratePattern,
+    MigrateStep,
+    MigrateProcess,
+    CoverImageMode,
+)
+from constants.template import (
+    DEAL_IMAGE_CONVERT_IMAGE_CMD_TEMPLATE,
+    DEAL_IMAGE_CONVERT_OVERLAY_CMD_TEMPLATE,
+    DEAL_IMAGE_OVA_MEMBER_URI_TEMPLATE,
+    UPLOAD_IMAGE_NBD_SOURCE_URI_TEMPLATE,
+    COVER_IMAGE_MAP_CMD_TEMPLATE,
+    COVER_IMAGE_FULL_COPY_CMD_TEMPLATE,
+    COVER_IMAGE_FLATTEN_CMD_TEMPLATE,
 )
 
 from error import ErrorMsg, ErrorCode
 
 
-def copy_nfs_file(nfs_file_path, local_file_path, timeout=60):
-    """从nfs拷贝文件到本地"""
-    pass
+def copy_nfs_file(nfs_file_path, local_file_path, timeout=60, on_progress=None):
+    """从nfs拷贝文件到本地，多个线程按块并行读取，返回文件大小
+    eg: nfs_file_path为"nfs://192.168.12.98/mnt/worker/centos_6.3_simple/centos_6.3_simple-disk1.vmdk"
+    """
+    address, path = posixpath.split(nfs_file_path)
+    return NFSInterface.download_file(
+        address,
+        path,
+        local_file_path,
+        concurrency=config.migration.upload_image_concurrency,
+        chunk_size=config.migration.upload_image_chunk_size,
+        timeout=timeout,
+        max_retry_times=config.migration.upload_image_max_retry_times,
+        backoff_base_seconds=config.migration.upload_image_retry_backoff_base,
+        backoff_max_seconds=config.migration.upload_image_retry_backoff_max,
+        on_progress=on_progress,
+    )
 
 
 def map_nbd_device_context(img_path):
@@ -52,20 +102,85 @@ def mount_nbd_device_context(mnt_dir, dev_path, option="ro"):
 
 
 class BaseMigration(object):
+    # 断点中保存的迁移器属性和虚拟机会话信息，续迁时恢复
+    checkpoint_attrs = ("ovf_path", "vmdk_path_list", "vmdk_uri_map", "linked_clone_map")
+    checkpoint_info_keys = ("dst_vm_disk", "dst_vm_id", "dst_vm_image")
+
     def __init__(self, vm_session):
         self.vm_session = vm_session
         self.ovf_path = ""
         self.vmdk_path_list = list()
+        # vmdk路径和镜像读取地址的映射，流式转换时vmdk不落盘，直接从读取地址转换
+        self.vmdk_uri_map = dict()
+        # 链接克隆的差异磁盘和共享基础镜像的映射
+        # example:
+        # {
+        #   "/xxxx/v2v_export/session-xxxx/xxxx/xxxx-disk1.vmdk": {
+        #       "base_file_path": "[datastore1] template/template.vmdk",
+        #       "base_qcow2_path": "/xxxx/v2v_base/xxxx/base.qcow2",
+        #   }
+        # }
+        self.linked_clone_map = dict()
+        # 解析后的OVF描述文件，按路径缓存，避免重复解析
+        self._ovf_envelope_map = dict()
+        self.checkpoint = MigrateCheckpoint(vm_session.session_id, config.checkpoint_base_dir_full)
+        # 覆盖镜像的存储后端，由部署决定
+        self.storage_backend = get_storage_backend(config.migration.cover_image_storage_backend, vm_session)
 
     def migrate(self):
-        """开始迁移"""
+        """开始迁移
+        每个步骤完成后记录断点，重新执行时跳过已完成的步骤，从断点处继续
+        迁移成功后删除断点；迁移失败时开启clean_after_failed则删除断点，重新执行时从头迁移，否则保留断点用于续迁
+        Note:被调度强制终止的子进程不经过此处，断点保留，重新排队的会话由领取的节点续迁
+        """
+        self._restore_checkpoint_state()
 
-        self.export_image()  # Note:只有导出镜像模式迁移才有此步骤
-        self.upload_image()  # Note:只有上传镜像模式迁移才有此步骤
-        self.deal_image()
-        self.create_vm()
-        self.cover_image()
-        self.recorrect_and_optimize()
+        try:
+            self._run_step("export_image", self.export_image)  # Note:只有导出镜像模式迁移才有此步骤
+            self._run_step("upload_image", self.upload_image)  # Note:只有上传镜像模式迁移才有此步骤
+            self._run_step("deal_image", self.deal_image)
+            self._run_step("create_vm", self.create_vm)
+            self._run_step("cover_image", self.cover_image)
+            self._run_step("recorrect_and_optimize", self.recorrect_and_optimize)
+        except Exception:
+            if config.setting.clean_after_failed:
+                logger.info(f"vm migrate failed, clear checkpoint, session id: {self.vm_session.session_id}")
+                self.checkpoint.clear()
+            raise
+
+        self.checkpoint.clear()
+
+    def _run_step(self, step, func, *args):
+        """执行步骤，已完成的步骤直接跳过，完成后记录断点"""
+        if self.checkpoint.is_done(step):
+            logger.info(
+                f"skip step, it has been done before, session id: {self.vm_session.session_id}, step: {step}"
+            )
+            return
+
+        func(*args)
+        self.checkpoint.mark_done(step, state=self._dump_checkpoint_state())
+
+    def _dump_checkpoint_state(self):
+        """生成需要保存到断点的状态快照"""
+        return dict(
+            attrs={attr: getattr(self, attr) for attr in self.checkpoint_attrs},
+            info={key: self.vm_session.info[key] for key in self.checkpoint_info_keys if key in self.vm_session.info},
+        )
+
+    def _restore_checkpoint_state(self):
+        """从断点恢复状态快照"""
+        state = self.checkpoint.state
+        if not state:
+            return
+
+        for attr, value in state.get("attrs", dict()).items():
+            if attr in self.checkpoint_attrs:
+                setattr(self, attr, value)
+        self.vm_session.update_to_mem(state.get("info", dict()))
+        logger.info(
+            f"restore checkpoint state, session id: {self.vm_session.session_id}, done steps: {self.checkpoint.done_steps}"
+        )
 
     def export_image(self):
         pass
@@ -85,16 +200,16 @@ class BaseMigration(object):
         # 0.更新详细的迁移状态信息
 
         # 1.解压镜像
-        self._uncompress_image()
+        self._run_step("deal_image.uncompress_image", self._uncompress_image)
 
         # 2.检查镜像
-        self._check_image()
+        self._run_step("deal_image.check_image", self._check_image)
 
         # 3.生成目标虚拟机磁盘信息
-        self._gen_dst_vm_disk_info()
+        self._run_step("deal_image.gen_dst_vm_disk_info", self._gen_dst_vm_disk_info)
 
         # 4.转换镜像格式
-        self._convert_image()
+        self._run_step("deal_image.convert_image", self._convert_image)
 
         # 5.更新详细的迁移状态信息
 
@@ -102,60 +217,65 @@ class BaseMigration(object):
         """创建虚拟机"""
 
         # 1.插入镜像数据
-        self._insert_image()
+        self._run_step("create_vm.insert_image", self._insert_image)
 
         # 2.更新镜像资源计费信息
-        self._update_resource_leasing()
+        self._run_step("create_vm.update_resource_leasing", self._update_resource_leasing)
 
         # 3.拷贝空镜像到存储节点
-        self._copy_image_to_storage()
+        self._run_step("create_vm.copy_image_to_storage", self._copy_image_to_storage)
 
         # 4.创建目标虚拟机
-        self._create_dst_vm()
+        self._run_step("create_vm.create_dst_vm", self._create_dst_vm)
 
         # # 5.关闭目标虚拟机
-        self._stop_dst_vm()
+        self._run_step("create_vm.stop_dst_vm", self._stop_dst_vm)
 
         # 6.更新目标虚拟机镜像的状态为弃用
-        self._update_dst_vm_image_status()
+        self._run_step("create_vm.update_dst_vm_image_status", self._update_dst_vm_image_status)
 
         # 7.从存储节点删除空镜像
-        self._delete_image_from_seed()
+        self._run_step("create_vm.delete_image_from_storage", self._delete_image_from_storage)
 
         # 8.创建目标虚拟机的系统盘
-        self._create_dst_vm_disks()
+        self._run_step("create_vm.create_dst_vm_disks", self._create_dst_vm_disks)
 
         # 9.加载目标虚拟机的系统盘
-        self._attach_dst_vm_disks()
+        self._run_step("create_vm.attach_dst_vm_disks", self._attach_dst_vm_disks)
 
         # 10.更新详细的迁移状态信息
 
     def cover_image(self):
-        """覆盖镜像"""
+        """覆盖镜像
+        按cover_image_storage_backend选择存储后端，每块硬盘使用后端支持的最快写入方式，系统盘优先覆盖
+        """
 
         # 更新详细的迁移状态信息
 
-        # 存储部署模式:Sanc
-        # Sanc 1.启动目标虚拟机
-        self._start_dst_vm()
-
-        # Sanc 2.使用mv, 覆盖系统盘
-        self._cover_image_by_move(self.vm_session.dst_vm_os_disk)
-
-        # Sanc 3.使用dd，覆盖数据盘
-        for disk_info in self.vm_session.dst_vm_data_disk:
-            self._cover_image_by_dd(disk_info)
-
-        # Sanc 4.重启目标虚拟机
-        self._restart_dst_vm()
-
-        # 存储部署模式:普通
-        # 普通 1.使用mv，覆盖所有的硬盘数据（包括系统盘和数据盘）
-        for disk_info in self.vm_session.dst_vm_disk:
-            self._cover_image_by_move(disk_info)
+        # 部分存储（如NeonSAN）需要先启动目标虚拟机，覆盖后重启
+        storage_backend = self.storage_backend
+        if storage_backend.start_dst_vm_before_cover:
+            self._start_dst_vm()
+
+        cover_func_map = {
+            CoverImageMode.MOVE: self._cover_image_by_move,
+            CoverImageMode.DD: self._cover_image_by_dd,
+            CoverImageMode.DIRECT_CONVERT: self._cover_image_by_direct_convert,
+        }
+        for disk_info in sorted(self.vm_session.dst_vm_disk, key=lambda disk_info: not disk_info.get("is_os_disk")):
+            cover_mode = storage_backend.get_cover_mode(disk_info)
+            # 链接克隆的qcow2依赖共享基础镜像，剪切或拷贝前先合并
+            if cover_mode != CoverImageMode.DIRECT_CONVERT and disk_info.get("base_qcow2_path"):
+                self._run_step(f"cover_image.flatten.{disk_info['name']}", self._flatten_image, disk_info)
+            self._run_step(f"cover_image.{cover_mode.value}.{disk_info['name']}", cover_func_map[cover_mode], disk_info)
+
+        if storage_backend.start_dst_vm_before_cover:
+            self._restart_dst_vm()
+        else:
+            self._start_dst_vm()
 
-        # 普通 2.启动目标虚拟机
-        self._start_dst_vm()
+        # 所有硬盘均已覆盖，不再需要共享基础镜像
+        self._release_shared_base_images()
 
         # 更新详细的迁移状态信息
 
@@ -165,10 +285,10 @@ class BaseMigration(object):
         # 0.更新详细的迁移状态信息
 
         # 1.修复目标虚拟机驱动问题
-        self._patch_drive()
+        self._run_step("recorrect_and_optimize.patch_drive", self._patch_drive)
 
         # 2.上传代理到目标虚拟机
-        self._upload_proxy()
+        self._run_step("recorrect_and_optimize.upload_proxy", self._upload_proxy)
 
         # 3.更新详细的迁移状态信息
 
@@ -178,104 +298,25 @@ class BaseMigration(object):
     def _check_image(self):
         pass
 
+    def _get_ovf_envelope(self, ovf_path=None):
+        """获取解析后的OVF描述文件，默认为当前迁移的OVF"""
+        ovf_path = ovf_path or self.ovf_path
+        if ovf_path not in self._ovf_envelope_map:
+            self._ovf_envelope_map[ovf_path] = OvfTool.parse(ovf_path)
+        return self._ovf_envelope_map[ovf_path]
+
     def _gen_dst_vm_disk_info(self):
         """生成目标虚拟机磁盘信息"""
         logger.info(
             f"generate dst vm disk info start, session id: {self.vm_session.session_id}"
         )
 
-        self.json_path = self.ovf_path.replace("ovf", "json")
-        ovf_config = ConvertTool.xml_file_to_json_file(self.ovf_path, self.json_path)
-
-        Envelope = ovf_config["Envelope"]
-
-        # disk_id和disk_label的映射
-        # example
-        # {
-        #   "vmdisk1": "Hard disk 1",
-        #   "vmdisk2": "Hard disk 2"
-        # }
-        VirtualSystem = Envelope["VirtualSystem"]
-        VirtualHardwareSection = VirtualSystem["VirtualHardwareSection"]
-        Item = VirtualHardwareSection["Item"]
-        disk_id_disk_label_mapper = dict()
-        for item in Item:
-            if "rasd:HostResource" in item.keys():
-                HostResource = item["rasd:HostResource"]  # eg: "ovf:/disk/vmdisk1"
-                resource = HostResource.split("/")[-1]  # eg: "vmdisk1"
-                ElementName = item["rasd:ElementName"]  # eg: "Hard disk 1"
-                disk_id_disk_label_mapper[resource] = ElementName
-        logger.info(
-            f"disk id and disk label mapper: {disk_id_disk_label_mapper}, "
-            f"session id: {self.vm_session.session_id}, src vm id: {self.vm_session.src_vm_id}"
-        )
-
-        # file_ref和disk_attr的映射
-        # example:
-        # {
-        #     "file1": {
-        #         "ovf_disk_id": "vmdisk1",
-        #         "ovf_capacity": 100,
-        #         "ovf_unit": "byte * 2^30",
-        #     },
-        #     "file2": {
-        #         "ovf_disk_id": "vmdisk2",
-        #         "ovf_capacity": 100,
-        #         "ovf_unit": "byte * 2^30",
-        #     }
-        # }
-        DiskSection = Envelope["DiskSection"]
-        DiskSectionInfo = DiskSection["Disk"]
-        file_ref_disk_attr_map = dict()
-        # 若源虚拟机有单个硬盘
-        if isinstance(DiskSectionInfo, dict):
-            ovf_file_ref = DiskSectionInfo["@ovf:fileRef"]  # eg: "file1"
-            ovf_disk_id = DiskSectionInfo["@ovf:diskId"]  # eg: "vmdisk1"
-            ovf_capacity = DiskSectionInfo["@ovf:capacity"]  # eg: 100
-            ovf_unit = DiskSectionInfo["@ovf:capacityAllocationUnits"]  # byte * 2^30
-            file_ref_disk_attr_map[ovf_file_ref] = dict(
-                ovf_disk_id=ovf_disk_id, ovf_capacity=ovf_capacity, ovf_unit=ovf_unit
-            )
-        # 若源虚拟机有多个硬盘
-        elif isinstance(DiskSectionInfo, list):
-            for section in DiskSectionInfo:
-                ovf_file_ref = section["@ovf:fileRef"]  # eg: "file1"
-                ovf_disk_id = section["@ovf:diskId"]  # eg: "vmdisk1"
-                ovf_capacity = section["@ovf:capacity"]  # eg: 100
-                ovf_unit = section["@ovf:capacityAllocationUnits"]  # byte * 2^30
-                file_ref_disk_attr_map[ovf_file_ref] = dict(
-                    ovf_disk_id=ovf_disk_id,
-                    ovf_capacity=ovf_capacity,
-                    ovf_unit=ovf_unit,
-                )
-        logger.info(
-            f"file ref and disk attr mapper: {file_ref_disk_attr_map}, session id: {self.vm_session.session_id}, "
-            f"src vm id: {self.vm_session.src_vm_id}"
-        )
-
-        # ovf_href和ovf_id的映射
-        # example
-        # {
-        #   "xxxx-disk1.vmdk": "file1",
-        #   "xxxx-disk2.vmdk": "file2"
-        # }
-        ovf_href_ovf_id_mapper = dict()
-        References = Envelope["References"]
-        File = References["File"]
-        # 若源虚拟机有单个硬盘
-        if isinstance(File, dict):
-            ovf_id = File["@ovf:id"]  # eg: "file1"
-            ovf_href = File["@ovf:href"]  # eg: "xxxx-disk1.vmdk""
-            ovf_href_ovf_id_mapper[ovf_href] = ovf_id
-        # 若源虚拟机有多个硬盘
-        elif isinstance(File, list):
-            for file_data in File:
-                ovf_id = file_data["@ovf:id"]  # eg: "file1"
-                ovf_href = file_data["@ovf:href"]  # eg: "xxxx-disk1.vmdk""
-                ovf_href_ovf_id_mapper[ovf_href] = ovf_id
-        logger.info(
-            f"ovf href and ovf id mapper: {ovf_href_ovf_id_mapper}, "
-            f"session id: {self.vm_session.session_id}, src vm id: {self.vm_session.src_vm_id}"
+        ovf_envelope = self._get_ovf_envelope()
+        virtual_system = ovf_envelope.virtual_system
+        logger.info(
+            f"ovf disk info, session id: {self.vm_session.session_id}, src vm id: {self.vm_session.src_vm_id}, "
+            f"ovf files: {[ovf_file.href for ovf_file in ovf_envelope.files]}, ovf disks: {ovf_envelope.disks}, "
+            f"ovf disk items: { {disk_id: item.element_name for disk_id, item in virtual_system.disk_item_map.items()} }"
         )
 
         # vmdk文件名称和vmdk文件路径的映射
@@ -288,49 +329,34 @@ class BaseMigration(object):
         try:
             for vmdk_path in self.vmdk_path_list:
                 disk_info = dict()
-                decode_vmdk_name = os.path.basename(vmdk_path).decode("utf8")
-                decode_vmdk_path = vmdk_path.decode("utf8")
-                ovf_id = ovf_href_ovf_id_mapper[decode_vmdk_name]
-                ovf_disk_id = file_ref_disk_attr_map[ovf_id]["ovf_disk_id"]
-                ovf_capacity = file_ref_disk_attr_map[ovf_id]["ovf_capacity"]
-                ovf_unit = file_ref_disk_attr_map[ovf_id]["ovf_unit"]
-                disk_label = disk_id_disk_label_mapper[ovf_disk_id]
+                decode_vmdk_name = os.path.basename(vmdk_path)
+                decode_vmdk_path = vmdk_path
+                ovf_id = ovf_envelope.file_href_map[decode_vmdk_name].id
+                ovf_disk = ovf_envelope.disk_file_ref_map[ovf_id]
+                ovf_disk_id = ovf_disk.disk_id
+                disk_label = virtual_system.disk_item_map[ovf_disk_id].element_name
 
                 disk_info["vmdk_name"] = decode_vmdk_name  # xxxx-disk1.vmdk
                 disk_info["vmdk_path"] = (
                     decode_vmdk_path  # /xxxx/v2v_export/session-xxxx/xxxx/xxxx-disk1.vmdk
                 )
-                disk_info["vmdk_size"] = FileTool.get_file_size(
-                    decode_vmdk_path
-                )  # 单位MB
+                if vmdk_path in self.vmdk_uri_map:
+                    disk_info["vmdk_uri"] = self.vmdk_uri_map[vmdk_path]["uri"]
+                    disk_info["vmdk_size"] = self.vmdk_uri_map[vmdk_path]["size"]
+                else:
+                    disk_info["vmdk_size"] = FileTool.get_file_size(
+                        decode_vmdk_path
+                    )  # 单位B
+                if vmdk_path in self.linked_clone_map:
+                    disk_info.update(self.linked_clone_map[vmdk_path])
                 disk_info["ovf_id"] = ovf_id  # file1
                 disk_info["ovf_disk_id"] = ovf_disk_id  # vmdisk1
                 disk_info["name"] = disk_label  # Hard disk 1
-                disk_info["name"] = disk_label  # Hard disk 1
 
-                # 容量单位转换
-                if ovf_unit == "byte * 2^30":
-                    # 默认为GB
-                    src_size = int(round(float(ovf_capacity)))
-                elif ovf_unit == "byte * 2^20":
-                    # MB转换为GB
-                    src_size = int(round(float(ovf_capacity))) / 1024
-                elif ovf_unit == "byte * 2^10":
-                    # KB转换为GB
-                    src_size = int(round(float(ovf_capacity))) / 1024 / 1024
-                elif ovf_unit == "byte":
-                    # B转换为GB
-                    src_size = int(round(float(ovf_capacity))) / 1024 / 1024 / 1024
-                else:
-                    # 默认为GB
-                    src_size = int(round(float(ovf_capacity)))
-
-                # 容量为10的倍数处理
-                src_size_suffix = int(str(src_size)[-1])
-                if src_size_suffix == 0:
-                    disk_info["size"] = src_size  # 100GB
-                else:
-                    disk_info["size"] = int(src_size) + (10 - src_size_suffix)  # 100GB
+                # 源硬盘的精确容量，单位B
+                disk_info["capacity"] = ovf_disk.capacity_bytes
+                # 目标卷的容量，单位GB，按deal_image_disk_size_align_gb向上对齐
+                disk_info["size"] = self._get_dst_disk_size(disk_info["capacity"])
 
                 dst_vm_disk.append(disk_info)
         except Exception as e:
@@ -351,65 +377,216 @@ class BaseMigration(object):
             f"generate dst vm disk info end, session id: {self.vm_session.session_id}, dst vm disk: {dst_vm_disk}"
         )
 
+    @staticmethod
+    def _get_dst_disk_size(capacity):
+        """计算目标卷的容量，单位GB
+        按deal_image_disk_size_align_gb向上对齐，eg: 对齐值为10时 35GB -> 40GB，对齐值为1时 35.5GB -> 36GB
+        """
+        align_size = max(1, config.migration.deal_image_disk_size_align_gb) * 1024 ** 3
+        align_count = max(1, -(-capacity // align_size))
+        return align_count * align_size // 1024 ** 3
+
     def _convert_image(self):
-        """转换镜像"""
+        """转换镜像
+        各硬盘之间相互独立，使用有界的线程池并行转换，并发数由deal_image_convert_concurrency控制
+        """
         logger.info(
             f"convert image start, session id: {self.vm_session.session_id}, dst vm disk: {self.vm_session.dst_vm_disk}"
         )
 
-        dst_vm_disk = self.vm_session.dst_vm_disk
-        for disk_info in dst_vm_disk:
-            vmdk_path = disk_info["vmdk_path"]
-            disk_info["qcow2_path"] = qcow2_path = vmdk_path.replace("vmdk", "qcow2")
-
-            # 执行转换镜像命令
-            convert_cmd = f"{config.migration.qemu_img_tool_path} {QemuImgAction.CONVERT.value} -p -f {config.migration.deal_image_src_format_vmdk} -O {config.migration.deal_image_dst_format_qcow2} {vmdk_path} {qcow2_path}"
-            logger.info(
-                f"convert image ready, session id: {self.vm_session.session_id}, disk name: {disk_info['name']}, convert cmd: {convert_cmd}"
-            )
-            returncode, _, stderr = CMDClient.bash_exec(
-                convert_cmd, config.migration.convert_image_timeout
-            )
-            if returncode != 0:
+        # 续迁时跳过已转换完成的硬盘
+        dst_vm_disk = [
+            disk_info for disk_info in self.vm_session.dst_vm_disk if not self._restore_converted_disk(disk_info)
+        ]
+        if not dst_vm_disk:
+            return
+
+        # 转换前在源镜像上识别系统盘，系统盘优先转换
+        if config.migration.deal_image_identify_os_disk_by_partition:
+            self._identify_os_disk_by_partition(dst_vm_disk)
+            dst_vm_disk.sort(key=lambda disk_info: not disk_info.get("is_os_disk"))
+
+        concurrency = max(1, min(config.migration.deal_image_convert_concurrency, len(dst_vm_disk)))
+        failed_disk_reason = dict()
+        # 转换线程可能已上报更具体的错误码（例如识别系统盘失败），此时不再以通用错误码覆盖
+        origin_err_code = self.vm_session.info.get("err_code")
+
+        # 各硬盘的转换进度按vmdk大小加权汇总
+        weights = {disk_info["name"]: disk_info.get("vmdk_size") or 1 for disk_info in dst_vm_disk}
+        progress_reporter = ProgressReporter(
+            self.vm_session,
+            MigrateStep.DEAL_IMAGE.value,
+            MigrateProcess.START_CONVERT_IMAGE_PROCESS.value,
+            MigrateProcess.END_CONVERT_IMAGE_PROCESS.value,
+            total_bytes=sum(disk_info.get("vmdk_size") or 0 for disk_info in dst_vm_disk),
+            weights=weights,
+            interval=config.migration.progress_report_interval,
+        )
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            future_map = dict()
+            for disk_info in dst_vm_disk:
+                future = executor.submit(self._convert_single_image, disk_info, progress_reporter)
+                future_map[future] = disk_info
+
+            for future in as_completed(future_map):
+                disk_info = future_map[future]
+                try:
+                    future.result()
+                    self.checkpoint.mark_done(self._get_convert_step(disk_info), result=dict(disk_info))
+                except Exception as e:
+                    failed_disk_reason[disk_info["name"]] = str(e)
+
+                    # 已经失败，则取消尚未开始的转换，避免浪费时间
+                    for pending_future in future_map:
+                        pending_future.cancel()
+
+        if failed_disk_reason:
+            if self.vm_session.info.get("err_code") == origin_err_code:
                 self.vm_session.update_detail_migrate_status(
                     dict(
                         err_code=ErrorCode.CONVERT_IMAGE_ERROR_COMMON.value,
                         err_msg=ErrorMsg.CONVERT_IMAGE_ERROR_COMMON.value.zh,
                     )
                 )
-                log_msg = f"convert image failed, session id: {self.vm_session.session_id}, disk name: {disk_info['name']}, convert cmd: {convert_cmd}, error reason: {stderr}"
-                logger.error(log_msg)
-                raise Exception(log_msg)
-
-            # 删掉原始的vmdk文件，节省空间
-            disk_info["qcow2_size"] = FileTool.get_file_size(qcow2_path)
-            os.remove(vmdk_path)
-
-            # 统计信息
-
-            # 识别系统盘并赋值
-            is_os_disk = disk_info.get(
-                "is_os_disk", None
-            ) or self.identify_src_vm_os_disk(qcow2_path)
-            disk_info["is_os_disk"] = is_os_disk
-            if is_os_disk:
-                disk_info["volume_type"] = self.vm_session.info["dst_vm_os_disk"]["type"]
-            else:
-                if (
-                    "dst_vm_data_disk" in self.vm_session.info
-                    and isinstance(self.vm_session.info["dst_vm_data_disk"], dict)
-                    and "type" in self.vm_session.info["dst_vm_data_disk"]
-                ):
-                    data_disk_type = self.vm_session.info["dst_vm_data_disk"]["type"]
-                    disk_info["volume_type"] = data_disk_type
-
-            # 更新虚拟机的配置
+            log_msg = f"convert image failed, session id: {self.vm_session.session_id}, failed disk count: {len(failed_disk_reason)}, error reason: {failed_disk_reason}"
+            logger.error(log_msg)
+            raise Exception(log_msg)
 
         # 若源虚拟机没有安装系统，则直接报错，迁移终止
 
         # 若源虚拟机识别错误识别出来多个系统盘，则直接报错，迁移终止
 
         # 更新虚拟机的配置
+        logger.info(
+            f"convert image end, session id: {self.vm_session.session_id}, concurrency: {concurrency}, dst vm disk: {dst_vm_disk}"
+        )
+
+    @staticmethod
+    def _get_convert_step(disk_info):
+        return f"deal_image.convert_image.{disk_info['name']}"
+
+    def _restore_converted_disk(self, disk_info):
+        """从断点恢复已转换完成的硬盘信息，qcow2文件缺失或大小不符时需要重新转换"""
+        result = self.checkpoint.get_result(self._get_convert_step(disk_info))
+        if not result:
+            return False
+
+        # 直接转换的数据盘在覆盖镜像时才转换，此处没有qcow2文件
+        if result.get("direct_convert"):
+            disk_info.update(result)
+            return True
+
+        qcow2_path = result.get("qcow2_path", "")
+        base_qcow2_path = result.get("base_qcow2_path")
+        if (
+            not os.path.isfile(qcow2_path)
+            or FileTool.get_file_size(qcow2_path) != result.get("qcow2_size")
+            or (base_qcow2_path and not os.path.isfile(base_qcow2_path))
+        ):
+            logger.warning(
+                f"converted image is missing or changed, convert again, session id: {self.vm_session.session_id}, disk name: {disk_info['name']}, qcow2 path: {qcow2_path}"
+            )
+            return False
+
+        disk_info.update(result)
+        logger.info(
+            f"skip convert image, it has been done before, session id: {self.vm_session.session_id}, disk name: {disk_info['name']}, qcow2 path: {qcow2_path}"
+        )
+        return True
+
+    def _convert_single_image(self, disk_info, progress_reporter=None):
+        """转换单个硬盘的镜像，并识别是否为系统盘
+        qemu-img的-p进度输出实时交给progress_reporter解析上报
+        开启deal_image_direct_convert_data_disk且存储后端支持时，先在vmdk上识别系统盘，数据盘不在此处转换，
+        而是在覆盖镜像时从vmdk直接转换到目标卷，省去一次全量读写和qcow2的暂存空间
+        """
+        vmdk_path = disk_info["vmdk_path"]
+        if (
+            config.migration.deal_image_direct_convert_data_disk
+            and self.storage_backend.supports(CoverImageMode.DIRECT_CONVERT)
+        ):
+            is_os_disk = disk_info.get("is_os_disk", None)
+            if is_os_disk is None:
+                is_os_disk = self.identify_src_vm_os_disk(disk_info.get("vmdk_uri") or vmdk_path)
+            if not is_os_disk:
+                disk_info["direct_convert"] = True
+                self._set_disk_volume_type(disk_info, False)
+                if progress_reporter:
+                    progress_reporter.update(100, disk_info["name"])
+                logger.info(
+                    f"data disk will be converted to volume directly, session id: {self.vm_session.session_id}, disk name: {disk_info['name']}"
+                )
+                return
+
+        disk_info["qcow2_path"] = qcow2_path = vmdk_path.replace("vmdk", "qcow2")
+
+        # 执行转换镜像命令，流式转换时直接从OVA中读取vmdk
+        # 链接克隆的差异磁盘转换为以共享基础镜像为backing file的qcow2
+        if disk_info.get("base_qcow2_path"):
+            convert_cmd = DEAL_IMAGE_CONVERT_OVERLAY_CMD_TEMPLATE.format(
+                qemu_img_path=config.hyper.qemu_img_tool_path,
+                src_image_format=config.migration.deal_image_src_format_vmdk,
+                dst_image_format=config.migration.deal_image_dst_format_qcow2,
+                base_image_path=disk_info["base_qcow2_path"],
+                base_image_format=config.migration.deal_image_dst_format_qcow2,
+                src_image_path=vmdk_path,
+                dst_image_path=qcow2_path,
+            )
+        else:
+            convert_cmd = DEAL_IMAGE_CONVERT_IMAGE_CMD_TEMPLATE.format(
+                qemu_img_path=config.hyper.qemu_img_tool_path,
+                qemu_img_action=QemuImgAction.CONVERT.value,
+                src_image_format=config.migration.deal_image_src_format_vmdk,
+                dst_image_format=config.migration.deal_image_dst_format_qcow2,
+                src_image_path=disk_info.get("vmdk_uri") or vmdk_path,
+                dst_image_path=qcow2_path,
+            )
+        logger.info(
+            f"convert image ready, session id: {self.vm_session.session_id}, disk name: {disk_info['name']}, convert cmd: {convert_cmd}"
+        )
+        start_time = datetime.datetime.now()
+        on_output = None
+        if progress_reporter:
+            on_output = progress_reporter.make_output_callback(QemuImgProgressParser(), disk_info["name"])
+        returncode, _, stderr = CMDClient.bash_exec(
+            convert_cmd, config.migration.deal_image_convert_image_timeout, on_output=on_output
+        )
+        if returncode != 0:
+            log_msg = f"convert image failed, session id: {self.vm_session.session_id}, disk name: {disk_info['name']}, convert cmd: {convert_cmd}, error reason: {stderr}"
+            logger.error(log_msg)
+            raise Exception(log_msg)
+
+        # 删掉原始的vmdk文件，节省空间
+        disk_info["qcow2_size"] = FileTool.get_file_size(qcow2_path)
+        if not disk_info.get("vmdk_uri"):
+            os.remove(vmdk_path)
+
+        # 统计信息
+        total_seconds = (datetime.datetime.now() - start_time).total_seconds()
+        logger.info(
+            f"convert single image end, session id: {self.vm_session.session_id}, disk name: {disk_info['name']}, "
+            f"cost time: {datetime.timedelta(seconds=total_seconds)}, qcow2 size: {disk_info['qcow2_size']}B"
+        )
+
+        # 识别系统盘并赋值
+        is_os_disk = disk_info.get("is_os_disk", None)
+        if is_os_disk is None:
+            is_os_disk = self.identify_src_vm_os_disk(qcow2_path)
+        self._set_disk_volume_type(disk_info, is_os_disk)
+
+    def _set_disk_volume_type(self, disk_info, is_os_disk):
+        """依据是否为系统盘设置硬盘对应的目标卷类型"""
+        disk_info["is_os_disk"] = is_os_disk
+        if is_os_disk:
+            disk_info["volume_type"] = self.vm_session.info["dst_vm_os_disk"]["type"]
+        else:
+            if (
+                "dst_vm_data_disk" in self.vm_session.info
+                and isinstance(self.vm_session.info["dst_vm_data_disk"], dict)
+                and "type" in self.vm_session.info["dst_vm_data_disk"]
+            ):
+                data_disk_type = self.vm_session.info["dst_vm_data_disk"]["type"]
+                disk_info["volume_type"] = data_disk_type
 
     def _insert_image(self):
         """插入镜像数据"""
@@ -451,11 +628,269 @@ class BaseMigration(object):
         Note:只有数据盘需要加载
         """
 
+    def _flatten_image(self, disk_info):
+        """合并qcow2的backing file中的数据，使其可以脱离共享基础镜像单独使用"""
+        flatten_cmd = COVER_IMAGE_FLATTEN_CMD_TEMPLATE.format(
+            qemu_img_path=config.hyper.qemu_img_tool_path,
+            image_format=config.migration.deal_image_dst_format_qcow2,
+            image_path=disk_info["qcow2_path"],
+        )
+        returncode, _, stderr = CMDClient.bash_exec(flatten_cmd, config.migration.cover_image_timeout)
+        if returncode != 0:
+            self.vm_session.update_detail_migrate_status(
+                dict(
+                    err_code=ErrorCode.COVER_IMAGE_ERROR_COMMON.value,
+                    err_msg=ErrorMsg.COVER_IMAGE_ERROR_COMMON.value.zh,
+                )
+            )
+
+            log_msg = f"flatten image failed, session id: {self.vm_session.session_id}, disk name: {disk_info['name']}, flatten cmd: {flatten_cmd}, error reason: {stderr}"
+            logger.error(log_msg)
+            raise Exception(log_msg)
+
+        logger.info(
+            f"flatten image end, session id: {self.vm_session.session_id}, disk name: {disk_info['name']}, qcow2 path: {disk_info['qcow2_path']}"
+        )
+
+    def _get_shared_base_image(self, base_file_path):
+        return SharedBaseImage(
+            base_file_path,
+            config.deal_image_linked_clone_base_dir_full,
+            config.deal_image_file_lock_base_dir_full,
+        )
+
+    def _release_shared_base_images(self):
+        """取消对共享基础镜像的引用"""
+        base_file_path_set = {
+            disk_info["base_file_path"] for disk_info in self.vm_session.dst_vm_disk if disk_info.get("base_file_path")
+        }
+        for base_file_path in base_file_path_set:
+            self._get_shared_base_image(base_file_path).release(
+                self.vm_session.session_id, keep=config.migration.deal_image_linked_clone_keep_base
+            )
+
     def _cover_image_by_move(self, disk_info):
-        """通过剪切的方式覆盖镜像"""
+        """通过剪切的方式覆盖镜像，qcow2文件直接作为目标卷"""
+        logger.info(
+            f"cover image by move start, session id: {self.vm_session.session_id}, disk name: {disk_info['name']}, "
+            f"qcow2 path: {disk_info['qcow2_path']}, storage backend: {self.storage_backend.name}"
+        )
+        start_time = datetime.datetime.now()
+        try:
+            move_method = self.storage_backend.move_image(disk_info["qcow2_path"], disk_info)
+        except Exception as e:
+            self.vm_session.update_detail_migrate_status(
+                dict(
+                    err_code=ErrorCode.COVER_IMAGE_ERROR_COMMON.value,
+                    err_msg=ErrorMsg.COVER_IMAGE_ERROR_COMMON.value.zh,
+                )
+            )
+
+            log_msg = f"cover image by move failed, session id: {self.vm_session.session_id}, disk name: {disk_info['name']}, error reason: {e}"
+            logger.error(log_msg)
+            raise Exception(log_msg)
+
+        total_seconds = (datetime.datetime.now() - start_time).total_seconds()
+        logger.info(
+            f"cover image by move end, session id: {self.vm_session.session_id}, disk name: {disk_info['name']}, "
+            f"move method: {move_method}, cost time: {datetime.timedelta(seconds=total_seconds)}"
+        )
 
     def _cover_image_by_dd(self, disk_info):
-        """通过dd的方式覆盖镜像"""
+        """通过dd的方式覆盖镜像
+        只把qcow2中已分配的数据写入目标卷，空洞按cover_image_hole_mode处理，无法获取数据分配信息时退化为全量拷贝
+        """
+        logger.info(
+            f"cover image by dd start, session id: {self.vm_session.session_id}, disk name: {disk_info['name']}, "
+            f"qcow2 path: {disk_info['qcow2_path']}, volume id: {disk_info['volume_id']}, storage backend: {self.storage_backend.name}"
+        )
+        start_time = datetime.datetime.now()
+        try:
+            with self.storage_backend.volume_context(disk_info) as dev_path:
+                stats = self._copy_image_to_device(disk_info["qcow2_path"], dev_path)
+        except Exception as e:
+            self.vm_session.update_detail_migrate_status(
+                dict(
+                    err_code=ErrorCode.COVER_IMAGE_ERROR_COMMON.value,
+                    err_msg=ErrorMsg.COVER_IMAGE_ERROR_COMMON.value.zh,
+                )
+            )
+
+            log_msg = f"cover image by dd failed, session id: {self.vm_session.session_id}, disk name: {disk_info['name']}, error reason: {e}"
+            logger.error(log_msg)
+            raise Exception(log_msg)
+
+        total_seconds = (datetime.datetime.now() - start_time).total_seconds()
+        logger.info(
+            f"cover image by dd end, session id: {self.vm_session.session_id}, disk name: {disk_info['name']}, "
+            f"cost time: {datetime.timedelta(seconds=total_seconds)}, stats: {stats}"
+        )
+
+    def _cover_image_by_direct_convert(self, disk_info):
+        """从vmdk直接转换到目标卷，流式转换时直接从OVA中读取vmdk"""
+        src_image_path = disk_info.get("vmdk_uri") or disk_info["vmdk_path"]
+        logger.info(
+            f"cover image by direct convert start, session id: {self.vm_session.session_id}, disk name: {disk_info['name']}, "
+            f"src image path: {src_image_path}, volume id: {disk_info['volume_id']}"
+        )
+        start_time = datetime.datetime.now()
+        progress_reporter = ProgressReporter(
+            self.vm_session,
+            MigrateStep.COVER_IMAGE.value,
+            MigrateProcess.START_COVER_IMAGE_PROCESS.value,
+            MigrateProcess.END_COVER_IMAGE_PROCESS.value,
+            total_bytes=disk_info.get("vmdk_size"),
+            interval=config.migration.progress_report_interval,
+        )
+        try:
+            with self.storage_backend.volume_context(disk_info) as dev_path:
+                convert_cmd = COVER_IMAGE_FULL_COPY_CMD_TEMPLATE.format(
+                    qemu_img_path=config.hyper.qemu_img_tool_path,
+                    image_format=config.migration.deal_image_src_format_vmdk,
+                    image_path=src_image_path,
+                    dev_path=dev_path,
+                )
+                returncode, _, stderr = CMDClient.bash_exec(
+                    convert_cmd,
+                    config.migration.cover_image_timeout,
+                    on_output=progress_reporter.make_output_callback(QemuImgProgressParser()),
+                )
+                if returncode != 0:
+                    raise Exception(f"convert cmd: {convert_cmd}, error reason: {stderr}")
+        except Exception as e:
+            self.vm_session.update_detail_migrate_status(
+                dict(
+                    err_code=ErrorCode.COVER_IMAGE_ERROR_COMMON.value,
+                    err_msg=ErrorMsg.COVER_IMAGE_ERROR_COMMON.value.zh,
+                )
+            )
+
+            log_msg = f"cover image by direct convert failed, session id: {self.vm_session.session_id}, disk name: {disk_info['name']}, error reason: {e}"
+            logger.error(log_msg)
+            raise Exception(log_msg)
+
+        # 删掉原始的vmdk文件，节省空间
+        if not disk_info.get("vmdk_uri") and os.path.isfile(disk_info["vmdk_path"]):
+            os.remove(disk_info["vmdk_path"])
+
+        total_seconds = (datetime.datetime.now() - start_time).total_seconds()
+        logger.info(
+            f"cover image by direct convert end, session id: {self.vm_session.session_id}, disk name: {disk_info['name']}, "
+            f"cost time: {datetime.timedelta(seconds=total_seconds)}"
+        )
+
+    def _copy_image_to_device(self, image_path, dev_path):
+        """拷贝镜像数据到块设备，返回拷贝的统计信息"""
+        image_format = config.migration.deal_image_dst_format_qcow2
+        extents = None
+        if config.migration.cover_image_sparse_copy:
+            image_map = self._get_image_map(image_path, image_format)
+            extents = BlockTool.parse_image_map(image_map) if image_map is not None else None
+
+        if extents is None:
+            copy_cmd = COVER_IMAGE_FULL_COPY_CMD_TEMPLATE.format(
+                qemu_img_path=config.hyper.qemu_img_tool_path,
+                image_format=image_format,
+                image_path=image_path,
+                dev_path=dev_path,
+            )
+            returncode, _, stderr = CMDClient.bash_exec(copy_cmd, config.migration.cover_image_timeout)
+            if returncode != 0:
+                raise Exception(f"copy image to device failed, copy cmd: {copy_cmd}, error reason: {stderr}")
+            return dict(mode="full")
+
+        data_extents, hole_extents = extents
+        stats = BlockTool.copy_extents(
+            image_path,
+            dev_path,
+            data_extents,
+            hole_extents,
+            hole_mode=config.migration.cover_image_hole_mode,
+            buffer_size=config.migration.cover_image_copy_buffer_size,
+        )
+        stats["mode"] = "sparse"
+        return stats
+
+    def _get_image_map(self, image_path, image_format):
+        """获取镜像的数据分配信息，获取失败时返回None"""
+        map_cmd = COVER_IMAGE_MAP_CMD_TEMPLATE.format(
+            qemu_img_path=config.hyper.qemu_img_tool_path,
+            image_format=image_format,
+            image_path=image_path,
+        )
+        try:
+            returncode, stdout, stderr = CMDClient.normal_exec(map_cmd, config.migration.cover_image_timeout)
+            if returncode == 0:
+                return json.loads(stdout)
+        except Exception as e:
+            stderr = e
+
+        logger.warning(
+            f"get image map failed, copy all data instead, session id: {self.vm_session.session_id}, map cmd: {map_cmd}, error reason: {stderr}"
+        )
+        return None
+
+    def _identify_os_disk_by_partition(self, dst_vm_disk):
+        """读取源镜像的分区表和文件系统超级块识别系统盘，无需映射nbd设备和挂载分区
+        各硬盘并行识别，能确定系统盘时为所有待转换的硬盘设置is_os_disk，无法确定时保持不变，
+        转换后再通过nbd挂载识别
+        Note:续迁时已转换完成的硬盘从断点恢复了is_os_disk，其vmdk可能已删除，只识别待转换的硬盘
+        """
+        if self.vm_session.dst_vm_disk_num == 1:
+            return
+
+        # 续迁时系统盘已识别，其余硬盘均为数据盘
+        if any(disk_info.get("is_os_disk") for disk_info in self.vm_session.dst_vm_disk):
+            for disk_info in dst_vm_disk:
+                disk_info.setdefault("is_os_disk", False)
+            return
+
+        # 已转换完成的硬盘均为数据盘，只剩一个待转换的硬盘时即为系统盘
+        restored_disk_list = [disk_info for disk_info in self.vm_session.dst_vm_disk if disk_info not in dst_vm_disk]
+        if len(dst_vm_disk) == 1 and all(disk_info.get("is_os_disk") is False for disk_info in restored_disk_list):
+            dst_vm_disk[0]["is_os_disk"] = True
+            logger.info(
+                f"identify os disk by restored data disks, session id: {self.vm_session.session_id}, os disk name: {dst_vm_disk[0]['name']}"
+            )
+            return
+
+        start_time = datetime.datetime.now()
+        inspect_result_map = dict()
+        with ThreadPoolExecutor(max_workers=len(dst_vm_disk)) as executor:
+            future_map = {executor.submit(self._inspect_src_disk, disk_info): disk_info for disk_info in dst_vm_disk}
+            for future in as_completed(future_map):
+                disk_info = future_map[future]
+                try:
+                    inspect_result_map[disk_info["name"]] = future.result()
+                except Exception as e:
+                    logger.warning(
+                        f"inspect disk partition failed, session id: {self.vm_session.session_id}, disk name: {disk_info['name']}, error reason: {e}"
+                    )
+
+        os_disk_name = None
+        if len(inspect_result_map) == len(dst_vm_disk):
+            os_disk_name = PartitionTool.rank_os_disk(inspect_result_map)
+        total_seconds = (datetime.datetime.now() - start_time).total_seconds()
+        logger.info(
+            f"identify os disk by partition end, session id: {self.vm_session.session_id}, os disk name: {os_disk_name}, "
+            f"cost time: {datetime.timedelta(seconds=total_seconds)}, "
+            f"inspect result: { {name: (result['score'], result['reasons']) for name, result in inspect_result_map.items()} }"
+        )
+        if os_disk_name is None:
+            return
+
+        for disk_info in dst_vm_disk:
+            disk_info["is_os_disk"] = disk_info["name"] == os_disk_name
+
+    def _inspect_src_disk(self, disk_info):
+        """检查源镜像的分区，流式转换时直接读取OVA中的vmdk"""
+        member_info = self.vmdk_uri_map.get(disk_info["vmdk_path"])
+        if member_info:
+            reader = ImageTool.open_image(member_info["file_path"], member_info["offset"], member_info["size"])
+        else:
+            reader = ImageTool.open_image(disk_info["vmdk_path"])
+        with reader:
+            return PartitionTool.inspect_disk(reader)
 
     def identify_src_vm_os_disk(self, qcow2_path):
         is_os_disk = self._identify_src_vm_os_disk(qcow2_path)
@@ -569,51 +1004,108 @@ class ExportImageMigration(BaseMigration):
     """导出镜像模式对应的迁移器"""
 
     migrate_pattern = MigratePattern.EXPORT_IMAGE.value
+    checkpoint_attrs = BaseMigration.checkpoint_attrs + ("ova_path", "mf_path", "mf_data")
 
     def __init__(self, vm_session):
         super(ExportImageMigration, self).__init__(vm_session)
         self.ova_path = ""
+        self.mf_path = ""
+        self.mf_data = dict()
 
     def export_image(self):
-        """导出镜像"""
+        """导出镜像
+        1.默认使用ovftool导出整个OVA
+        2.开启export_image_per_disk时，ovftool只导出OVF描述文件，各硬盘再从数据存储并行下载，
+          下载失败时只续传出错的硬盘，已下载的部分无需重新下载
+        """
         logger.info(
             f"export image start, session id: {self.vm_session.session_id}, src vm name: {self.vm_session.src_vm_name}"
         )
         # 更新详细的迁移状态信息
-        start_status = RunningDetailMigrateStatus.START_EXPORT_IMAGE_DETAIL_STATUS.value
+        start_status = RunningDetailMigrateStatus.START_EXPORT_IMAGE_DETAIL_STATUS.copy()
         start_status["step"]["start_time"] = TimeTool.get_now_datetime_str()
         self.vm_session.update_detail_migrate_status(start_status)
+        start_time = datetime.datetime.now()
 
-        """
+        per_disk = config.migration.export_image_per_disk
+        export_size = self._export()
+
+        # 更新详细的迁移状态信息
+        end_status = RunningDetailMigrateStatus.END_EXPORT_IMAGE_DETAIL_STATUS.copy()
+        end_status["step"]["end_time"] = TimeTool.get_now_datetime_str()
+        self.vm_session.update_detail_migrate_status(end_status)
+
+        # 统计数据
+        end_time = datetime.datetime.now()
+        total_seconds = (end_time - start_time).total_seconds()
+        time_strftime = str(datetime.timedelta(seconds=total_seconds))
+        export_size_mb = export_size / 1024 / 1024
+        export_speed = export_size_mb / total_seconds  # 单位：MB/s
+        logger.info(
+            f"export image end, session id: {self.vm_session.session_id}, cost time: {time_strftime}, per disk: {per_disk}, "
+            f"export size: {export_size_mb}MB, export speed: {export_speed}MB/s, ova path: {self.ova_path}, ovf path: {self.ovf_path}"
+        )
+
+    def _export(self):
+        """导出OVF描述文件和硬盘数据，返回导出的总大小"""
+        if config.migration.export_image_per_disk:
+            return self._export_image_per_disk()
+        return self._export_ova()
+
+    def _get_export_image_cmd(self, dst_path, extra_params=()):
+        """生成导出镜像命令
         命令格式
-        {ovf_tool_path} {cmd_params} 
-        '{cmd_prefix}{username}:{password}@{ip}:{port}/{datacenter}/{vm_dir}/{vm_folder}/{src_vm_name}' 
-        {dst_dir}/{dst_vm_name}.{dst_image_format}
+        {ovf_tool_path} {cmd_params}
+        '{cmd_prefix}{username}:{password}@{ip}:{port}/{datacenter}/{vm_dir}/{vm_folder}/{src_vm_name}'
+        {dst_path}
         """
-
         # 目前写死， 后续再酌情优化
         disk_mode_param = "--diskMode=thin"
-        advanced_params = " ".join([disk_mode_param])
+        cmd_params = " ".join(
+            [
+                config.migration.export_image_cmd_nosslverify,
+                config.migration.export_image_cmd_overwrite,
+                config.migration.export_image_cmd_acceptalleulas,
+                config.migration.export_image_cmd_machineoutput,
+                config.export_image_cmd_log_level,
+                config.export_image_cmd_log_path,
+                disk_mode_param,
+                *extra_params,
+            ]
+        )
 
         src_platform = self.vm_session.task.src_platform
-        export_image_cmd = f"{config.migration.ovf_tool_path} {config.migration.export_image_common_params} {advanced_params} '{config.migration.export_image_cmd_prefix}{src_platform.user}:{src_platform.password}@{src_platform.ip}:{src_platform.port}/{self.vm_session.task.src_datacenter_name}/vm/{self.vm_session.src_vm_folder}/{self.vm_session.src_vm_name}' '{self.vm_session.export_dir}/{self.vm_session.dst_vm_name}.{config.migration.export_image_dst_format.value}' "
+        return f"{config.hyper.vmware_ovf_tool_path} {cmd_params} '{config.migration.export_image_cmd_vi_prefix}{src_platform.user}:{src_platform.password}@{src_platform.ip}:{src_platform.port}/{self.vm_session.task.src_datacenter_name}/vm/{self.vm_session.src_vm_folder}/{self.vm_session.src_vm_name}' '{dst_path}' "
+
+    def _exec_export_image_cmd(self, export_image_cmd, report_progress=True):
+        """执行导出镜像命令，失败后按指数退避重试，返回执行次数"""
         logger.info(
             f"export image ready, session id: {self.vm_session.session_id}, src vm name: {self.vm_session.src_vm_name}, export image cmd: {export_image_cmd}"
         )
-        start_time = datetime.datetime.now()
-
-        # 执行导出镜像命令
         execute_times = 0
         while True:
             execute_times += 1
             logger.info(
                 f"export image, execute times: {execute_times} times, max retry times: {config.migration.export_image_max_retry_times} times, session id: {self.vm_session.session_id}"
             )
+            # 每次执行都重新统计进度，ovftool的机器输出实时解析上报
+            on_output = None
+            if report_progress:
+                progress_reporter = ProgressReporter(
+                    self.vm_session,
+                    MigrateStep.EXPORT_IMAGE.value,
+                    MigrateProcess.START_EXPORT_IMAGE_PROCESS.value,
+                    MigrateProcess.END_EXPORT_IMAGE_PROCESS.value,
+                    interval=config.migration.progress_report_interval,
+                )
+                on_output = progress_reporter.make_output_callback(OvfToolProgressParser())
             returncode, stdout, stderr = CMDClient.normal_exec(
-                export_image_cmd, config.migration.export_image_timeout
+                export_image_cmd,
+                config.migration.export_image_timeout,
+                on_output=on_output,
             )
             if returncode == 0:
-                break
+                return execute_times
 
             if execute_times >= config.migration.export_image_max_retry_times:
                 self.vm_session.update_detail_migrate_status(
@@ -626,16 +1118,30 @@ class ExportImageMigration(BaseMigration):
                 log_msg = f"export image failed, retry times has out of limit, session id: {self.vm_session.session_id}, export image cmd: {export_image_cmd}, error reason: {stderr}"
                 logger.error(log_msg)
                 raise Exception(log_msg)
-            time.sleep(10)
 
-        # 检查OVA文件是否成功下载
+            backoff_seconds = TimeTool.get_backoff_seconds(
+                execute_times,
+                config.migration.export_image_retry_backoff_base,
+                config.migration.export_image_retry_backoff_max,
+            )
+            logger.warning(
+                f"export image failed, retry after {backoff_seconds:.1f} seconds, session id: {self.vm_session.session_id}, error reason: {stderr}"
+            )
+            time.sleep(backoff_seconds)
+
+    def _export_ova(self):
+        """使用ovftool导出整个OVA，返回OVA大小"""
         ova_name = ".".join(
             [
                 self.vm_session.dst_vm_name,
-                config.migration.export_image_dst_format.value,
+                config.migration.export_image_dst_format_ova,
             ]
         )
-        self.ova_path = os.path.join(self.vm_session.export_dir, ova_name)
+        ova_path = os.path.join(self.vm_session.export_dir, ova_name)
+        self._exec_export_image_cmd(self._get_export_image_cmd(ova_path))
+
+        # 检查OVA文件是否成功下载
+        self.ova_path = ova_path
         if not os.path.isfile(self.ova_path):
             self.vm_session.update_detail_migrate_status(
                 dict(
@@ -647,25 +1153,502 @@ class ExportImageMigration(BaseMigration):
             log_msg = f"export image failed, can not find ova file, session id: {self.vm_session.session_id}, ova path: {self.ova_path}"
             logger.error(log_msg)
             raise Exception(log_msg)
+        return FileTool.get_file_size(self.ova_path)
+
+    def _export_image_per_disk(self):
+        """按硬盘导出镜像，返回下载的总大小
+        1.ovftool使用--noImageFiles只导出OVF描述文件
+        2.按OVF中的文件名，从数据存储并行下载硬盘的vmdk描述文件和数据文件，数据文件支持断点续传
+          总并发数由export_image_disk_concurrency控制，每个数据存储的并发数由export_image_datastore_concurrency控制
+        3.下载的同时计算哈希值，在本地组装mf清单，供后续步骤使用
+        Note:数据存储中的vmdk为flat格式，精简置备的硬盘也会按完整容量下载
+        """
+        vmdk_dir = os.path.join(self.vm_session.export_dir, self.vm_session.dst_vm_name)
+        os.makedirs(vmdk_dir, exist_ok=True)
+
+        # 1.只导出OVF描述文件
+        ovf_path = self._export_ovf(vmdk_dir)
+
+        # 2.并行下载硬盘
+        src_vm_disk_list = self._relate_src_vm_disk_to_ovf_file(ovf_path)
+        progress_reporter = ProgressReporter(
+            self.vm_session,
+            MigrateStep.EXPORT_IMAGE.value,
+            MigrateProcess.START_EXPORT_IMAGE_PROCESS.value,
+            MigrateProcess.END_EXPORT_IMAGE_PROCESS.value,
+            weights={src_vm_disk["vmdk_name"]: src_vm_disk.get("capacity") or 1 for src_vm_disk in src_vm_disk_list},
+            interval=config.migration.progress_report_interval,
+        )
+        datastore_client = self._get_datastore_client()
+        datastore_semaphore_map = {
+            DatastoreClient.parse_datastore_path(src_vm_disk["file_path"])[0]: threading.Semaphore(
+                config.migration.export_image_datastore_concurrency
+            )
+            for src_vm_disk in src_vm_disk_list
+        }
+        manifest = {os.path.basename(ovf_path): ("sha256", FileTool.calculate_sha256(ovf_path))}
+        concurrency = max(1, min(config.migration.export_image_disk_concurrency, len(src_vm_disk_list)))
+        failed_disk_reason = dict()
+        export_size = 0
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            future_map = dict()
+            for src_vm_disk in self._interleave_by_datastore(src_vm_disk_list):
+                future = executor.submit(
+                    self._download_disk,
+                    datastore_client,
+                    src_vm_disk["file_path"],
+                    os.path.join(vmdk_dir, src_vm_disk["vmdk_name"]),
+                    progress_reporter,
+                    datastore_semaphore_map,
+                    src_vm_disk.get("base_file_path"),
+                    src_vm_disk.get("device_key"),
+                )
+                future_map[future] = src_vm_disk
+
+            for future in as_completed(future_map):
+                src_vm_disk = future_map[future]
+                try:
+                    disk_size, disk_manifest = future.result()
+                    export_size += disk_size
+                    manifest.update(disk_manifest)
+                except Exception as e:
+                    failed_disk_reason[src_vm_disk["file_path"]] = str(e)
+
+                    # 已经失败，则取消尚未开始的下载，已下载的部分保留，重新迁移时续传
+                    for pending_future in future_map:
+                        pending_future.cancel()
+
+        if failed_disk_reason:
+            self.vm_session.update_detail_migrate_status(
+                dict(
+                    err_code=ErrorCode.EXPORT_IMAGE_ERROR_DOWNLOAD_DISK_FAILED.value,
+                    err_msg=ErrorMsg.EXPORT_IMAGE_ERROR_DOWNLOAD_DISK_FAILED.value.zh,
+                )
+            )
 
-        # 更新详细的迁移状态信息
-        end_status = RunningDetailMigrateStatus.END_EXPORT_IMAGE_DETAIL_STATUS.value
-        end_status["step"]["end_time"] = TimeTool.get_now_datetime_str()
-        self.vm_session.update_detail_migrate_status(end_status)
+            log_msg = f"export image failed, download disk failed, session id: {self.vm_session.session_id}, failed disk count: {len(failed_disk_reason)}, error reason: {failed_disk_reason}"
+            logger.error(log_msg)
+            raise Exception(log_msg)
 
-        # 统计数据
-        end_time = datetime.datetime.now()
-        total_seconds = (end_time - start_time).total_seconds()
-        time_strftime = str(datetime.timedelta(seconds=total_seconds))
-        ova_size = FileTool.get_file_size(self.ova_path)
-        export_speed = ova_size / total_seconds  # 单位：MB/s
+        # 3.组装mf清单
+        self.mf_path = os.path.join(vmdk_dir, f"{self.vm_session.dst_vm_name}.mf")
+        FileTool.write_manifest_file(self.mf_path, manifest)
+        self.mf_data = manifest
+        self.ovf_path = ovf_path
+        self.vmdk_path_list = [
+            os.path.join(vmdk_dir, src_vm_disk["vmdk_name"]) for src_vm_disk in src_vm_disk_list
+        ]
         logger.info(
-            f"export image end, session id: {self.vm_session.session_id}, cost time: {time_strftime}, execute times: {execute_times} times, "
-            f"ova size: {ova_size}MB, export speed: {export_speed}MB/s, ova path: {self.ova_path}"
+            f"export image per disk end, session id: {self.vm_session.session_id}, concurrency: {concurrency}, "
+            f"datastore list: {list(datastore_semaphore_map)}, mf path: {self.mf_path}"
         )
+        return export_size
+
+    def _export_ovf(self, vmdk_dir):
+        """ovftool使用--noImageFiles只导出OVF描述文件，返回OVF路径"""
+        ovf_path = os.path.join(vmdk_dir, f"{self.vm_session.dst_vm_name}.ovf")
+        export_image_cmd = self._get_export_image_cmd(
+            ovf_path, [config.migration.export_image_cmd_noimagefiles]
+        )
+        self._exec_export_image_cmd(export_image_cmd, report_progress=False)
+        if not os.path.isfile(ovf_path):
+            self.vm_session.update_detail_migrate_status(
+                dict(
+                    err_code=ErrorCode.EXPORT_IMAGE_ERROR_COMMON.value,
+                    err_msg=ErrorMsg.EXPORT_IMAGE_ERROR_COMMON.value.zh,
+                )
+            )
+
+            log_msg = f"export image failed, can not find ovf file, session id: {self.vm_session.session_id}, ovf path: {ovf_path}"
+            logger.error(log_msg)
+            raise Exception(log_msg)
+        return ovf_path
+
+    @staticmethod
+    def _interleave_by_datastore(src_vm_disk_list):
+        """按数据存储轮流排列硬盘，避免线程池的工作线程都阻塞在同一个数据存储上"""
+        datastore_disk_map = dict()
+        for src_vm_disk in src_vm_disk_list:
+            datastore = DatastoreClient.parse_datastore_path(src_vm_disk["file_path"])[0]
+            datastore_disk_map.setdefault(datastore, list()).append(src_vm_disk)
+        return [
+            src_vm_disk
+            for disk_group in itertools.zip_longest(*datastore_disk_map.values())
+            for src_vm_disk in disk_group
+            if src_vm_disk
+        ]
+
+    def _relate_src_vm_disk_to_ovf_file(self, ovf_path):
+        """关联源虚拟机硬盘和OVF中的vmdk文件
+        ovftool按硬盘的device_key顺序生成References中的文件，二者按顺序一一对应
+        """
+        ovf_envelope = self._get_ovf_envelope(ovf_path)
+        vmdk_name_list = [ovf_file.href for ovf_file in ovf_envelope.files if ovf_file.href.endswith("vmdk")]
+
+        src_vm_disk_list = sorted(self.vm_session.info["src_vm_disk"], key=lambda disk: disk["device_key"])
+        if len(vmdk_name_list) != len(src_vm_disk_list):
+            self.vm_session.update_detail_migrate_status(
+                dict(
+                    err_code=ErrorCode.EXPORT_IMAGE_ERROR_COMMON.value,
+                    err_msg=ErrorMsg.EXPORT_IMAGE_ERROR_COMMON.value.zh,
+                )
+            )
+
+            log_msg = f"export image failed, disk count is not match, session id: {self.vm_session.session_id}, ovf vmdk list: {vmdk_name_list}, src vm disk count: {len(src_vm_disk_list)}"
+            logger.error(log_msg)
+            raise Exception(log_msg)
+
+        return [
+            dict(src_vm_disk, vmdk_name=vmdk_name)
+            for src_vm_disk, vmdk_name in zip(src_vm_disk_list, vmdk_name_list)
+        ]
+
+    def _get_datastore_client(self):
+        src_platform = self.vm_session.task.src_platform
+        return DatastoreClient(
+            src_platform.ip,
+            src_platform.user,
+            src_platform.password,
+            self.vm_session.task.src_datacenter_name,
+            port=src_platform.port,
+            timeout=config.vmware_vsphere.timeout_connect_to_vmware_vsphere,
+        )
+
+    def _download_disk(self, datastore_client, file_path, vmdk_path, progress_reporter, datastore_semaphore_map,
+                       base_file_path=None, device_key=None):
+        """下载单个硬盘，返回数据文件的总大小和各文件的哈希值
+        vmdk描述文件中的数据文件名改写为本地文件名后保存到vmdk_path，qemu-img可直接转换
+        """
+        datastore, descriptor_path = DatastoreClient.parse_datastore_path(file_path)
+        # 占用数据存储的并发名额，同一数据存储上同时下载的硬盘数受限
+        with datastore_semaphore_map[datastore]:
+            return self._download_disk_files(
+                datastore_client, file_path, vmdk_path, progress_reporter, base_file_path, device_key
+            )
+
+    def _download_disk_files(self, datastore_client, file_path, vmdk_path, progress_reporter, base_file_path=None,
+                             device_key=None):
+        datastore, descriptor_path = DatastoreClient.parse_datastore_path(file_path)
+        descriptor = datastore_client.read_file(datastore, descriptor_path).decode("utf-8")
+        parent_file_name = VmdkTool.get_descriptor_parent(descriptor)
+        if parent_file_name:
+            if not config.migration.deal_image_linked_clone:
+                raise Exception(f"disk has snapshot, parent file name: {parent_file_name}, please consolidate snapshots or export ova")
+
+            # 链接克隆：只下载差异磁盘，父磁盘作为共享基础镜像在本节点只构建一次
+            base_file_path = base_file_path or self._resolve_parent_file_path(file_path, parent_file_name)
+            shared_base_image = self._get_shared_base_image(base_file_path)
+            shared_base_image.acquire(
+                self.vm_session.session_id,
+                lambda image: self._build_shared_base_image(datastore_client, image),
+            )
+            descriptor = VmdkTool.rewrite_descriptor_parent(descriptor, shared_base_image.vmdk_path)
+            self.linked_clone_map[vmdk_path] = dict(
+                base_file_path=base_file_path, base_qcow2_path=shared_base_image.qcow2_path
+            )
+        extents = VmdkTool.parse_descriptor_extents(descriptor)
+        if not extents:
+            raise Exception(f"can not find extent in vmdk descriptor: {file_path}")
+
+        vmdk_name = os.path.basename(vmdk_path)
+        vmdk_stem = os.path.splitext(vmdk_name)[0]
+        disk_size = sum(extent["sectors"] for extent in extents) * 512
+        extent_path_list = [posixpath.join(posixpath.dirname(descriptor_path), extent["file_name"]) for extent in extents]
+
+        # 分块缓存中有上次迁移的数据时，按CBT查询变化的区间，只下载变化的块
+        # Note:差异磁盘和稀疏格式的数据文件中，文件偏移与硬盘偏移不对应，只处理flat格式
+        change_id, changed_areas = "", None
+        if (
+            self._get_chunk_store()
+            and device_key is not None
+            and not parent_file_name
+            and all(extent["type"] in ("VMFS", "FLAT") for extent in extents)
+        ):
+            change_id, changed_areas = self._query_disk_changes(
+                device_key, [f"[{datastore}] {extent_path}" for extent_path in extent_path_list], disk_size
+            )
+
+        done_size = 0
+        disk_offset = 0
+        file_name_map = dict()
+        manifest = dict()
+        for index, extent in enumerate(extents):
+            extent_name = f"{vmdk_stem}-flat.vmdk" if len(extents) == 1 else f"{vmdk_stem}-f{index + 1:03d}.vmdk"
+            file_name_map[extent["file_name"]] = extent_name
+
+            def on_progress(downloaded_size, total_size, done_size=done_size):
+                if progress_reporter:
+                    progress_reporter.update((done_size + downloaded_size) * 100 / disk_size, vmdk_name)
+
+            logger.info(
+                f"download disk extent start, session id: {self.vm_session.session_id}, file path: {file_path}, extent: {extent['file_name']}"
+            )
+            extent_changed_areas = None
+            if changed_areas is not None:
+                extent_changed_areas = self._map_disk_areas_to_extent(
+                    changed_areas, disk_offset, extent["sectors"] * 512, extent["offset"] * 512
+                )
+            extent_size, digest_map = self._download_extent(
+                datastore_client,
+                datastore,
+                extent_path_list[index],
+                os.path.join(os.path.dirname(vmdk_path), extent_name),
+                on_progress,
+                change_id,
+                extent_changed_areas,
+            )
+            done_size += extent_size
+            disk_offset += extent["sectors"] * 512
+            manifest[extent_name] = ("sha256", digest_map["sha256"])
+
+        with open(vmdk_path, "w", encoding="utf-8") as f:
+            f.write(VmdkTool.rewrite_descriptor_extents(descriptor, file_name_map))
+        manifest[vmdk_name] = ("sha256", FileTool.calculate_sha256(vmdk_path))
+        logger.info(
+            f"download disk end, session id: {self.vm_session.session_id}, file path: {file_path}, vmdk path: {vmdk_path}, size: {done_size}B"
+        )
+        return done_size, manifest
+
+    def _download_extent(self, datastore_client, datastore, path, dst_path, on_progress, change_id="", changed_areas=None):
+        """下载vmdk的数据文件，返回文件大小和哈希值
+        开启export_image_chunk_cache时：
+        1.远端文件与上次迁移时的版本一致，则由分块缓存重建，无需下载
+        2.版本不一致但已知上次迁移以来变化的区间（changed_areas，文件内的偏移），则只下载变化的块，其余块由缓存重建
+        3.否则完整下载，下载的同时分块保存到缓存
+        change_id为硬盘当前的CBT变更标识，记录在文件清单中，供同一虚拟机的下次迁移查询变化的区间
+        """
+        chunk_store = self._get_chunk_store()
+        if not chunk_store:
+            return self._download_file(datastore_client, datastore, path, dst_path, on_progress)
+
+        key = f"[{datastore}] {path}"
+        version = datastore_client.get_file_version(datastore, path)
+        recipe = chunk_store.get_valid_recipe(self.vm_session.src_vm_id, key, version)
+        if recipe and "sha256" in recipe["digest_map"]:
+            try:
+                chunk_store.restore_file(recipe, dst_path)
+                on_progress(recipe["size"], recipe["size"])
+                logger.info(
+                    f"restore extent from chunk store, session id: {self.vm_session.session_id}, file path: {key}, size: {recipe['size']}B"
+                )
+                if change_id and recipe.get("change_id") != change_id:
+                    chunk_store.save_recipe(
+                        self.vm_session.src_vm_id, key, recipe["size"], recipe["chunks"], version, recipe["digest_map"], change_id
+                    )
+                return recipe["size"], recipe["digest_map"]
+            except OSError as e:
+                # 重建过程中块被淘汰，改为下载
+                os.remove(dst_path) if os.path.isfile(dst_path) else None
+                logger.warning(
+                    f"restore extent from chunk store failed, download it, session id: {self.vm_session.session_id}, file path: {key}, error reason: {e}"
+                )
+
+        recipe = chunk_store.load_recipe(self.vm_session.src_vm_id, key)
+        if changed_areas is not None and recipe and recipe.get("chunk_size") == chunk_store.chunk_size:
+            try:
+                return self._download_extent_changes(
+                    chunk_store, datastore_client, datastore, path, dst_path, on_progress, recipe, changed_areas,
+                    version, change_id,
+                )
+            except OSError as e:
+                os.remove(dst_path) if os.path.isfile(dst_path) else None
+                logger.warning(
+                    f"download extent changes failed, download it, session id: {self.vm_session.session_id}, file path: {key}, error reason: {e}"
+                )
+
+        chunk_writer = chunk_store.open_writer(self.vm_session.src_vm_id, key)
+        extent_size, digest_map = self._download_file(
+            datastore_client, datastore, path, dst_path, on_progress, chunk_writer
+        )
+        chunk_writer.finish(version, digest_map, change_id)
+        return extent_size, digest_map
+
+    def _download_file(self, datastore_client, datastore, path, dst_path, on_progress, sink=None):
+        return datastore_client.download_file(
+            datastore,
+            path,
+            dst_path,
+            max_retry_times=config.migration.export_image_max_retry_times,
+            backoff_base_seconds=config.migration.export_image_retry_backoff_base,
+            backoff_max_seconds=config.migration.export_image_retry_backoff_max,
+            on_progress=on_progress,
+            algorithms=("sha256",),
+            sink=sink,
+        )
+
+    def _download_extent_changes(self, chunk_store, datastore_client, datastore, path, dst_path, on_progress, recipe,
+                                 changed_areas, version, change_id):
+        """按块重建数据文件，与变化区间重叠的块及上次迁移以来新增的块从远端读取，其余块由缓存重建
+        所有块按顺序计算整个文件的哈希值并写入新的文件清单，块已被淘汰或长度不符时抛出OSError
+        """
+        chunk_size = recipe["chunk_size"]
+        file_size = datastore_client.get_file_size(datastore, path)
+        # 文件大小变化时，清单的最后一块可能不足一个块，从该块起全部从远端读取
+        download_index = len(recipe["chunks"]) if recipe["size"] == file_size else len(recipe["chunks"]) - 1
+        changed_index_set = set()
+        for area in changed_areas:
+            changed_index_set.update(
+                range(area["start"] // chunk_size, (area["start"] + area["length"] - 1) // chunk_size + 1)
+            )
+
+        chunk_writer = chunk_store.open_writer(self.vm_session.src_vm_id, recipe["key"])
+        sha256 = hashlib.sha256()
+        download_size = 0
+        with open(dst_path, "wb") as f:
+            for index, offset in enumerate(range(0, file_size, chunk_size)):
+                length = min(chunk_size, file_size - offset)
+                if index in changed_index_set or index >= download_index:
+                    data = datastore_client.read_range(
+                        datastore, path, offset, length, max_retry_times=config.migration.export_image_max_retry_times
+                    )
+                    if len(data) != length:
+                        raise Exception(
+                            f"download extent changes failed, file size is changed, file path: {recipe['key']}, offset: {offset}"
+                        )
+                    download_size += length
+                else:
+                    data = chunk_store.read_chunk(recipe["chunks"][index], length)
+                    if len(data) != length:
+                        raise OSError(
+                            f"chunk size is changed, file path: {recipe['key']}, offset: {offset}, "
+                            f"chunk size: {len(data)}B, expected size: {length}B"
+                        )
+                sha256.update(data)
+                chunk_writer.update(data)
+                # 全零的块保留为文件空洞
+                if data.strip(b"\0"):
+                    f.seek(offset)
+                    f.write(data)
+                on_progress(offset + length, file_size)
+            f.truncate(file_size)
+
+        digest_map = dict(sha256=sha256.hexdigest())
+        chunk_writer.finish(version, digest_map, change_id)
+        logger.info(
+            f"download extent changes from chunk store, session id: {self.vm_session.session_id}, file path: {recipe['key']}, "
+            f"size: {file_size}B, download size: {download_size}B, changed chunk count: {len(changed_index_set)}"
+        )
+        return file_size, digest_map
+
+    def _query_disk_changes(self, device_key, key_list, disk_size):
+        """查询硬盘当前的CBT变更标识，以及分块缓存中记录的变更标识以来变化的区间（硬盘内的偏移）
+        源虚拟机未开启CBT时返回("", None)，缓存中没有可用的变更标识或查询失败时变化的区间为None
+        Note:导出时源虚拟机已关机，不创建快照，直接查询硬盘的当前状态
+        """
+        chunk_store = self._get_chunk_store()
+        vsphere_client = self._get_vsphere_client()
+        try:
+            vsphere_client.login()
+            disk = next(
+                (
+                    disk for disk in vsphere_client.get_virtual_disks("VirtualMachine", self.vm_session.src_vm_id)
+                    if int(disk["key"]) == int(device_key)
+                ),
+                None,
+            )
+            change_id = ((disk or dict()).get("backing") or dict()).get("changeId") or ""
+            if not change_id:
+                return "", None
+
+            recipe_list = [chunk_store.load_recipe(self.vm_session.src_vm_id, key) for key in key_list]
+            recipe_change_id_set = {recipe.get("change_id") for recipe in recipe_list if recipe}
+            if len(recipe_change_id_set) != 1 or not all(recipe_list) or not next(iter(recipe_change_id_set)):
+                return change_id, None
+            recipe_change_id = next(iter(recipe_change_id_set))
+            changed_areas = DeltaReader.merge_areas(vsphere_client.iter_changed_disk_areas(
+                self.vm_session.src_vm_id, None, int(device_key), disk_size, recipe_change_id
+            ))
+            logger.info(
+                f"query disk changes, session id: {self.vm_session.session_id}, device key: {device_key}, "
+                f"change id: {recipe_change_id} -> {change_id}, changed size: {sum(area['length'] for area in changed_areas)}B"
+            )
+            return change_id, changed_areas
+        except (VSphereFault, OSError) as e:
+            # 变更标识已失效（CBT被重置）或无法连接，按完整下载处理
+            logger.warning(
+                f"query disk changes failed, session id: {self.vm_session.session_id}, device key: {device_key}, error reason: {e}"
+            )
+            return "", None
+        finally:
+            try:
+                vsphere_client.logout()
+            except Exception:
+                pass
+
+    @staticmethod
+    def _map_disk_areas_to_extent(areas, disk_offset, extent_size, file_offset):
+        """将硬盘内的区间转换为数据文件内的区间，extent从硬盘的disk_offset开始，数据从文件的file_offset开始"""
+        extent_areas = list()
+        for area in areas:
+            start = max(area["start"], disk_offset)
+            end = min(area["start"] + area["length"], disk_offset + extent_size)
+            if start < end:
+                extent_areas.append(dict(start=start - disk_offset + file_offset, length=end - start))
+        return extent_areas
+
+    def _get_vsphere_client(self):
+        src_platform = self.vm_session.task.src_platform
+        return VSphereClient(
+            src_platform.ip,
+            src_platform.user,
+            src_platform.password,
+            port=src_platform.port,
+            timeout=config.vmware_vsphere.timeout_connect_to_vmware_vsphere,
+        )
+
+    @staticmethod
+    def _get_chunk_store():
+        if not config.migration.export_image_chunk_cache:
+            return None
+        return ChunkStore(
+            config.export_image_chunk_cache_dir_full,
+            config.migration.export_image_chunk_cache_max_gb * 1024 ** 3,
+            config.migration.export_image_chunk_cache_chunk_size,
+        )
+
+    @staticmethod
+    def _resolve_parent_file_path(file_path, parent_file_name):
+        """将vmdk描述文件中的parentFileNameHint解析为数据存储路径
+        eg: "template.vmdk" -> "[datastore1] template/template.vmdk"（相对于差异磁盘所在目录）
+        eg: "/vmfs/volumes/datastore1/template/template.vmdk" -> "[datastore1] template/template.vmdk"
+        Note:以数据存储UUID表示的绝对路径无法解析，需在src_vm_disk中指定base_file_path
+        """
+        vmfs_prefix = "/vmfs/volumes/"
+        if parent_file_name.startswith(vmfs_prefix):
+            datastore, path = parent_file_name[len(vmfs_prefix):].split("/", 1)
+            return f"[{datastore}] {path}"
+
+        datastore, descriptor_path = DatastoreClient.parse_datastore_path(file_path)
+        path = posixpath.normpath(posixpath.join(posixpath.dirname(descriptor_path), parent_file_name))
+        return f"[{datastore}] {path}"
+
+    def _build_shared_base_image(self, datastore_client, shared_base_image):
+        """下载链接克隆的父磁盘并转换为qcow2，先写临时文件再改名，避免其他会话使用未转换完成的镜像"""
+        os.makedirs(shared_base_image.image_dir, exist_ok=True)
+        self._download_disk_files(datastore_client, shared_base_image.base_file_path, shared_base_image.vmdk_path, None)
+
+        tmp_qcow2_path = f"{shared_base_image.qcow2_path}.tmp"
+        convert_cmd = DEAL_IMAGE_CONVERT_IMAGE_CMD_TEMPLATE.format(
+            qemu_img_path=config.hyper.qemu_img_tool_path,
+            qemu_img_action=QemuImgAction.CONVERT.value,
+            src_image_format=config.migration.deal_image_src_format_vmdk,
+            dst_image_format=config.migration.deal_image_dst_format_qcow2,
+            src_image_path=shared_base_image.vmdk_path,
+            dst_image_path=tmp_qcow2_path,
+        )
+        returncode, _, stderr = CMDClient.bash_exec(convert_cmd, config.migration.deal_image_convert_image_timeout)
+        if returncode != 0:
+            raise Exception(f"convert shared base image failed, convert cmd: {convert_cmd}, error reason: {stderr}")
+        os.replace(tmp_qcow2_path, shared_base_image.qcow2_path)
 
     def _uncompress_image(self):
-        """解压镜像"""
+        """解压镜像
+        先解析mf清单，再逐个解压tar成员，解压的同时计算哈希值，成员解压完成即完成校验，无需再次读取
+        Note:按硬盘导出时没有OVA，无需解压
+        """
+        if config.migration.export_image_per_disk:
+            return
+
         logger.info(
             f"uncompress image start, session id: {self.vm_session.session_id}, ova path: {self.ova_path}"
         )
@@ -673,34 +1656,32 @@ class ExportImageMigration(BaseMigration):
         shutil.rmtree(vmdk_dir) if os.path.isdir(vmdk_dir) else None
         os.mkdir(vmdk_dir)
         start_time = datetime.datetime.now()
+        stream_convert = config.migration.deal_image_stream_convert
         try:
             tar = tarfile.open(self.ova_path)
-            for single_file in tar.getnames():
-                if single_file.endswith("ovf"):
-                    tar.extract(single_file, self.vm_session.export_dir)
-                    self.ovf_path = os.path.join(
-                        self.vm_session.export_dir, single_file
-                    )
-                elif single_file.endswith("vmdk"):
-                    tar.extract(single_file, vmdk_dir)
-                    self.vmdk_path_list.append(os.path.join(vmdk_dir, single_file))
-                elif single_file.endswith("mf"):
-                    tar.extract(single_file, self.vm_session.export_dir)
-                    self.mf_path = os.path.join(self.vm_session.export_dir, single_file)
-                else:
-                    continue
-            tar.close()
+            members = tar.getmembers()
+
+            # 优先解析mf清单，以便每个成员解压完成时立即校验
+            for member in members:
+                if member.name.endswith("mf"):
+                    tar.extract(member, self.vm_session.export_dir)
+                    self.mf_path = os.path.join(self.vm_session.export_dir, member.name)
+                    self.mf_data = FileTool.parse_manifest_file(self.mf_path)
         except Exception as e:
-            self.vm_session.update_detail_migrate_status(
-                dict(
-                    err_code=ErrorCode.DEAL_IMAGE_ERROR_UNCOMPRESS_IMAGE_FAILED.value,
-                    err_msg=ErrorMsg.DEAL_IMAGE_ERROR_UNCOMPRESS_IMAGE_FAILED.value.zh,
-                )
-            )
+            self._uncompress_image_failed(e)
 
-            log_msg = f"uncompress image failed, user id: {self.vm_session.user_id}, session id: {self.vm_session.session_id}, ova path: {self.ova_path}, error reason: {str(e)}"
-            logger.error(log_msg)
-            raise Exception(log_msg)
+        with tar:
+            for member in members:
+                try:
+                    file_path, digest_map = self._uncompress_member(
+                        tar, member, vmdk_dir, stream_convert
+                    )
+                except Exception as e:
+                    self._uncompress_image_failed(e)
+
+                # Note:没有mf清单时不计算哈希值，由检查镜像步骤报错
+                if file_path and self.mf_path:
+                    self._check_file_digest(file_path, digest_map)
 
         # 记录结束时间并统计
         end_time = datetime.datetime.now()
@@ -711,9 +1692,60 @@ class ExportImageMigration(BaseMigration):
 
         logger.info(
             f"uncompress image end, session id: {self.vm_session.session_id}, cost time: {time_strftime}, ova_size: {ova_size}MB, uncompress speed: {uncompress_speed}MB/s, ova path: {self.ova_path}, "
-            f"vmdk path list: {self.vmdk_path_list}, ovf path: {self.ovf_path}"
+            f"vmdk path list: {self.vmdk_path_list}, ovf path: {self.ovf_path}, stream convert: {stream_convert}"
+        )
+
+    def _uncompress_member(self, tar, member, vmdk_dir, stream_convert):
+        """解压单个tar成员，返回解压后的路径和哈希值
+        Note:mf文件已提前解压，不需要处理的成员返回空路径
+        """
+        single_file = member.name
+        if single_file.endswith("ovf"):
+            self.ovf_path = os.path.join(self.vm_session.export_dir, single_file)
+            digest_map = FileTool.copy_fileobj_with_hash(
+                tar.extractfile(member), self.ovf_path, self._get_mf_algorithms(self.ovf_path)
+            )
+            return self.ovf_path, digest_map
+
+        if single_file.endswith("vmdk"):
+            vmdk_path = os.path.join(vmdk_dir, single_file)
+            self.vmdk_path_list.append(vmdk_path)
+
+            # 流式转换：只记录vmdk在OVA中的偏移，由qemu-img直接读取，不解压落盘，哈希值在转换时计算
+            # Note:稀疏存储的tar成员数据不连续，仍需解压
+            if stream_convert and member.isreg() and not member.issparse():
+                self.vmdk_uri_map[vmdk_path] = dict(
+                    uri=DEAL_IMAGE_OVA_MEMBER_URI_TEMPLATE.format(
+                        offset=member.offset_data,
+                        size=member.size,
+                        ova_path=self.ova_path,
+                    ),
+                    file_path=self.ova_path,
+                    offset=member.offset_data,
+                    size=member.size,
+                )
+                return "", dict()
+
+            digest_map = FileTool.copy_fileobj_with_hash(
+                tar.extractfile(member), vmdk_path, self._get_mf_algorithms(vmdk_path)
+            )
+            return vmdk_path, digest_map
+
+        return "", dict()
+
+    def _uncompress_image_failed(self, reason):
+        """解压镜像失败"""
+        self.vm_session.update_detail_migrate_status(
+            dict(
+                err_code=ErrorCode.DEAL_IMAGE_ERROR_UNCOMPRESS_IMAGE_FAILED.value,
+                err_msg=ErrorMsg.DEAL_IMAGE_ERROR_UNCOMPRESS_IMAGE_FAILED.value.zh,
+            )
         )
 
+        log_msg = f"uncompress image failed, session id: {self.vm_session.session_id}, ova path: {self.ova_path}, error reason: {str(reason)}"
+        logger.error(log_msg)
+        raise Exception(log_msg)
+
     def check_image(self):
         """检查镜像"""
         return self._check_image()
@@ -721,7 +1753,9 @@ class ExportImageMigration(BaseMigration):
     def _check_image(self):
         """检查镜像
         # 1.完整性检查
-        # 2.检查文件的SHA256值
+        # 2.检查文件的哈希值
+        Note:ovf和vmdk的哈希值已在解压时校验，流式转换的vmdk在转换的同时校验，此处不再读取文件
+        Note:按硬盘导出时mf清单在本地组装，哈希值在下载时计算
         """
 
         logger.info(
@@ -739,55 +1773,97 @@ class ExportImageMigration(BaseMigration):
             logger.error(log_msg)
             raise Exception(log_msg)
 
-        mf_data = {}
-        mf_content = FileTool.read_file(self.mf_path)
-        items = mf_content.split("\n")
-        for line in items:
-            if line:
-                key, value = line.split("=")
-                if key not in mf_data:
-                    mf_data[key] = value.strip()
-        logger.info(f"mf data: {mf_data}, session id: {self.vm_session.session_id}")
-
-        # 检查ovf文件
-        ovf_name = os.path.basename(self.ovf_path)
-        ovf_key = f"SHA256({ovf_name})"
-        ovf_content = FileTool.read_file(self.ovf_path)
-        ovf_sha256 = FileTool.sha256_tool(ovf_content)
-        if mf_data.get(ovf_key) != ovf_sha256:
+        # OVF引用的硬盘文件均需在mf清单中，否则无法校验
+        # nvram、iso等非硬盘文件不参与迁移，按硬盘导出时本地组装的mf清单也不包含这些文件
+        ovf_envelope = self._get_ovf_envelope()
+        missing_href_list = [
+            ovf_file.href for ovf_file in ovf_envelope.files
+            if ovf_file.id in ovf_envelope.disk_file_ref_map and ovf_file.href not in self.mf_data
+        ]
+        if missing_href_list:
             self.vm_session.update_detail_migrate_status(
                 dict(
-                    err_code=ErrorCode.DEAL_IMAGE_ERROR_OVF_NOT_MATCH.value,
-                    err_msg=ErrorMsg.DEAL_IMAGE_ERROR_OVF_NOT_MATCH.value.zh,
+                    err_code=ErrorCode.DEAL_IMAGE_ERROR_VMDK_NOT_MATCH.value,
+                    err_msg=ErrorMsg.DEAL_IMAGE_ERROR_VMDK_NOT_MATCH.value.zh,
                 )
             )
 
-            log_msg = f"ovf file {ovf_name} md5 is not match, mf md5: {mf_data.get(ovf_key)}, ovf md5: {ovf_sha256}"
+            log_msg = f"disk file referenced by ovf is not in mf file, session id: {self.vm_session.session_id}, missing files: {missing_href_list}"
             logger.error(log_msg)
             raise Exception(log_msg)
 
-        # 检查vmdk文件
-        for vmdk_path in self.vmdk_path_list:
-            vmdk_name = os.path.basename(vmdk_path)
-            vmdk_key = f"SHA256({vmdk_name})"
-            vmdk_content = FileTool.read_file(vmdk_path)
-            vmdk_sha256 = FileTool.sha256_tool(vmdk_content)
-            if mf_data.get(vmdk_key) != vmdk_sha256:
-                self.vm_session.update_detail_migrate_status(
-                    dict(
-                        err_code=ErrorCode.DEAL_IMAGE_ERROR_VMDK_NOT_MATCH.value,
-                        err_msg=ErrorMsg.DEAL_IMAGE_ERROR_VMDK_NOT_MATCH.value.zh,
-                    )
+        logger.info(
+            f"check image end, session id: {self.vm_session.session_id}, ova path: {self.ova_path}, mf path: {self.mf_path}, mf data: {self.mf_data}"
+        )
+
+    def _get_mf_algorithms(self, file_path):
+        """获取mf清单中文件对应的哈希算法，文件不在清单中时不计算哈希值"""
+        file_name = os.path.basename(file_path)
+        if file_name in self.mf_data:
+            return (self.mf_data[file_name][0],)
+        return tuple()
+
+    def _check_file_digest(self, file_path, digest_map):
+        """依据mf清单校验ovf或vmdk文件的哈希值"""
+        file_name = os.path.basename(file_path)
+        algorithm, mf_digest = self.mf_data.get(file_name, ("", ""))
+        file_digest = digest_map.get(algorithm, "")
+        if mf_digest and mf_digest == file_digest:
+            return
+
+        if file_name.endswith("ovf"):
+            err_code = ErrorCode.DEAL_IMAGE_ERROR_OVF_NOT_MATCH
+            err_msg = ErrorMsg.DEAL_IMAGE_ERROR_OVF_NOT_MATCH
+        else:
+            err_code = ErrorCode.DEAL_IMAGE_ERROR_VMDK_NOT_MATCH
+            err_msg = ErrorMsg.DEAL_IMAGE_ERROR_VMDK_NOT_MATCH
+        self.vm_session.update_detail_migrate_status(
+            dict(err_code=err_code.value, err_msg=err_msg.value.zh)
+        )
+
+        log_msg = f"file {file_name} {algorithm or 'digest'} is not match, session id: {self.vm_session.session_id}, mf digest: {mf_digest}, file digest: {file_digest}"
+        logger.error(log_msg)
+        raise Exception(log_msg)
+
+    def _convert_image(self):
+        """转换镜像
+        流式转换时，在qemu-img从OVA读取vmdk的同时并行计算哈希值，转换结束后校验并删除OVA
+        """
+        if not self.vmdk_uri_map:
+            return super(ExportImageMigration, self)._convert_image()
+
+        with ThreadPoolExecutor(max_workers=len(self.vmdk_uri_map)) as executor:
+            future_map = dict()
+            for vmdk_path, member_info in self.vmdk_uri_map.items():
+                future_map[vmdk_path] = executor.submit(
+                    FileTool.calculate_range_hash,
+                    self.ova_path,
+                    member_info["offset"],
+                    member_info["size"],
+                    self._get_mf_algorithms(vmdk_path),
                 )
 
-                log_msg = f"vmdk file {ovf_name} md5 is not match, mf md5: {mf_data.get(ovf_key)}, vmdk md5: {vmdk_sha256}"
-                logger.error(log_msg)
-                raise Exception(log_msg)
+            super(ExportImageMigration, self)._convert_image()
+
+            for vmdk_path, future in future_map.items():
+                self._check_file_digest(vmdk_path, future.result())
 
+        # 所有vmdk均已转换并校验通过，删掉OVA文件，节省空间
+        # Note:数据盘直接转换到目标卷时，覆盖镜像后才能删除
+        if not any(disk_info.get("direct_convert") for disk_info in self.vm_session.dst_vm_disk):
+            os.remove(self.ova_path)
         logger.info(
-            f"check image end, session id: {self.vm_session.session_id}, ova path: {self.ova_path}, mf path: {self.mf_path}"
+            f"stream convert image end, session id: {self.vm_session.session_id}, ova path: {self.ova_path}"
         )
 
+    def cover_image(self):
+        """覆盖镜像
+        数据盘从OVA直接转换到目标卷时，OVA在覆盖镜像后删除
+        """
+        super(ExportImageMigration, self).cover_image()
+        if self.vmdk_uri_map and os.path.isfile(self.ova_path):
+            os.remove(self.ova_path)
+
 
 class UploadImageMigration(BaseMigration):
     """上传镜像模式对应的迁移器"""
@@ -796,68 +1872,362 @@ class UploadImageMigration(BaseMigration):
 
     def __init__(self, vm_session):
         super(UploadImageMigration, self).__init__(vm_session)
+        # 流式转换时正在发布的NBD导出，key为vmdk路径
+        self.nbd_export_map = dict()
 
     def upload_image(self):
-        """上传镜像"""
-        # logger.info("upload image start, session id: {session_id}"
-        #             .format(session_id=self.vm_session.session_id))
-        # # 更新详细的迁移状态信息
-        # start_status = RunningDetailMigrateStatus.START_UPLOAD_IMAGE_DETAIL_STATUS.value
-        # start_status["step"]["start_time"] = TimeTool.get_now_datetime_str()
-        # self.vm_session.update_detail_migrate_status(start_status)
-
-        # start_time = datetime.datetime.now()
-        # try:
-        #     src_vm_nfs_path = self.vm_session.src_vm_nfs_path
-        #     dst_vm_name = self.vm_session.dst_vm_name
-        #
-        #     # 初始化vmdk目录
-        #     vmdk_dir = os.path.join(self.vm_session.upload_dir, dst_vm_name)
-        #     shutil.rmtree(vmdk_dir) if os.path.isdir(vmdk_dir) else None
-        #     os.mkdir(vmdk_dir)
-        #
-        #     total_size = 0
-        #     nfs = NFSInterface(src_vm_nfs_path)
-        #     for single_file in nfs.listdirs(""):
-        #         file_path = os.path.join(src_vm_nfs_path, single_file)
-        #         if single_file.endswith('ovf'):
-        #             self.ovf_path = os.path.join(self.vm_session.upload_dir,
-        #                                          single_file)
-        #             copy_nfs_file(file_path, self.ovf_path)
-        #             total_size += os.path.getsize(self.ovf_path)
-        #         elif single_file.endswith('vmdk'):
-        #             vmdk_path = os.path.join(vmdk_dir, single_file)
-        #             copy_nfs_file(file_path, vmdk_path,
-        #                           timeout=config.migration.upload_image_timeout.value)
-        #             total_size += os.path.getsize(vmdk_path)
-        #             self.vmdk_path_list.append(vmdk_path)
-        # except Exception as e:
-        #     self.vm_session.update_detail_migrate_status(dict(
-        #         err_code=ErrorCode.UPLOAD_IMAGE_ERROR_COMMON.value,
-        #         err_msg=ErrorMsg.UPLOAD_IMAGE_ERROR_COMMON.value.zh))
-        #
-        #     log_msg = "upload image failed, session id: {session_id}, error " \
-        #               "reason: {error_reason}" \
-        #               "".format(session_id=self.vm_session.session_id,
-        #                         error_reason=str(e))
-        #     logger.exception(log_msg)
-        #     raise Exception(log_msg)
-        #
-        # # 更新详细的迁移状态信息
-        # end_status = RunningDetailMigrateStatus.END_UPLOAD_IMAGE_DETAIL_STATUS.value
-        # end_status["step"]["end_time"] = TimeTool.get_now_datetime_str()
-        # self.vm_session.update_detail_migrate_status(end_status)
-        #
-        # # 汇总数据
-        # end_time = datetime.datetime.now()
-        # total_seconds = (end_time - start_time).total_seconds()
-        # time_strftime = str(datetime.timedelta(seconds=total_seconds))
-        # total_size = round(total_size / float(1024 * 1024), 2)
-        # upload_speed = total_size / total_seconds  # 单位：MB/s
-        # logger.info("upload image end, session id: {session_id}, cost_time: "
-        #             "{cost_time}, total_size: {total_size}MB, upload speed: "
-        #             "{upload_speed}MB/s"
-        #             .format(cost_time=time_strftime,
-        #                     total_size=total_size,
-        #                     upload_speed=upload_speed,
-        #                     session_id=self.vm_session.session_id))
+        """上传镜像
+        从源虚拟机的NFS目录拷贝OVF和vmdk文件到本地，文件依次拷贝，单个文件由多个线程按块并行读取，
+        并发数和块大小分别由upload_image_concurrency、upload_image_chunk_size控制，失败时只重新拷贝未完成的块
+        开启upload_image_stream_convert时，单文件的sparse vmdk不拷贝，只记录其NFS路径，转换时由qemu-img经NBD导出直接读取
+        """
+        logger.info(
+            f"upload image start, session id: {self.vm_session.session_id}, src vm nfs path: {self.vm_session.src_vm_nfs_path}"
+        )
+        # 更新详细的迁移状态信息
+        start_status = RunningDetailMigrateStatus.START_UPLOAD_IMAGE_DETAIL_STATUS.copy()
+        start_status["step"]["start_time"] = TimeTool.get_now_datetime_str()
+        self.vm_session.update_detail_migrate_status(start_status)
+
+        start_time = datetime.datetime.now()
+        try:
+            src_vm_nfs_path = self.vm_session.src_vm_nfs_path
+            dst_vm_name = self.vm_session.dst_vm_name
+
+            # 初始化vmdk目录
+            vmdk_dir = os.path.join(self.vm_session.upload_dir, dst_vm_name)
+            shutil.rmtree(vmdk_dir) if os.path.isdir(vmdk_dir) else None
+            os.makedirs(vmdk_dir)
+
+            # 只拷贝ovf和vmdk文件，进度按文件大小加权汇总
+            nfs = NFSInterface(src_vm_nfs_path)
+            file_size_map = {
+                single_file: nfs.getsize(single_file)
+                for single_file in nfs.listdirs("")
+                if single_file.endswith("ovf") or single_file.endswith("vmdk")
+            }
+
+            self.vmdk_path_list = list()
+            self.vmdk_uri_map = dict()
+            if config.migration.upload_image_stream_convert:
+                for single_file in list(file_size_map):
+                    if single_file.endswith("vmdk") and self._is_sparse_vmdk(nfs, single_file):
+                        vmdk_path = os.path.join(vmdk_dir, single_file)
+                        self.vmdk_path_list.append(vmdk_path)
+                        self.vmdk_uri_map[vmdk_path] = self._gen_nfs_source_info(
+                            vmdk_path, posixpath.join(src_vm_nfs_path, single_file), file_size_map.pop(single_file)
+                        )
+
+            progress_reporter = ProgressReporter(
+                self.vm_session,
+                MigrateStep.UPLOAD_IMAGE.value,
+                MigrateProcess.START_UPLOAD_IMAGE_PROCESS.value,
+                MigrateProcess.END_UPLOAD_IMAGE_PROCESS.value,
+                total_bytes=sum(file_size_map.values()),
+                weights={single_file: file_size or 1 for single_file, file_size in file_size_map.items()},
+                interval=config.migration.progress_report_interval,
+            )
+
+            for single_file in file_size_map:
+                if single_file.endswith("ovf"):
+                    self.ovf_path = os.path.join(self.vm_session.upload_dir, single_file)
+                    local_file_path = self.ovf_path
+                else:
+                    local_file_path = os.path.join(vmdk_dir, single_file)
+                    self.vmdk_path_list.append(local_file_path)
+
+                def on_progress(copied_size, total_size, part=single_file):
+                    progress_reporter.update(copied_size * 100 / total_size, part)
+
+                copy_nfs_file(
+                    posixpath.join(src_vm_nfs_path, single_file),
+                    local_file_path,
+                    timeout=config.migration.upload_image_timeout,
+                    on_progress=on_progress,
+                )
+                progress_reporter.update(100, single_file)
+        except Exception as e:
+            self.vm_session.update_detail_migrate_status(
+                dict(
+                    err_code=ErrorCode.UPLOAD_IMAGE_ERROR_COMMON.value,
+                    err_msg=ErrorMsg.UPLOAD_IMAGE_ERROR_COMMON.value.zh,
+                )
+            )
+
+            log_msg = f"upload image failed, session id: {self.vm_session.session_id}, error reason: {str(e)}"
+            logger.error(log_msg)
+            raise Exception(log_msg)
+
+        # 更新详细的迁移状态信息
+        end_status = RunningDetailMigrateStatus.END_UPLOAD_IMAGE_DETAIL_STATUS.copy()
+        end_status["step"]["end_time"] = TimeTool.get_now_datetime_str()
+        self.vm_session.update_detail_migrate_status(end_status)
+
+        # 汇总数据
+        end_time = datetime.datetime.now()
+        total_seconds = (end_time - start_time).total_seconds()
+        time_strftime = str(datetime.timedelta(seconds=total_seconds))
+        total_size_mb = sum(file_size_map.values()) / 1024 / 1024
+        upload_speed = total_size_mb / total_seconds  # 单位：MB/s
+        logger.info(
+            f"upload image end, session id: {self.vm_session.session_id}, cost time: {time_strftime}, total size: {total_size_mb}MB, "
+            f"upload speed: {upload_speed}MB/s, ovf path: {self.ovf_path}, vmdk path list: {self.vmdk_path_list}, "
+            f"stream convert vmdk: {list(self.vmdk_uri_map)}"
+        )
+
+    @staticmethod
+    def _is_sparse_vmdk(nfs, path):
+        """单文件的sparse vmdk（monolithicSparse、streamOptimized）才能直接读取，描述文件引用的extent仍需拷贝到本地"""
+        with nfs.open(path, "rb") as nfs_file:
+            return nfs_file.pread(0, len(VMDK_SPARSE_MAGIC)) == VMDK_SPARSE_MAGIC
+
+    @staticmethod
+    def _gen_nfs_source_info(vmdk_path, nfs_file_path, size):
+        """流式转换的源镜像信息，socket路径由vmdk路径确定，续迁时重新发布的NBD导出地址不变
+        Note:unix socket的路径长度有限，放在锁目录下并以哈希命名
+        """
+        socket_path = os.path.join(
+            config.deal_image_file_lock_base_dir_full, f"nbd-{hashlib.sha1(vmdk_path.encode('utf-8')).hexdigest()[:16]}.sock"
+        )
+        return dict(
+            uri=UPLOAD_IMAGE_NBD_SOURCE_URI_TEMPLATE.format(socket_path=socket_path),
+            nfs_file_path=nfs_file_path,
+            socket_path=socket_path,
+            size=size,
+        )
+
+    @contextlib.contextmanager
+    def _serve_nfs_sources(self, vmdk_path_list):
+        """发布流式转换的源镜像，退出时停止"""
+        try:
+            for vmdk_path in vmdk_path_list:
+                source_info = self.vmdk_uri_map.get(vmdk_path)
+                if not source_info or vmdk_path in self.nbd_export_map:
+                    continue
+                nbd_export = NBDExport(
+                    NFSSourceReader(source_info["nfs_file_path"]),
+                    source_info["socket_path"],
+                    concurrency=config.migration.upload_image_concurrency,
+                )
+                nbd_export.start()
+                self.nbd_export_map[vmdk_path] = nbd_export
+            yield
+        finally:
+            for nbd_export in self.nbd_export_map.values():
+                nbd_export.stop()
+            self.nbd_export_map.clear()
+
+    def _convert_image(self):
+        """转换镜像，流式转换时qemu-img经NBD导出直接读取NFS上的vmdk"""
+        with self._serve_nfs_sources(list(self.vmdk_uri_map)):
+            super(UploadImageMigration, self)._convert_image()
+
+    def _inspect_src_disk(self, disk_info):
+        """检查源镜像的分区，流式转换时直接读取NFS上的vmdk"""
+        nbd_export = self.nbd_export_map.get(disk_info["vmdk_path"])
+        if not nbd_export:
+            return super(UploadImageMigration, self)._inspect_src_disk(disk_info)
+        with ImageTool.open_image(disk_info["vmdk_path"], source=nbd_export.source_reader) as reader:
+            return PartitionTool.inspect_disk(reader)
+
+    def cover_image(self):
+        """覆盖镜像，数据盘从NFS上的vmdk直接转换到目标卷时，需要再次发布NBD导出"""
+        vmdk_path_list = [
+            disk_info["vmdk_path"] for disk_info in self.vm_session.dst_vm_disk if disk_info.get("direct_convert")
+        ]
+        with self._serve_nfs_sources(vmdk_path_list):
+            super(UploadImageMigration, self).cover_image()
+
+
+class DeltaSyncMigration(ExportImageMigration):
+    """增量同步模式对应的迁移器
+    源虚拟机运行期间完成基线拷贝并多轮同步增量，只在最后一轮前关闭源虚拟机，
+    同步完成后本地的OVF和vmdk与按硬盘导出的结果一致，后续步骤复用导出镜像模式的流程
+    """
+
+    migrate_pattern = MigratePattern.DELTA_SYNC.value
+    checkpoint_attrs = ExportImageMigration.checkpoint_attrs + ("change_id_map",)
+
+    def __init__(self, vm_session):
+        super(DeltaSyncMigration, self).__init__(vm_session)
+        # 各硬盘最近一次同步到的变更标识，key为vmdk路径，续迁时从该标识继续同步
+        self.change_id_map = dict()
+
+    def _export(self):
+        """同步硬盘数据，返回同步的总大小
+        1.ovftool只导出OVF描述文件，不关闭源虚拟机
+        2.基线拷贝：源虚拟机运行期间拷贝各硬盘全部已分配的区间
+        3.增量同步：拷贝上一轮以来变化的区间，本轮变化量不超过delta_sync_final_threshold_mb或达到delta_sync_max_rounds时结束
+        4.最终同步：关闭源虚拟机，拷贝最后一轮增量，停机时间只包含这一轮
+        5.生成vmdk描述文件和mf清单
+        """
+        vmdk_dir = os.path.join(self.vm_session.export_dir, self.vm_session.dst_vm_name)
+        os.makedirs(vmdk_dir, exist_ok=True)
+
+        # 读取器不可用时（名称错误、无法连接源平台）在导出前失败
+        delta_reader = get_delta_reader(config.migration.delta_sync_reader, self.vm_session)
+        try:
+            # 1.只导出OVF描述文件
+            ovf_path = self._export_ovf(vmdk_dir)
+            src_vm_disk_list = [
+                dict(src_vm_disk, vmdk_path=os.path.join(vmdk_dir, src_vm_disk["vmdk_name"]))
+                for src_vm_disk in self._relate_src_vm_disk_to_ovf_file(ovf_path)
+            ]
+
+            # 2.基线拷贝，续迁时已完成基线拷贝的硬盘直接同步增量
+            progress_reporter = ProgressReporter(
+                self.vm_session,
+                MigrateStep.EXPORT_IMAGE.value,
+                MigrateProcess.START_EXPORT_IMAGE_PROCESS.value,
+                MigrateProcess.END_EXPORT_IMAGE_PROCESS.value,
+                weights={src_vm_disk["vmdk_name"]: src_vm_disk.get("capacity") or 1 for src_vm_disk in src_vm_disk_list},
+                interval=config.migration.progress_report_interval,
+            )
+            sync_size = self._sync_disks(delta_reader, src_vm_disk_list, "baseline", progress_reporter)
+
+            # 3.增量同步，直到一轮的变化量足够小
+            final_threshold = config.migration.delta_sync_final_threshold_mb * 1024 * 1024
+            for round_index in range(1, config.migration.delta_sync_max_rounds + 1):
+                round_size = self._sync_disks(delta_reader, src_vm_disk_list, f"round {round_index}")
+                sync_size += round_size
+                if round_size <= final_threshold:
+                    break
+
+            # 4.最终同步，关闭源虚拟机后硬盘数据不再变化
+            logger.info(
+                f"stop source vm before final sync, session id: {self.vm_session.session_id}, src vm name: {self.vm_session.src_vm_name}"
+            )
+            delta_reader.stop_source()
+            sync_size += self._sync_disks(delta_reader, src_vm_disk_list, "final")
+        finally:
+            delta_reader.close()
+
+        # 5.生成vmdk描述文件和mf清单
+        # Note:数据文件在本地由同步的区间拼成，最终同步后数据不再变化，此时再计算哈希值，各硬盘并行计算
+        manifest = {os.path.basename(ovf_path): ("sha256", FileTool.calculate_sha256(ovf_path))}
+        flat_path_list = [self._get_flat_path(src_vm_disk["vmdk_path"]) for src_vm_disk in src_vm_disk_list]
+        with ThreadPoolExecutor(max_workers=max(1, len(flat_path_list))) as executor:
+            flat_sha256_list = list(executor.map(
+                lambda flat_path: FileTool.calculate_sha256(flat_path, buffer_size=1024 * 1024), flat_path_list
+            ))
+        for src_vm_disk, flat_path, flat_sha256 in zip(src_vm_disk_list, flat_path_list, flat_sha256_list):
+            vmdk_path = src_vm_disk["vmdk_path"]
+            with open(vmdk_path, "w", encoding="utf-8") as f:
+                f.write(VmdkTool.gen_flat_descriptor(os.path.basename(flat_path), os.path.getsize(flat_path)))
+            manifest[src_vm_disk["vmdk_name"]] = ("sha256", FileTool.calculate_sha256(vmdk_path))
+            manifest[os.path.basename(flat_path)] = ("sha256", flat_sha256)
+
+        self.mf_path = os.path.join(vmdk_dir, f"{self.vm_session.dst_vm_name}.mf")
+        FileTool.write_manifest_file(self.mf_path, manifest)
+        self.mf_data = manifest
+        self.ovf_path = ovf_path
+        self.vmdk_path_list = [src_vm_disk["vmdk_path"] for src_vm_disk in src_vm_disk_list]
+        logger.info(
+            f"delta sync end, session id: {self.vm_session.session_id}, delta reader: {config.migration.delta_sync_reader}, "
+            f"sync size: {sync_size}B, change id map: {self.change_id_map}, mf path: {self.mf_path}"
+        )
+        return sync_size
+
+    @staticmethod
+    def _get_flat_path(vmdk_path):
+        """vmdk描述文件对应的数据文件，eg: "xxxx-disk1.vmdk" -> "xxxx-disk1-flat.vmdk" """
+        return f"{os.path.splitext(vmdk_path)[0]}-flat.vmdk"
+
+    def _sync_disks(self, delta_reader, src_vm_disk_list, sync_name, progress_reporter=None):
+        """并行同步各硬盘，返回本轮同步的总大小
+        每块硬盘同步完成后记录变更标识并保存断点，续迁时已同步的数据无需重新拷贝
+        """
+        logger.info(
+            f"sync disks start, session id: {self.vm_session.session_id}, sync name: {sync_name}, change id map: {self.change_id_map}"
+        )
+        start_time = datetime.datetime.now()
+        delta_reader.begin_round()
+        concurrency = max(1, min(config.migration.export_image_disk_concurrency, len(src_vm_disk_list)))
+        failed_disk_reason = dict()
+        sync_size = 0
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            future_map = dict()
+            for src_vm_disk in src_vm_disk_list:
+                future = executor.submit(self._sync_disk, delta_reader, src_vm_disk, progress_reporter)
+                future_map[future] = src_vm_disk
+
+            for future in as_completed(future_map):
+                src_vm_disk = future_map[future]
+                try:
+                    disk_sync_size, change_id = future.result()
+                    sync_size += disk_sync_size
+                    self.change_id_map[src_vm_disk["vmdk_path"]] = change_id
+                    self.checkpoint.update_state(self._dump_checkpoint_state())
+                except Exception as e:
+                    failed_disk_reason[src_vm_disk["vmdk_name"]] = str(e)
+
+                    # 已经失败，则取消尚未开始的同步，已同步的部分保留，重新迁移时继续
+                    for pending_future in future_map:
+                        pending_future.cancel()
+
+        if failed_disk_reason:
+            self.vm_session.update_detail_migrate_status(
+                dict(
+                    err_code=ErrorCode.EXPORT_IMAGE_ERROR_SYNC_DISK_FAILED.value,
+                    err_msg=ErrorMsg.EXPORT_IMAGE_ERROR_SYNC_DISK_FAILED.value.zh,
+                )
+            )
+
+            log_msg = f"sync disks failed, session id: {self.vm_session.session_id}, sync name: {sync_name}, failed disk count: {len(failed_disk_reason)}, error reason: {failed_disk_reason}"
+            logger.error(log_msg)
+            raise Exception(log_msg)
+
+        total_seconds = (datetime.datetime.now() - start_time).total_seconds()
+        logger.info(
+            f"sync disks end, session id: {self.vm_session.session_id}, sync name: {sync_name}, sync size: {sync_size}B, "
+            f"cost time: {datetime.timedelta(seconds=total_seconds)}"
+        )
+        return sync_size
+
+    def _sync_disk(self, delta_reader, src_vm_disk, progress_reporter=None):
+        """同步单个硬盘，返回同步的大小和最新的变更标识
+        没有变更标识或变更标识已失效时进行基线拷贝，重新创建本地文件，避免残留源硬盘上已释放的数据
+        """
+        vmdk_name = src_vm_disk["vmdk_name"]
+        flat_path = self._get_flat_path(src_vm_disk["vmdk_path"])
+        change_id = self.change_id_map.get(src_vm_disk["vmdk_path"]) if os.path.isfile(flat_path) else None
+
+        areas = None
+        if change_id is not None:
+            try:
+                areas, new_change_id = delta_reader.query_changed_areas(src_vm_disk, change_id)
+            except InvalidChangeIdError as e:
+                logger.warning(
+                    f"change id is invalid, sync disk from baseline, session id: {self.vm_session.session_id}, vmdk name: {vmdk_name}, error reason: {e}"
+                )
+        if areas is None:
+            open(flat_path, "wb").close()
+            areas, new_change_id = delta_reader.query_changed_areas(src_vm_disk, DeltaReader.ALL_CHANGE_ID)
+
+        sync_size = sum(area["length"] for area in areas)
+        done_size = 0
+        with open(flat_path, "r+b") as f:
+            # 源硬盘扩容后本地文件随之扩大，新增部分未写入的数据为空洞
+            disk_size = delta_reader.get_disk_size(src_vm_disk)
+            if os.fstat(f.fileno()).st_size < disk_size:
+                f.truncate(disk_size)
+
+            for area in areas:
+                offset, end = area["start"], area["start"] + area["length"]
+                while offset < end:
+                    data = delta_reader.read(src_vm_disk, offset, min(DeltaReader.READ_SIZE, end - offset))
+                    if not data:
+                        raise Exception(f"read disk failed, unexpected end of disk, vmdk name: {vmdk_name}, offset: {offset}")
+                    os.pwrite(f.fileno(), data, offset)
+                    offset += len(data)
+                    done_size += len(data)
+                    if progress_reporter:
+                        progress_reporter.update(done_size * 100 / sync_size, vmdk_name)
+
+        if progress_reporter:
+            progress_reporter.update(100, vmdk_name)
+        return sync_size, new_change_id
+
+    def _uncompress_image(self):
+        """增量同步时没有OVA，无需解压"""
+        return
@@ -0,0 +1,664 @@
+# -*- coding: utf-8 -*-
+
+"""
+功能：迁移调度
+
+从等待队列中拉取排队中/重试排队中的迁移会话，按优先级在独立的子进程中并发执行迁移
+1.setting.max_migrating_num     本节点同时运行的迁移会话数上限
+2.setting.concurrency_migrate   每轮调度最多启动的迁移会话数，避免同一时刻集中导出冲击源平台
+3.setting.vm_max_migrate_timeout 单个迁移会话的最长运行时间，超时则强制终止
+4.setting.admission_*           准入控制，磁盘空间、导出带宽或CPU负载不足时会话继续排队
+"""
+
+import heapq
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import sys
+import threading
+
+from core.logger import logger
+from core.config import config
+
+from clients.redis_cli import RedisClient
+from tools.time_tool import TimeTool
+
+from constants.enum import MigrateStatus
+
+from error import ErrorMsg, ErrorCode
+
+from status_writer import status_writer
+from vm_session import VMSession
+
+
+def run_migrate_process(vm_session_info):
+    """子进程入口：执行单个虚拟机的迁移，通过退出码返回迁移结果"""
+    vm_session = VMSession(vm_session_info["session_id"])
+    vm_session.info = vm_session_info
+    try:
+        is_success = vm_session.migrate()
+    finally:
+        # multiprocessing的子进程退出时不执行atexit，须主动写入剩余的状态
+        status_writer.close()
+    sys.exit(0 if is_success else 1)
+
+
+class MemorySessionQueue:
+    """内存中的迁移会话等待队列
+    priority越大越优先，相同优先级先进先出
+    """
+
+    def __init__(self):
+        self._heap = list()
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        # session_id和排队序号的映射，重新排队时保持原有的先后顺序
+        self._order_map = dict()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._heap)
+
+    def put(self, vm_session_info):
+        """放入等待队列，只接受排队中/重试排队中的会话"""
+        status = vm_session_info.get("status")
+        if status not in MigrateStatus.list_wait_migrate_status():
+            raise ValueError(
+                f"vm session status invalid, session id: {vm_session_info['session_id']}, status: {status}"
+            )
+
+        priority = vm_session_info.get("priority", 0)
+        session_id = vm_session_info["session_id"]
+        with self._lock:
+            order = self._order_map.setdefault(session_id, next(self._counter))
+            heapq.heappush(self._heap, (-priority, order, vm_session_info))
+
+    def claim(self, count):
+        """取出至多count个优先级最高的会话"""
+        claimed = list()
+        with self._lock:
+            while self._heap and len(claimed) < count:
+                claimed.append(heapq.heappop(self._heap)[-1])
+        return claimed
+
+    def heartbeat(self, session_id):
+        """会话运行中的心跳，返回本节点是否仍持有会话，内存队列只在本节点使用，始终持有"""
+        return True
+
+    def report_capacity(self, running_num, max_migrating_num):
+        """上报本节点的容量，内存队列只在本节点使用，无需处理"""
+
+    def ack(self, session_id):
+        """会话运行结束"""
+        with self._lock:
+            self._order_map.pop(session_id, None)
+
+    def requeue(self, vm_session_info, status=None):
+        """会话重新排队，未指定status时保持会话原有的排队状态"""
+        if status is not None:
+            vm_session_info["status"] = status
+        self.put(vm_session_info)
+
+
+class RedisSessionQueue:
+    """Redis中的迁移会话等待队列，由多个节点共享，排序规则与MemorySessionQueue相同
+    1.等待  有序集合session_queue，分值由优先级和排队序号组成，会话信息以JSON保存在哈希session_info
+    2.领取  领取的会话移入有序集合session_claimed，分值为可见性超时的截止时间，领取节点记录在哈希session_owner；
+            运行期间领取节点通过heartbeat延长截止时间，节点宕机后截止时间过期，会话在下一次领取前重新放回等待队列
+    3.容量  各节点每轮调度将运行数和并发上限上报到哈希node_<key_suffix_auto_node>，由list_node_capacity汇总
+    Note:修改均通过WATCH/MULTI事务完成，不依赖Lua脚本，可使用本地的redis-server或进程内的替身（例如fakeredis）验证
+    """
+
+    # 分值中优先级的权重，排队序号须小于该值
+    PRIORITY_WEIGHT = 10 ** 12
+
+    def __init__(self, node_id=None, visibility_timeout=None, client=None):
+        self.node_id = node_id or config.setting.session_queue_node_id or socket.gethostname()
+        self.visibility_timeout = visibility_timeout or config.setting.session_queue_visibility_timeout
+        self.client = client or RedisClient.get_client()
+        self.queue_key = RedisClient.get_key("session", "queue")
+        self.info_key = RedisClient.get_key("session", "info")
+        self.order_key = RedisClient.get_key("session", "order")
+        self.counter_key = RedisClient.get_key("session", "counter")
+        self.claimed_key = RedisClient.get_key("session", "claimed")
+        self.owner_key = RedisClient.get_key("session", "owner")
+        self.node_key = RedisClient.get_key("node", config.redis.key_suffix_auto_node)
+
+    def __len__(self):
+        """等待中和已领取、尚未结束的会话数，宕机节点领取的会话过期后仍需重新调度"""
+        pipeline = self.client.pipeline(transaction=False)
+        pipeline.zcard(self.queue_key)
+        pipeline.zcard(self.claimed_key)
+        return sum(pipeline.execute())
+
+    def _get_now(self):
+        """以Redis服务端的时间为准，不受各节点时钟偏差影响"""
+        seconds, microseconds = self.client.time()
+        return seconds + microseconds / 1000000
+
+    def _get_order(self, session_id):
+        """获取会话的排队序号，重新排队时保持原有的先后顺序"""
+        order = self.client.hget(self.order_key, session_id)
+        if order is None:
+            self.client.hsetnx(self.order_key, session_id, self.client.incr(self.counter_key))
+            order = self.client.hget(self.order_key, session_id)
+        return int(order)
+
+    def _get_score(self, vm_session_info, order):
+        return -vm_session_info.get("priority", 0) * self.PRIORITY_WEIGHT + order
+
+    def put(self, vm_session_info):
+        """放入等待队列，只接受排队中/重试排队中的会话，已被节点领取的会话不重复放入"""
+        self._enqueue(vm_session_info, release_claim=False)
+
+    def _enqueue(self, vm_session_info, release_claim):
+        status = vm_session_info.get("status")
+        if status not in MigrateStatus.list_wait_migrate_status():
+            raise ValueError(
+                f"vm session status invalid, session id: {vm_session_info['session_id']}, status: {status}"
+            )
+
+        session_id = vm_session_info["session_id"]
+        score = self._get_score(vm_session_info, self._get_order(session_id))
+        data = json.dumps(vm_session_info, ensure_ascii=False, default=str)
+
+        def enqueue(pipeline):
+            owner = pipeline.hget(self.owner_key, session_id)
+            if owner is not None and (not release_claim or owner != self.node_id):
+                return owner
+            pipeline.multi()
+            pipeline.zrem(self.claimed_key, session_id)
+            pipeline.hdel(self.owner_key, session_id)
+            pipeline.hset(self.info_key, session_id, data)
+            pipeline.zadd(self.queue_key, {session_id: score})
+            return None
+
+        owner = self.client.transaction(enqueue, self.owner_key, value_from_callable=True)
+        if owner is not None:
+            logger.warning(f"vm session is claimed by other node, session id: {session_id}, node id: {owner}")
+
+    def claim(self, count):
+        """领取至多count个优先级最高的会话"""
+        self._requeue_expired()
+        now = self._get_now()
+
+        def claim(pipeline):
+            session_id_list = pipeline.zrange(self.queue_key, 0, count - 1)
+            if not session_id_list:
+                return list()
+            info_list = pipeline.hmget(self.info_key, session_id_list)
+            deadline = now + self.visibility_timeout
+            pipeline.multi()
+            pipeline.zrem(self.queue_key, *session_id_list)
+            pipeline.zadd(self.claimed_key, {session_id: deadline for session_id in session_id_list})
+            pipeline.hset(self.owner_key, mapping={session_id: self.node_id for session_id in session_id_list})
+            return [json.loads(info) for info in info_list if info]
+
+        return self.client.transaction(claim, self.queue_key, self.owner_key, value_from_callable=True)
+
+    def _requeue_expired(self):
+        """将可见性超时已过期（领取节点宕机或失联）的会话重新放回等待队列"""
+        now = self._get_now()
+
+        def requeue_expired(pipeline):
+            session_id_list = pipeline.zrangebyscore(self.claimed_key, "-inf", now)
+            if not session_id_list:
+                return list()
+            owner_list = pipeline.hmget(self.owner_key, session_id_list)
+            info_list = pipeline.hmget(self.info_key, session_id_list)
+            order_list = pipeline.hmget(self.order_key, session_id_list)
+            pipeline.multi()
+            pipeline.zrem(self.claimed_key, *session_id_list)
+            pipeline.hdel(self.owner_key, *session_id_list)
+            for session_id, info, order in zip(session_id_list, info_list, order_list):
+                if not info:
+                    continue
+                vm_session_info = json.loads(info)
+                vm_session_info["status"] = MigrateStatus.PENDING.value
+                pipeline.hset(self.info_key, session_id, json.dumps(vm_session_info, ensure_ascii=False))
+                pipeline.zadd(self.queue_key, {session_id: self._get_score(vm_session_info, int(order or 0))})
+            return list(zip(session_id_list, owner_list))
+
+        expired_list = self.client.transaction(
+            requeue_expired, self.claimed_key, self.owner_key, value_from_callable=True
+        )
+        for session_id, owner in expired_list:
+            logger.warning(
+                f"vm session claim expired and requeued, session id: {session_id}, node id: {owner}, "
+                f"visibility timeout: {self.visibility_timeout}"
+            )
+
+    def heartbeat(self, session_id):
+        """会话运行中的心跳，延长可见性超时的截止时间，返回本节点是否仍持有会话
+        领取已过期并被重新排队或由其他节点领取时返回False，本节点须停止运行该会话
+        """
+        deadline = self._get_now() + self.visibility_timeout
+
+        def heartbeat(pipeline):
+            owner = pipeline.hget(self.owner_key, session_id)
+            if owner != self.node_id:
+                return owner
+            pipeline.multi()
+            pipeline.zadd(self.claimed_key, {session_id: deadline}, xx=True)
+            return owner
+
+        owner = self.client.transaction(heartbeat, self.owner_key, value_from_callable=True)
+        if owner != self.node_id:
+            logger.warning(f"vm session claim lost, session id: {session_id}, node id: {self.node_id}, owner: {owner}")
+            return False
+        return True
+
+    def ack(self, session_id):
+        """会话运行结束，删除会话的排队信息；会话已过期并被其他节点领取时不做处理"""
+
+        def ack(pipeline):
+            owner = pipeline.hget(self.owner_key, session_id)
+            if owner != self.node_id:
+                return owner
+            pipeline.multi()
+            pipeline.zrem(self.claimed_key, session_id)
+            pipeline.hdel(self.owner_key, session_id)
+            pipeline.hdel(self.info_key, session_id)
+            pipeline.hdel(self.order_key, session_id)
+            return owner
+
+        owner = self.client.transaction(ack, self.owner_key, value_from_callable=True)
+        if owner != self.node_id:
+            logger.warning(f"vm session claim lost, session id: {session_id}, node id: {self.node_id}, owner: {owner}")
+
+    def requeue(self, vm_session_info, status=None):
+        """会话重新排队，释放本节点的领取，未指定status时保持会话原有的排队状态"""
+        if status is not None:
+            vm_session_info["status"] = status
+        self._enqueue(vm_session_info, release_claim=True)
+
+    def report_capacity(self, running_num, max_migrating_num):
+        """上报本节点的运行数和并发上限"""
+        capacity = dict(
+            running_num=running_num,
+            max_migrating_num=max_migrating_num,
+            free_num=max(0, max_migrating_num - running_num),
+            update_time=self._get_now(),
+        )
+        self.client.hset(self.node_key, self.node_id, json.dumps(capacity))
+
+    def list_node_capacity(self):
+        """汇总各节点上报的容量，超过可见性超时未上报的节点视为已下线，不计入"""
+        now = self._get_now()
+        capacity_map = dict()
+        for node_id, data in self.client.hgetall(self.node_key).items():
+            capacity = json.loads(data)
+            if now - capacity["update_time"] <= self.visibility_timeout:
+                capacity_map[node_id] = capacity
+        return capacity_map
+
+
+# 可选的等待队列，key为setting.session_queue
+SESSION_QUEUE_MAP = dict(
+    memory=MemorySessionQueue,
+    redis=RedisSessionQueue,
+)
+
+
+def get_session_queue(name):
+    """按名称创建等待队列"""
+    if name not in SESSION_QUEUE_MAP:
+        raise Exception(f"unsupported session queue: {name}, supported session queues: {list(SESSION_QUEUE_MAP)}")
+    return SESSION_QUEUE_MAP[name]()
+
+
+class MigrateAdmission:
+    """迁移准入控制
+    依据会话预估所需的暂存空间、导出带宽和本节点实时的CPU负载，判断会话能否立即开始迁移
+    """
+
+    GB = 1024 * 1024 * 1024
+
+    def __init__(self, data_dir=None):
+        self.data_dir = data_dir or config.export_image_dst_base_dir_full
+
+    @classmethod
+    def estimate_disk_bytes(cls, vm_session_info):
+        """预估迁移所需的暂存空间，单位B
+        精简置备的硬盘按admission_thin_provisioned_ratio估算实际数据量
+        非流式转换时OVA、解压后的vmdk、qcow2同时存在，约为数据量的3倍，流式转换时约为2倍
+        """
+        data_bytes = 0
+        for disk in vm_session_info.get("src_vm_disk") or list():
+            capacity_bytes = disk.get("capacity", 0) * cls.GB
+            if disk.get("thin_provisioned"):
+                capacity_bytes *= config.setting.admission_thin_provisioned_ratio
+            data_bytes += capacity_bytes
+
+        factor = 2 if config.migration.deal_image_stream_convert else 3
+        return int(data_bytes * factor)
+
+    @staticmethod
+    def get_dir_size(dir_path):
+        """获取目录下所有文件的大小之和，单位B"""
+        total_size = 0
+        for root, _, files in os.walk(dir_path):
+            for file_name in files:
+                try:
+                    total_size += os.path.getsize(os.path.join(root, file_name))
+                except OSError:
+                    continue
+        return total_size
+
+    def _get_disk_usage(self):
+        """获取暂存目录所在文件系统的用量，目录不存在时取最近的已存在的上级目录"""
+        path = self.data_dir
+        while not os.path.exists(path):
+            path = os.path.dirname(path)
+        return shutil.disk_usage(path)
+
+    def get_free_disk_bytes(self):
+        """获取暂存目录所在文件系统的剩余空间"""
+        return self._get_disk_usage().free
+
+    def get_reserved_disk_bytes(self, running_session_info_list):
+        """运行中的会话尚未写入、但即将占用的暂存空间"""
+        reserved_bytes = 0
+        for vm_session_info in running_session_info_list:
+            export_dir = vm_session_info.get("extra", dict()).get("export_dir", "")
+            used_bytes = self.get_dir_size(export_dir) if export_dir else 0
+            reserved_bytes += max(0, self.estimate_disk_bytes(vm_session_info) - used_bytes)
+        return reserved_bytes
+
+    @staticmethod
+    def get_load_ratio():
+        """获取本节点1分钟平均负载和CPU核数的比值"""
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+
+    def admit(self, vm_session_info, running_session_info_list):
+        """判断会话能否开始迁移，返回(是否准入, 原因)"""
+        is_admitted, reason = self.admit_node(running_session_info_list)
+        if not is_admitted:
+            return is_admitted, reason
+        return self.admit_session(vm_session_info, running_session_info_list)
+
+    def admit_node(self, running_session_info_list):
+        """判断本节点能否再启动一个会话，与会话本身无关，不满足时任何会话都无法启动，返回(是否准入, 原因)"""
+        if not config.setting.admission_enabled:
+            return True, ""
+
+        # 1.导出带宽
+        uplink_bandwidth = config.setting.admission_uplink_bandwidth_mbps
+        session_bandwidth = config.setting.admission_export_bandwidth_per_session_mbps
+        if uplink_bandwidth:
+            used_bandwidth = session_bandwidth * len(running_session_info_list)
+            if used_bandwidth + session_bandwidth > uplink_bandwidth:
+                return False, f"uplink bandwidth not enough, used: {used_bandwidth}Mbps, uplink: {uplink_bandwidth}Mbps"
+
+        # 2.CPU负载
+        load_ratio = self.get_load_ratio()
+        if load_ratio > config.setting.admission_max_load_ratio:
+            return False, f"cpu load too high, load ratio: {load_ratio:.2f}"
+
+        return True, ""
+
+    def admit_session(self, vm_session_info, running_session_info_list):
+        """判断本节点当前的暂存空间能否容纳会话，返回(是否准入, 原因)"""
+        if not config.setting.admission_enabled:
+            return True, ""
+
+        need_bytes = self.estimate_disk_bytes(vm_session_info)
+        available_bytes = (
+            self.get_free_disk_bytes()
+            - self.get_reserved_disk_bytes(running_session_info_list)
+            - config.setting.admission_disk_reserved_gb * self.GB
+        )
+        if need_bytes > available_bytes:
+            return False, f"disk space not enough, need: {need_bytes}B, available: {available_bytes}B"
+        return True, ""
+
+    def check_feasible(self, vm_session_info):
+        """判断会话在没有其他会话运行时能否被准入，暂存空间超出文件系统的总容量（扣除预留）时永远无法迁移，返回(是否可行, 原因)"""
+        if not config.setting.admission_enabled:
+            return True, ""
+
+        need_bytes = self.estimate_disk_bytes(vm_session_info)
+        usable_bytes = self._get_disk_usage().total - config.setting.admission_disk_reserved_gb * self.GB
+        if need_bytes > usable_bytes:
+            return False, f"disk space never enough, need: {need_bytes}B, usable: {usable_bytes}B"
+        return True, ""
+
+
+class MigrateScheduler:
+    """迁移调度器"""
+
+    def __init__(self, session_queue, max_migrating_num=None, concurrency_migrate=None,
+                 migrate_timeout=None, poll_interval=1, admission=None):
+        self.session_queue = session_queue
+        self.admission = admission or MigrateAdmission()
+        self.max_migrating_num = max_migrating_num or config.setting.max_migrating_num
+        self.concurrency_migrate = concurrency_migrate or config.setting.concurrency_migrate
+        self.migrate_timeout = migrate_timeout or config.setting.vm_max_migrate_timeout
+        self.poll_interval = poll_interval
+
+        # session_id和运行中的迁移信息的映射
+        # example:
+        # {
+        #   "session-xxxx": {"process": <Process>, "start_time": 1700000000, "vm_session": <VMSession>}
+        # }
+        self.running = dict()
+        self._stop_event = threading.Event()
+
+    @property
+    def running_num(self):
+        return len(self.running)
+
+    def submit(self, vm_session_info):
+        """提交迁移会话到等待队列"""
+        if vm_session_info.get("status") != MigrateStatus.PENDING.value:
+            vm_session_info["status"] = MigrateStatus.QUEUING.value
+        self.session_queue.put(vm_session_info)
+        logger.info(
+            f"vm session submitted, session id: {vm_session_info['session_id']}, priority: {vm_session_info.get('priority', 0)}"
+        )
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run_forever(self):
+        """持续调度，直到调用stop"""
+        logger.info(
+            f"migrate scheduler start, max migrating num: {self.max_migrating_num}, "
+            f"concurrency migrate: {self.concurrency_migrate}, migrate timeout: {self.migrate_timeout}"
+        )
+        try:
+            while not self._stop_event.is_set():
+                self._run_once_safely()
+                self._stop_event.wait(self.poll_interval)
+        finally:
+            self._terminate_all()
+            logger.info("migrate scheduler stop")
+
+    def run_until_empty(self):
+        """调度直到等待队列为空且没有运行中的会话，适用于一次性发起的迁移批次"""
+        try:
+            while not self._stop_event.is_set():
+                if self._run_once_safely() and not self.running and not len(self.session_queue):
+                    break
+                self._stop_event.wait(self.poll_interval)
+        finally:
+            self._terminate_all()
+
+    def _run_once_safely(self):
+        """执行一轮调度，出错时（例如Redis暂时不可用）记录日志，等待下一轮重试，返回本轮是否成功"""
+        try:
+            self.run_once()
+            return True
+        except Exception as e:
+            logger.exception(f"migrate schedule failed, retry after {self.poll_interval}s, error reason: {e}")
+            return False
+
+    def run_once(self):
+        """执行一轮调度：回收结束/超时的会话，再按空闲的并发数启动新的会话"""
+        self._reap()
+        self._dispatch()
+        self.session_queue.report_capacity(self.running_num, self.max_migrating_num)
+
+    def _dispatch(self):
+        """启动新的迁移会话
+        暂存空间不足的会话暂不启动，继续领取优先级更低的会话，直到空闲的并发数用完或等待队列扫描完一遍，
+        避免容纳不下的高优先级会话阻塞能够启动的会话；本轮领取但未启动的会话最后按原有顺序重新排队
+        """
+        free_num = self.max_migrating_num - self.running_num
+        count = min(free_num, self.concurrency_migrate)
+        if count <= 0:
+            return
+
+        started_num = 0
+        held_list = list()
+        try:
+            while started_num < count:
+                claimed_list = self.session_queue.claim(count - started_num)
+                if not claimed_list:
+                    break
+                held_list.extend(claimed_list)
+
+                for vm_session_info in claimed_list:
+                    session_id = vm_session_info["session_id"]
+                    running_session_info_list = [
+                        running_info["vm_session"].info for running_info in self.running.values()
+                    ]
+                    # 带宽或负载不足时任何会话都无法启动，已领取的会话继续排队，等待下一轮调度
+                    is_admitted, reason = self.admission.admit_node(running_session_info_list)
+                    if not is_admitted:
+                        logger.debug(f"node not admitted, reason: {reason}")
+                        return
+
+                    is_feasible, reason = self.admission.check_feasible(vm_session_info)
+                    if not is_feasible:
+                        held_list.remove(vm_session_info)
+                        self._fail_infeasible(vm_session_info, reason)
+                        continue
+
+                    is_admitted, reason = self.admission.admit_session(vm_session_info, running_session_info_list)
+                    if not is_admitted:
+                        logger.debug(f"vm session not admitted, session id: {session_id}, reason: {reason}")
+                        continue
+
+                    held_list.remove(vm_session_info)
+                    self._start(vm_session_info)
+                    started_num += 1
+        finally:
+            for vm_session_info in held_list:
+                self.session_queue.requeue(vm_session_info)
+
+    def _fail_infeasible(self, vm_session_info, reason):
+        """会话在本节点永远无法准入，直接失败，不再排队"""
+        session_id = vm_session_info["session_id"]
+        vm_session = VMSession(session_id)
+        vm_session.info = vm_session_info
+        vm_session.update_detail_migrate_status(
+            dict(
+                status=MigrateStatus.FAILED.value,
+                err_code=ErrorCode.ERROR_DISPATCH_DISK_SPACE_NOT_ENOUGH.value,
+                err_msg=ErrorMsg.ERROR_DISPATCH_DISK_SPACE_NOT_ENOUGH.value.zh,
+            )
+        )
+        self.session_queue.ack(session_id)
+        logger.error(f"vm session can never be admitted, session id: {session_id}, reason: {reason}")
+
+    def _start(self, vm_session_info):
+        """在子进程中启动迁移会话"""
+        session_id = vm_session_info["session_id"]
+        vm_session = VMSession(session_id)
+        vm_session.info = vm_session_info
+        vm_session.update_detail_migrate_status(
+            dict(status=MigrateStatus.RUNNING.value, start_time=TimeTool.get_now_datetime())
+        )
+
+        process = multiprocessing.Process(
+            target=run_migrate_process, args=(vm_session_info,), name=session_id
+        )
+        process.start()
+        self.running[session_id] = dict(
+            process=process, start_time=TimeTool.get_now_timestamp(), vm_session=vm_session
+        )
+        logger.info(
+            f"vm session dispatched, session id: {session_id}, pid: {process.pid}, running num: {self.running_num}"
+        )
+
+    def _reap(self):
+        """回收已结束或超时的迁移会话"""
+        now = TimeTool.get_now_timestamp()
+        for session_id, running_info in list(self.running.items()):
+            process = running_info["process"]
+            vm_session = running_info["vm_session"]
+
+            if process.is_alive():
+                if not self.session_queue.heartbeat(session_id):
+                    # 领取已失效，会话由其他节点重新调度，本节点停止运行且不再更新会话状态
+                    self._terminate(process)
+                    del self.running[session_id]
+                    logger.warning(f"vm migrate stopped, claim lost, session id: {session_id}")
+                    continue
+                if now - running_info["start_time"] <= self.migrate_timeout:
+                    continue
+
+                # 迁移超时，强制终止
+                self._terminate(process)
+                vm_session.update_detail_migrate_status(
+                    dict(
+                        status=MigrateStatus.FAILED.value,
+                        err_code=ErrorCode.ERROR_DISPATCH_END_MIGRATE_TIMEOUT.value,
+                        err_msg=ErrorMsg.ERROR_DISPATCH_END_MIGRATE_TIMEOUT.value.zh,
+                    )
+                )
+                logger.error(
+                    f"vm migrate timeout, session id: {session_id}, timeout: {self.migrate_timeout}"
+                )
+            elif process.exitcode == 0:
+                vm_session.update_detail_migrate_status(dict(status=MigrateStatus.COMPLETED.value))
+                logger.info(f"vm migrate end, session id: {session_id}")
+            else:
+                vm_session.update_detail_migrate_status(dict(status=MigrateStatus.FAILED.value))
+                logger.error(
+                    f"vm migrate failed, session id: {session_id}, exit code: {process.exitcode}"
+                )
+
+            self.session_queue.ack(session_id)
+            del self.running[session_id]
+
+    @staticmethod
+    def _terminate(process, grace_seconds=10):
+        """终止迁移子进程，超过宽限时间仍未退出则强杀"""
+        process.terminate()
+        process.join(grace_seconds)
+        if process.is_alive():
+            process.kill()
+            process.join()
+
+    def _terminate_all(self):
+        """终止所有运行中的迁移会话，并重新排队"""
+        for session_id, running_info in list(self.running.items()):
+            self._terminate(running_info["process"])
+            try:
+                self.session_queue.requeue(running_info["vm_session"].info, MigrateStatus.PENDING.value)
+            except Exception as e:
+                # 等待队列不可用时，redis队列中的会话在可见性超时后由其他节点重新调度
+                logger.error(f"vm migrate interrupted, requeue failed, session id: {session_id}, error reason: {e}")
+                continue
+            logger.warning(f"vm migrate interrupted and requeued, session id: {session_id}")
+        self.running.clear()
+
+
+if __name__ == "__main__":
+    # 用法: python scheduler.py [wave.json]
+    # wave.json为迁移会话信息的列表，格式同main.py中的params，提交后调度直到全部结束
+    # 等待队列为redis时可不指定wave.json，作为工作节点持续领取其他节点提交的会话
+    scheduler = MigrateScheduler(get_session_queue(config.setting.session_queue))
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], encoding="utf-8") as f:
+            vm_session_info_list = json.load(f)
+        for info in vm_session_info_list:
+            scheduler.submit(info)
+        scheduler.run_until_empty()
+    else:
+        scheduler.run_forever()
@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+
+"""
+功能：源镜像读取器
+
+上传镜像模式的vmdk位于源虚拟机的NFS目录，原先需要整个拷贝到本地后再转换，或编译并预加载ld_nfs.so让qemu-img直接读取NFS路径
+读取器通过NFSInterface按偏移读取源镜像，再由NBDExport以只读NBD导出的形式发布在本地unix socket上，
+qemu-img使用nbd+unix地址直接读取，省去一次全量的本地写入，运行时也不再依赖gcc
+1.读取器    按偏移读取，线程安全，也可作为ImageTool.open_image的source直接检查源镜像的分区
+2.NBD导出   只实现qemu-img读取所需的最小协议子集：fixed newstyle握手、EXPORT_NAME/INFO/GO选项、READ/DISC请求和简单回复
+Note:vmdk的grain directory位于文件头部或尾部，需要随机读取，因此不能使用只能顺序读取的FIFO
+"""
+
+import abc
+import errno
+import os
+import posixpath
+import socket
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from core.logger import logger
+
+from clients.nfs_cli import NFSInterface
+from tools.time_tool import TimeTool
+
+
+class SourceReader(abc.ABC):
+    """读取器基类"""
+
+    def __init__(self):
+        self.size = 0
+
+    @abc.abstractmethod
+    def pread(self, offset, length):
+        """从指定偏移读取length字节，超出镜像大小的部分被截断"""
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class NFSSourceReader(SourceReader):
+    """读取NFS上的源镜像
+    libnfs的文件句柄不能被多个线程同时使用，每次读取借用一个空闲句柄，没有空闲句柄时新打开，读取失败时丢弃句柄后重试
+    """
+
+    def __init__(self, nfs_file_path, chunk_size=NFSInterface.CHUNK_SIZE, max_retry_times=3):
+        super(NFSSourceReader, self).__init__()
+        address, self.path = posixpath.split(nfs_file_path)
+        self.nfs_file_path = nfs_file_path
+        self.nfs = NFSInterface(address, chunk_size)
+        self.max_retry_times = max_retry_times
+        self.size = self.nfs.getsize(self.path)
+        self._idle_files = list()
+        self._lock = threading.Lock()
+
+    def pread(self, offset, length):
+        length = max(0, min(length, self.size - offset))
+        if not length:
+            return b""
+
+        retry_times = 0
+        while True:
+            nfs_file = self._acquire_file()
+            try:
+                data = nfs_file.pread(offset, length)
+                if len(data) != length:
+                    raise EOFError(f"short read, offset: {offset}, expected: {length}, actual: {len(data)}")
+            except Exception as e:
+                nfs_file.close(discard=True)
+                retry_times += 1
+                if retry_times > self.max_retry_times:
+                    raise Exception(
+                        f"read nfs source failed, nfs file path: {self.nfs_file_path}, offset: {offset}, "
+                        f"length: {length}, error reason: {e}"
+                    )
+                time.sleep(TimeTool.get_backoff_seconds(retry_times, 1, 10))
+                continue
+
+            with self._lock:
+                self._idle_files.append(nfs_file)
+            return data
+
+    def _acquire_file(self):
+        with self._lock:
+            if self._idle_files:
+                return self._idle_files.pop()
+        return self.nfs.open(self.path, "rb")
+
+    def close(self):
+        with self._lock:
+            idle_files, self._idle_files = self._idle_files, list()
+        for nfs_file in idle_files:
+            nfs_file.close()
+
+
+class NBDExport:
+    """将读取器以只读NBD导出的形式发布在本地unix socket上
+    每个客户端连接由一个线程接收请求，READ请求交给线程池并行读取，回复按完成顺序发送
+    """
+
+    NBD_MAGIC = b"NBDMAGIC"
+    IHAVEOPT = 0x49484156454F5054
+    OPTION_REPLY_MAGIC = 0x3E889045565A9
+    REQUEST_MAGIC = 0x25609513
+    SIMPLE_REPLY_MAGIC = 0x67446698
+
+    FLAG_FIXED_NEWSTYLE = 1 << 0
+    FLAG_NO_ZEROES = 1 << 1
+    FLAG_HAS_FLAGS = 1 << 0
+    FLAG_READ_ONLY = 1 << 1
+
+    OPT_EXPORT_NAME = 1
+    OPT_ABORT = 2
+    OPT_INFO = 6
+    OPT_GO = 7
+    REP_ACK = 1
+    REP_INFO = 3
+    REP_ERR_UNSUP = (1 << 31) + 1
+    INFO_EXPORT = 0
+    INFO_BLOCK_SIZE = 3
+
+    CMD_READ = 0
+    CMD_WRITE = 1
+    CMD_DISC = 2
+
+    # 单个READ请求的最大字节数，在握手时告知客户端
+    MAX_PAYLOAD_SIZE = 32 * 1024 * 1024
+
+    def __init__(self, source_reader, socket_path, concurrency=4):
+        self.source_reader = source_reader
+        self.socket_path = socket_path
+        self.concurrency = concurrency
+        self._server_socket = None
+        self._accept_thread = None
+        self._conn_list = list()
+        self._lock = threading.Lock()
+        self._executor = None
+
+    @property
+    def transmission_flags(self):
+        return self.FLAG_HAS_FLAGS | self.FLAG_READ_ONLY
+
+    def start(self):
+        os.makedirs(os.path.dirname(self.socket_path), exist_ok=True)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        self._server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server_socket.bind(self.socket_path)
+        self._server_socket.listen()
+        self._accept_thread = threading.Thread(target=self._accept, daemon=True)
+        self._accept_thread.start()
+        logger.info(
+            f"nbd export start, socket path: {self.socket_path}, size: {self.source_reader.size}, concurrency: {self.concurrency}"
+        )
+
+    def stop(self):
+        """停止导出，断开所有客户端连接，重复调用不报错"""
+        if self._server_socket is None:
+            return
+
+        server_socket, self._server_socket = self._server_socket, None
+        try:
+            # 唤醒阻塞在accept上的线程
+            server_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        server_socket.close()
+        self._accept_thread.join()
+        with self._lock:
+            conn_list, self._conn_list = self._conn_list, list()
+        for conn in conn_list:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self._executor.shutdown(wait=True)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self.source_reader.close()
+        logger.info(f"nbd export stop, socket path: {self.socket_path}")
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self._server_socket.accept()
+            except (OSError, AttributeError):
+                return
+            with self._lock:
+                self._conn_list.append(conn)
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        try:
+            if self._handshake(conn):
+                self._transmission(conn)
+        except (OSError, EOFError) as e:
+            # 客户端断开或导出停止
+            logger.debug(f"nbd connection closed, socket path: {self.socket_path}, reason: {e}")
+        except Exception as e:
+            logger.error(f"nbd connection failed, socket path: {self.socket_path}, error reason: {e}")
+        finally:
+            with self._lock:
+                if conn in self._conn_list:
+                    self._conn_list.remove(conn)
+            conn.close()
+
+    @staticmethod
+    def _recv_exact(conn, length):
+        chunks = list()
+        while length:
+            chunk = conn.recv(min(length, 1024 * 1024))
+            if not chunk:
+                raise EOFError("connection closed by peer")
+            chunks.append(chunk)
+            length -= len(chunk)
+        return b"".join(chunks)
+
+    def _send_option_reply(self, conn, option, reply_type, data=b""):
+        conn.sendall(struct.pack(">QIII", self.OPTION_REPLY_MAGIC, option, reply_type, len(data)) + data)
+
+    def _handshake(self, conn):
+        """选项协商，进入传输阶段时返回True，客户端放弃时返回False"""
+        conn.sendall(
+            self.NBD_MAGIC + struct.pack(">QH", self.IHAVEOPT, self.FLAG_FIXED_NEWSTYLE | self.FLAG_NO_ZEROES)
+        )
+        client_flags = struct.unpack(">I", self._recv_exact(conn, 4))[0]
+        while True:
+            magic, option, length = struct.unpack(">QII", self._recv_exact(conn, 16))
+            if magic != self.IHAVEOPT:
+                raise Exception(f"invalid nbd option magic: {magic:#x}")
+            data = self._recv_exact(conn, length)
+
+            if option == self.OPT_EXPORT_NAME:
+                # 旧式选项没有回复头，直接发送导出信息
+                reply = struct.pack(">QH", self.source_reader.size, self.transmission_flags)
+                if not client_flags & self.FLAG_NO_ZEROES:
+                    reply += bytes(124)
+                conn.sendall(reply)
+                return True
+            if option == self.OPT_ABORT:
+                self._send_option_reply(conn, option, self.REP_ACK)
+                return False
+            if option in (self.OPT_INFO, self.OPT_GO):
+                self._send_option_reply(
+                    conn, option, self.REP_INFO,
+                    struct.pack(">HQH", self.INFO_EXPORT, self.source_reader.size, self.transmission_flags),
+                )
+                self._send_option_reply(
+                    conn, option, self.REP_INFO,
+                    struct.pack(">HIII", self.INFO_BLOCK_SIZE, 1, 4096, self.MAX_PAYLOAD_SIZE),
+                )
+                self._send_option_reply(conn, option, self.REP_ACK)
+                if option == self.OPT_GO:
+                    return True
+                continue
+            # 结构化回复、元数据上下文等选项均不支持，客户端会退回到简单回复
+            self._send_option_reply(conn, option, self.REP_ERR_UNSUP)
+
+    def _transmission(self, conn):
+        send_lock = threading.Lock()
+
+        def send_reply(cookie, error, data=b""):
+            with send_lock:
+                conn.sendall(struct.pack(">IIQ", self.SIMPLE_REPLY_MAGIC, error, cookie) + data)
+
+        def read(cookie, offset, length):
+            try:
+                data = self.source_reader.pread(offset, length)
+            except Exception as e:
+                logger.error(
+                    f"nbd read failed, socket path: {self.socket_path}, offset: {offset}, length: {length}, error reason: {e}"
+                )
+                send_reply(cookie, errno.EIO)
+                return
+            send_reply(cookie, 0, data)
+
+        while True:
+            magic, _, cmd_type, cookie, offset, length = struct.unpack(">IHHQQI", self._recv_exact(conn, 28))
+            if magic != self.REQUEST_MAGIC:
+                raise Exception(f"invalid nbd request magic: {magic:#x}")
+
+            if cmd_type == self.CMD_READ:
+                if length > self.MAX_PAYLOAD_SIZE or offset + length > self.source_reader.size:
+                    send_reply(cookie, errno.EINVAL)
+                    continue
+                self._executor.submit(read, cookie, offset, length)
+            elif cmd_type == self.CMD_DISC:
+                return
+            elif cmd_type == self.CMD_WRITE:
+                # 只读导出，丢弃写入的数据
+                self._recv_exact(conn, length)
+                send_reply(cookie, errno.EPERM)
+            else:
+                send_reply(cookie, errno.EINVAL)
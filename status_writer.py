@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+"""
+功能：迁移状态的异步持久化
+
+迁移过程中频繁上报进度，同步写库会拖慢转换、拷贝等循环，状态改为由后台线程批量写入存储
+1.快照  提交时在调用方线程深拷贝数据，之后调用方修改原字典（例如共享的状态模板、硬盘信息）不影响待写入的数据
+2.合并  同一会话在两次写入之间的多次更新合并为一条，后提交的字段覆盖先提交的，只写入最新状态
+3.写入  后台线程每隔status_store_flush_interval秒或待写入的会话数达到status_store_batch_size时批量写入，
+        写入失败时保留数据并在下一轮重试，提交方永远不会等待存储
+4.存储  按名称注册，由status_store选择：sqlite（本地文件）、postgres、redis，保存的是会话自启动以来提交的全部字段
+Note:迁移会话运行在fork出的子进程中，子进程首次提交时重新启动后台线程，退出前须调用close写入剩余数据
+"""
+
+import abc
+import atexit
+import copy
+import json
+import os
+import sqlite3
+import threading
+
+from core.logger import logger
+from core.config import config
+
+from clients.redis_cli import RedisClient
+from tools.registry_tool import Registry
+from tools.time_tool import TimeTool
+
+try:
+    import psycopg2
+    import psycopg2.extras
+except ImportError:
+    # 只有状态存储为postgres时需要psycopg2
+    psycopg2 = None
+
+
+# 已注册的状态存储，key为存储名称
+STATUS_STORE_REGISTRY = Registry("status store")
+register_status_store = STATUS_STORE_REGISTRY.register
+
+
+def get_status_store(name):
+    """按名称创建状态存储"""
+    return STATUS_STORE_REGISTRY.create(name)
+
+
+class StatusStore(abc.ABC):
+    """状态存储基类，只在后台线程中使用"""
+
+    name = ""
+
+    @abc.abstractmethod
+    def write_many(self, status_map):
+        """批量写入，status_map的key为session_id，value为会话的全部状态字段"""
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def dumps(status):
+        return json.dumps(status, ensure_ascii=False, default=str)
+
+
+@register_status_store("sqlite")
+class SqliteStatusStore(StatusStore):
+    """本地SQLite文件，多个迁移子进程可同时写入"""
+
+    def __init__(self):
+        db_path = config.status_store_sqlite_path_full
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.conn = sqlite3.connect(db_path, timeout=30)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS migrate_status "
+            "(session_id TEXT PRIMARY KEY, info TEXT NOT NULL, update_time TEXT NOT NULL)"
+        )
+        self.conn.commit()
+
+    def write_many(self, status_map):
+        update_time = TimeTool.get_now_datetime_str()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO migrate_status (session_id, info, update_time) VALUES (?, ?, ?)",
+                [(session_id, self.dumps(status), update_time) for session_id, status in status_map.items()],
+            )
+
+    def close(self):
+        self.conn.close()
+
+
+@register_status_store("postgres")
+class PostgresStatusStore(StatusStore):
+    """PostgreSQL，连接串由status_store_pg_dsn指定"""
+
+    def __init__(self):
+        if psycopg2 is None:
+            raise Exception("psycopg2 is not installed, please install psycopg2-binary")
+        self.conn = psycopg2.connect(config.setting.status_store_pg_dsn)
+        with self.conn, self.conn.cursor() as cursor:
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS migrate_status "
+                "(session_id TEXT PRIMARY KEY, info JSONB NOT NULL, update_time TIMESTAMP NOT NULL)"
+            )
+
+    def write_many(self, status_map):
+        update_time = TimeTool.get_now_datetime()
+        with self.conn, self.conn.cursor() as cursor:
+            psycopg2.extras.execute_values(
+                cursor,
+                "INSERT INTO migrate_status (session_id, info, update_time) VALUES %s "
+                "ON CONFLICT (session_id) DO UPDATE SET info = EXCLUDED.info, update_time = EXCLUDED.update_time",
+                [(session_id, self.dumps(status), update_time) for session_id, status in status_map.items()],
+            )
+
+    def close(self):
+        self.conn.close()
+
+
+@register_status_store("redis")
+class RedisStatusStore(StatusStore):
+    """Redis，每个会话一个键，值为状态的JSON"""
+
+    def __init__(self):
+        self.client = RedisClient.get_client()
+
+    @staticmethod
+    def get_key(session_id):
+        return RedisClient.get_key("migrate_status", session_id)
+
+    def write_many(self, status_map):
+        pipeline = self.client.pipeline(transaction=False)
+        for session_id, status in status_map.items():
+            pipeline.set(self.get_key(session_id), self.dumps(status))
+        pipeline.execute()
+
+
+class StatusWriter:
+    """状态的异步写入器，submit只在内存中合并，不做任何IO"""
+
+    def __init__(self):
+        self._pid = None
+        self._thread = None
+        self._store = None
+        self._closed = False
+        # 串行化后台线程的启动和停止
+        self._start_lock = threading.Lock()
+        self._cond = threading.Condition()
+        # 会话自启动以来提交的全部字段，key为session_id
+        self._status_map = dict()
+        # 尚未写入存储的会话
+        self._dirty_session_ids = set()
+        os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        """fork时锁可能正被父进程的其他线程持有，子进程使用新的锁，只写入自己提交的状态"""
+        self._pid = None
+        self._thread = None
+        self._store = None
+        self._closed = False
+        self._start_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._status_map = dict()
+        self._dirty_session_ids = set()
+
+    def submit(self, session_id, data):
+        """提交会话的状态更新"""
+        snapshot = copy.deepcopy(data)
+        self._ensure_started()
+        with self._cond:
+            self._status_map[session_id] = {**self._status_map.get(session_id, dict()), **snapshot}
+            self._dirty_session_ids.add(session_id)
+            if len(self._dirty_session_ids) >= config.setting.status_store_batch_size:
+                self._cond.notify()
+
+    def _ensure_started(self):
+        """首次提交时启动后台线程，fork出的子进程不继承父进程的线程，需要重新启动"""
+        if self._pid == os.getpid() and not self._closed:
+            return
+        with self._start_lock:
+            if self._pid == os.getpid() and not self._closed:
+                return
+            if self._thread is not None:
+                # close后再次提交，等待上一个线程写完退出
+                self._thread.join()
+            with self._cond:
+                self._closed = False
+            self._thread = threading.Thread(target=self._run, name="status-writer", daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        retry_times = 0
+        while True:
+            with self._cond:
+                if not self._closed:
+                    self._cond.wait(config.setting.status_store_flush_interval * (2 ** min(retry_times, 5)))
+                closed = self._closed
+            try:
+                self._flush()
+                retry_times = 0
+            except Exception as e:
+                retry_times += 1
+                logger.error(f"write migrate status failed, retry times: {retry_times}, error reason: {e}")
+            if closed:
+                break
+
+        # 存储的连接只能在创建它的线程中使用
+        if self._store is not None:
+            self._store.close()
+            self._store = None
+
+    def _flush(self):
+        """将合并后的状态批量写入存储，失败时数据仍保留为待写入"""
+        with self._cond:
+            if not self._dirty_session_ids:
+                return
+            status_map = {session_id: self._status_map[session_id] for session_id in self._dirty_session_ids}
+            self._dirty_session_ids = set()
+
+        try:
+            if self._store is None:
+                self._store = get_status_store(config.setting.status_store)
+            self._store.write_many(status_map)
+        except Exception:
+            with self._cond:
+                self._dirty_session_ids.update(status_map)
+            if self._store is not None:
+                try:
+                    self._store.close()
+                except Exception:
+                    pass
+                self._store = None
+            raise
+
+    def close(self, timeout=10):
+        """写入剩余的状态并停止后台线程，写入失败时不再重试，重复调用不报错"""
+        with self._start_lock:
+            if self._pid != os.getpid() or self._closed:
+                return
+            with self._cond:
+                self._closed = True
+                self._cond.notify()
+            self._thread.join(timeout)
+
+
+# 进程内共享的写入器
+status_writer = StatusWriter()
+atexit.register(status_writer.close)
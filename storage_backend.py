@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+"""
+功能：覆盖镜像的存储后端
+
+覆盖镜像将转换后的镜像写入目标虚拟机的卷，卷的形态因部署而异，由cover_image_storage_backend选择后端
+各后端声明支持的写入方式（见CoverImageMode），每块硬盘使用后端支持的最快方式
+1.qbd    NeonSAN卷，映射为本地qbd块设备；先启动目标虚拟机，系统盘剪切，数据盘写入卷，覆盖后重启
+2.block  通用块设备，例如LVM逻辑卷，设备路径由cover_image_block_dev_path_template按卷id生成
+3.file   本地文件，卷为cover_image_file_backend_dir下以卷id命名的文件，可在普通Linux主机上完整验证覆盖镜像流程并测量性能
+         卷格式为qcow2时直接剪切，为raw时与块设备相同，稀疏拷贝或直接转换，写入结果可通过loop设备挂载检查
+"""
+
+import abc
+import contextlib
+import os
+
+from core.logger import logger
+from core.config import config
+
+from clients.cmd_cli import CMDClient
+from tools.block_tool import BlockTool
+from tools.file_tool import FileTool
+from tools.registry_tool import Registry
+
+from constants.enum import CoverImageMode
+from constants.template import (
+    GET_POOL_BY_VOLUME_CMD_TEMPLATE,
+    QBD_MAP_CMD_TEMPLATE,
+    QBD_UNMAP_CMD_TEMPLATE,
+    QBD_DEV_PATH_TEMPLATE,
+)
+
+
+# 已注册的存储后端，key为后端名称
+STORAGE_BACKEND_REGISTRY = Registry("storage backend")
+register_storage_backend = STORAGE_BACKEND_REGISTRY.register
+
+
+def get_storage_backend(name, vm_session):
+    """按名称创建存储后端"""
+    return STORAGE_BACKEND_REGISTRY.create(name, vm_session)
+
+
+@contextlib.contextmanager
+def map_qbd_volume_context(volume_id, timeout=60):
+    """将NeonSAN卷映射为本地qbd块设备，退出时解除映射"""
+    returncode, stdout, stderr = CMDClient.normal_exec(
+        GET_POOL_BY_VOLUME_CMD_TEMPLATE.format(volume_id=volume_id), timeout
+    )
+    pool = stdout.decode().strip()
+    if returncode != 0 or not pool:
+        raise Exception(f"get pool of volume failed, volume id: {volume_id}, error reason: {stderr}")
+
+    returncode, _, stderr = CMDClient.normal_exec(
+        QBD_MAP_CMD_TEMPLATE.format(pool=pool, volume_id=volume_id), timeout
+    )
+    if returncode != 0:
+        raise Exception(f"map qbd volume failed, volume id: {volume_id}, pool: {pool}, error reason: {stderr}")
+
+    try:
+        yield QBD_DEV_PATH_TEMPLATE.format(pool=pool, volume_id=volume_id)
+    finally:
+        returncode, _, stderr = CMDClient.normal_exec(
+            QBD_UNMAP_CMD_TEMPLATE.format(pool=pool, volume_id=volume_id), timeout
+        )
+        if returncode != 0:
+            logger.error(f"unmap qbd volume failed, volume id: {volume_id}, pool: {pool}, error reason: {stderr}")
+
+
+class StorageBackend(abc.ABC):
+    """存储后端基类"""
+
+    name = ""
+    # 支持的写入方式，按速度从快到慢排列
+    cover_modes = ()
+    # 为True时先启动目标虚拟机再覆盖，覆盖后重启；否则覆盖后启动
+    start_dst_vm_before_cover = False
+
+    def __init__(self, vm_session):
+        self.vm_session = vm_session
+
+    def supports(self, cover_mode):
+        return cover_mode in self.cover_modes
+
+    def get_cover_mode(self, disk_info):
+        """选择硬盘的写入方式，处理镜像时未转换的数据盘只能直接转换，其余硬盘使用支持的最快方式"""
+        if disk_info.get("direct_convert"):
+            return CoverImageMode.DIRECT_CONVERT
+        for cover_mode in self.cover_modes:
+            if cover_mode != CoverImageMode.DIRECT_CONVERT:
+                return cover_mode
+        raise Exception(f"no cover mode is supported, storage backend: {self.name}, disk name: {disk_info['name']}")
+
+    @abc.abstractmethod
+    def volume_context(self, disk_info):
+        """获取硬盘对应的目标卷在本地的路径（块设备或文件），退出时释放"""
+
+    def move_image(self, image_path, disk_info):
+        """剪切镜像文件作为目标卷，只有卷为镜像文件的后端支持，返回实际使用的方式（见FileTool.move_file）"""
+        with self.volume_context(disk_info) as volume_path:
+            return FileTool.move_file(image_path, volume_path)
+
+
+@register_storage_backend("qbd")
+class QbdStorageBackend(StorageBackend):
+    """NeonSAN卷"""
+
+    cover_modes = (CoverImageMode.MOVE, CoverImageMode.DD, CoverImageMode.DIRECT_CONVERT)
+    start_dst_vm_before_cover = True
+
+    def get_cover_mode(self, disk_info):
+        if disk_info.get("is_os_disk"):
+            return CoverImageMode.MOVE
+        if disk_info.get("direct_convert"):
+            return CoverImageMode.DIRECT_CONVERT
+        return CoverImageMode.DD
+
+    def volume_context(self, disk_info):
+        return map_qbd_volume_context(disk_info["volume_id"])
+
+    def move_image(self, image_path, disk_info):
+        """系统盘剪切到目标平台，由目标平台对接实现"""
+
+
+@register_storage_backend("block")
+class BlockStorageBackend(StorageBackend):
+    """通用块设备，设备由部署环境预先映射到本地"""
+
+    cover_modes = (CoverImageMode.DD, CoverImageMode.DIRECT_CONVERT)
+
+    @contextlib.contextmanager
+    def volume_context(self, disk_info):
+        dev_path = config.migration.cover_image_block_dev_path_template.format(volume_id=disk_info["volume_id"])
+        if not BlockTool.is_block_device(dev_path):
+            raise Exception(f"block device is not found, volume id: {disk_info['volume_id']}, dev path: {dev_path}")
+        yield dev_path
+
+
+@register_storage_backend("file")
+class FileStorageBackend(StorageBackend):
+    """本地文件"""
+
+    GB = 1024 * 1024 * 1024
+
+    def __init__(self, vm_session):
+        super(FileStorageBackend, self).__init__(vm_session)
+        self.volume_format = config.migration.cover_image_file_volume_format
+        if self.volume_format == "qcow2":
+            self.cover_modes = (CoverImageMode.MOVE,)
+        elif self.volume_format == "raw":
+            self.cover_modes = (CoverImageMode.DD, CoverImageMode.DIRECT_CONVERT)
+        else:
+            raise Exception(f"unsupported file volume format: {self.volume_format}, supported formats: ['qcow2', 'raw']")
+
+    def get_volume_path(self, disk_info):
+        return os.path.join(
+            config.cover_image_file_backend_dir_full, f"{disk_info['volume_id']}.{self.volume_format}"
+        )
+
+    @contextlib.contextmanager
+    def volume_context(self, disk_info):
+        """raw格式的卷每次重新创建为目标卷容量大小的稀疏文件，与新建的空卷一致，未写入的区域读出零"""
+        volume_path = self.get_volume_path(disk_info)
+        os.makedirs(os.path.dirname(volume_path), exist_ok=True)
+        if self.volume_format == "raw":
+            with open(volume_path, "wb") as f:
+                f.truncate(disk_info["size"] * self.GB)
+        yield volume_path
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+"""
+功能：迁移调度的测试
+
+使用内存等待队列，准入控制和子进程启动由测试替换
+"""
+
+from unittest import mock
+
+import pytest
+
+import scheduler
+from constants.enum import MigrateStatus
+from error import ErrorCode
+from scheduler import MemorySessionQueue, MigrateAdmission, MigrateScheduler
+
+
+class FakeAdmission(MigrateAdmission):
+    """暂存空间固定的准入控制，单位GB"""
+
+    def __init__(self, free_gb, total_gb):
+        super(FakeAdmission, self).__init__(data_dir="/")
+        self.free_gb = free_gb
+        self.total_gb = total_gb
+
+    def admit_node(self, running_session_info_list):
+        return True, ""
+
+    def admit_session(self, vm_session_info, running_session_info_list):
+        if vm_session_info["need_gb"] > self.free_gb:
+            return False, "disk space not enough"
+        return True, ""
+
+    def check_feasible(self, vm_session_info):
+        if vm_session_info["need_gb"] > self.total_gb:
+            return False, "disk space never enough"
+        return True, ""
+
+
+def new_session_info(session_id, need_gb, priority=0):
+    return dict(session_id=session_id, priority=priority, status=MigrateStatus.QUEUING.value, need_gb=need_gb)
+
+
+@pytest.fixture
+def vm_session_cls():
+    with mock.patch.object(scheduler, "VMSession") as vm_session_cls:
+        yield vm_session_cls
+
+
+def new_scheduler(admission, max_migrating_num=2, concurrency_migrate=2):
+    migrate_scheduler = MigrateScheduler(
+        MemorySessionQueue(),
+        max_migrating_num=max_migrating_num,
+        concurrency_migrate=concurrency_migrate,
+        admission=admission,
+    )
+    migrate_scheduler._start = mock.Mock(
+        side_effect=lambda info: migrate_scheduler.running.setdefault(
+            info["session_id"], dict(vm_session=mock.Mock(info=info))
+        )
+    )
+    return migrate_scheduler
+
+
+def test_dispatch_skips_sessions_that_do_not_fit(vm_session_cls):
+    migrate_scheduler = new_scheduler(FakeAdmission(free_gb=10, total_gb=100))
+    for session_info in (
+        new_session_info("big-1", 50, priority=9),
+        new_session_info("big-2", 50, priority=9),
+        new_session_info("big-3", 50, priority=9),
+        new_session_info("small-1", 5),
+        new_session_info("small-2", 5),
+    ):
+        migrate_scheduler.submit(session_info)
+
+    migrate_scheduler._dispatch()
+
+    assert list(migrate_scheduler.running) == ["small-1", "small-2"]
+    # 未准入的会话按原有顺序继续排队
+    assert [info["session_id"] for info in migrate_scheduler.session_queue.claim(5)] == ["big-1", "big-2", "big-3"]
+
+
+def test_dispatch_fails_sessions_that_never_fit(vm_session_cls):
+    migrate_scheduler = new_scheduler(FakeAdmission(free_gb=10, total_gb=100))
+    migrate_scheduler.submit(new_session_info("huge", 500, priority=9))
+    migrate_scheduler.submit(new_session_info("small", 5))
+
+    migrate_scheduler._dispatch()
+
+    assert list(migrate_scheduler.running) == ["small"]
+    assert len(migrate_scheduler.session_queue) == 0
+    status = vm_session_cls.return_value.update_detail_migrate_status.call_args[0][0]
+    assert status["status"] == MigrateStatus.FAILED.value
+    assert status["err_code"] == ErrorCode.ERROR_DISPATCH_DISK_SPACE_NOT_ENOUGH.value
+
+
+def test_dispatch_stops_when_node_is_busy(vm_session_cls):
+    admission = FakeAdmission(free_gb=10, total_gb=100)
+    admission.admit_node = mock.Mock(return_value=(False, "cpu load too high"))
+    migrate_scheduler = new_scheduler(admission)
+    migrate_scheduler.submit(new_session_info("small-1", 5))
+    migrate_scheduler.submit(new_session_info("small-2", 5))
+
+    migrate_scheduler._dispatch()
+
+    assert not migrate_scheduler.running
+    assert len(migrate_scheduler.session_queue) == 2
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+"""
+功能：Redis等待队列的测试
+
+使用fakeredis作为进程内的Redis替身，时间由测试控制，不依赖真实的等待
+"""
+
+from unittest import mock
+
+import pytest
+
+redis = pytest.importorskip("redis")
+fakeredis = pytest.importorskip("fakeredis")
+
+from constants.enum import MigrateStatus
+from scheduler import MigrateScheduler, RedisSessionQueue
+from tools.time_tool import TimeTool
+
+VISIBILITY_TIMEOUT = 60
+
+
+class FakeClock:
+    """替代Redis服务端时间"""
+
+    def __init__(self):
+        self.now = 1700000000.0
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(RedisSessionQueue, "_get_now", lambda self: clock.now)
+    return clock
+
+
+@pytest.fixture
+def client():
+    pool = redis.ConnectionPool(
+        connection_class=fakeredis.FakeConnection, server=fakeredis.FakeServer(), decode_responses=True
+    )
+    return redis.Redis(connection_pool=pool)
+
+
+@pytest.fixture
+def new_queue(client, clock):
+    def new_queue(node_id):
+        return RedisSessionQueue(node_id=node_id, visibility_timeout=VISIBILITY_TIMEOUT, client=client)
+
+    return new_queue
+
+
+def new_session_info(session_id, priority=0, status=MigrateStatus.QUEUING.value):
+    return dict(session_id=session_id, priority=priority, status=status)
+
+
+def test_claim_by_priority_then_fifo(new_queue):
+    queue = new_queue("node-a")
+    queue.put(new_session_info("s1"))
+    queue.put(new_session_info("s2", priority=5))
+    queue.put(new_session_info("s3"))
+
+    claimed = queue.claim(2)
+
+    assert [info["session_id"] for info in claimed] == ["s2", "s1"]
+    assert len(queue) == 3
+    assert [info["session_id"] for info in new_queue("node-b").claim(5)] == ["s3"]
+    assert new_queue("node-b").claim(5) == list()
+
+
+def test_put_rejects_non_waiting_status(new_queue):
+    with pytest.raises(ValueError):
+        new_queue("node-a").put(new_session_info("s1", status=MigrateStatus.RUNNING.value))
+
+
+def test_put_skips_claimed_session(new_queue):
+    queue = new_queue("node-a")
+    queue.put(new_session_info("s1"))
+    queue.claim(1)
+
+    queue.put(new_session_info("s1"))
+
+    assert new_queue("node-b").claim(1) == list()
+
+
+def test_expired_claim_is_requeued_and_reclaimed(new_queue, clock, client):
+    node_a = new_queue("node-a")
+    node_b = new_queue("node-b")
+    node_a.put(new_session_info("s1"))
+    node_a.claim(1)
+
+    clock.advance(VISIBILITY_TIMEOUT - 1)
+    assert node_b.claim(1) == list()
+
+    clock.advance(2)
+    claimed = node_b.claim(1)
+
+    assert [info["session_id"] for info in claimed] == ["s1"]
+    assert claimed[0]["status"] == MigrateStatus.PENDING.value
+    assert client.hget(node_b.owner_key, "s1") == "node-b"
+
+
+def test_heartbeat_extends_claim(new_queue, clock):
+    node_a = new_queue("node-a")
+    node_b = new_queue("node-b")
+    node_a.put(new_session_info("s1"))
+    node_a.claim(1)
+
+    clock.advance(VISIBILITY_TIMEOUT - 1)
+    assert node_a.heartbeat("s1") is True
+    clock.advance(VISIBILITY_TIMEOUT - 1)
+
+    assert node_b.claim(1) == list()
+
+
+def test_heartbeat_after_claim_lost(new_queue, clock, client):
+    node_a = new_queue("node-a")
+    node_b = new_queue("node-b")
+    node_a.put(new_session_info("s1"))
+    node_a.claim(1)
+    clock.advance(VISIBILITY_TIMEOUT + 1)
+    node_b.claim(1)
+
+    assert node_a.heartbeat("s1") is False
+    assert node_b.heartbeat("s1") is True
+
+    # 失去领取的节点结束会话时不影响新的领取节点
+    node_a.ack("s1")
+    assert client.hget(node_b.owner_key, "s1") == "node-b"
+    assert len(node_b) == 1
+
+
+def test_ack_and_requeue(new_queue):
+    queue = new_queue("node-a")
+    queue.put(new_session_info("s1"))
+    queue.put(new_session_info("s2"))
+    s1, s2 = queue.claim(2)
+
+    queue.ack("s1")
+    queue.requeue(s2)
+
+    assert len(queue) == 1
+    claimed = new_queue("node-b").claim(2)
+    assert [info["session_id"] for info in claimed] == ["s2"]
+    assert claimed[0]["status"] == MigrateStatus.QUEUING.value
+
+
+def test_report_capacity(new_queue, clock):
+    node_a = new_queue("node-a")
+    node_b = new_queue("node-b")
+    node_a.report_capacity(2, 5)
+    node_b.report_capacity(6, 5)
+
+    capacity_map = node_a.list_node_capacity()
+
+    assert set(capacity_map) == {"node-a", "node-b"}
+    assert capacity_map["node-a"]["free_num"] == 3
+    assert capacity_map["node-b"]["free_num"] == 0
+
+    # 超过可见性超时未上报的节点视为已下线
+    clock.advance(VISIBILITY_TIMEOUT + 1)
+    node_b.report_capacity(1, 5)
+    assert set(node_a.list_node_capacity()) == {"node-b"}
+
+
+def test_reap_stops_session_after_claim_lost(new_queue, clock):
+    node_a = new_queue("node-a")
+    node_a.put(new_session_info("s1"))
+    node_a.claim(1)
+    clock.advance(VISIBILITY_TIMEOUT + 1)
+    new_queue("node-b").claim(1)
+
+    scheduler = MigrateScheduler(node_a, admission=mock.Mock())
+    process = mock.Mock()
+    process.is_alive.return_value = True
+    vm_session = mock.Mock()
+    scheduler.running["s1"] = dict(process=process, start_time=TimeTool.get_now_timestamp(), vm_session=vm_session)
+
+    with mock.patch.object(MigrateScheduler, "_terminate") as terminate:
+        scheduler._reap()
+
+    terminate.assert_called_once_with(process)
+    assert "s1" not in scheduler.running
+    vm_session.update_detail_migrate_status.assert_not_called()
+
+
+def test_run_forever_retries_failed_round(new_queue):
+    scheduler = MigrateScheduler(new_queue("node-a"), admission=mock.Mock(), poll_interval=0)
+    round_list = list()
+
+    def run_once():
+        round_list.append(len(round_list))
+        if len(round_list) == 1:
+            raise redis.ConnectionError("redis is unavailable")
+        scheduler.stop()
+
+    with mock.patch.object(scheduler, "run_once", side_effect=run_once), \
+            mock.patch.object(scheduler, "_terminate_all") as terminate_all:
+        scheduler.run_forever()
+
+    assert len(round_list) == 2
+    terminate_all.assert_called_once_with()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import mmap
+import stat
+import fcntl
+import struct
+from typing import Any, Optional
+
+# linux/fs.h
+BLKDISCARD = 0x1277
+BLKZEROOUT = 0x127f
+
+# O_DIRECT要求偏移和长度按逻辑块对齐，按4K对齐可兼容绝大多数设备
+DIRECT_IO_ALIGNMENT = 4096
+
+
+class BlockTool:
+
+    @classmethod
+    def parse_image_map(cls, image_map: list[dict[str, Any]]) -> Optional[tuple[list[dict[str, int]], list[dict[str, int]]]]:
+        """解析qemu-img map --output=json的结果，返回数据区间和空洞区间
+        数据区间包含虚拟磁盘中的起始位置start、长度length和镜像文件中的偏移offset
+        数据不在当前镜像文件中（依赖backing file）或没有偏移（压缩簇）时返回None，只能全量拷贝
+        """
+        data_extents: list[dict[str, int]] = list()
+        hole_extents: list[dict[str, int]] = list()
+        for extent in image_map:
+            start, length = extent["start"], extent["length"]
+            if extent.get("zero") or not extent.get("data"):
+                cls._append_extent(hole_extents, dict(start=start, length=length))
+                continue
+            if extent.get("depth", 0) != 0 or extent.get("compressed") or "offset" not in extent:
+                return None
+            cls._append_extent(data_extents, dict(start=start, length=length, offset=extent["offset"]))
+        return data_extents, hole_extents
+
+    @classmethod
+    def _append_extent(cls, extents: list[dict[str, int]], extent: dict[str, int]) -> None:
+        """追加区间，与上一个区间连续时合并，减少系统调用次数"""
+        if extents:
+            last = extents[-1]
+            contiguous = last["start"] + last["length"] == extent["start"]
+            if contiguous and ("offset" not in extent or last["offset"] + last["length"] == extent["offset"]):
+                last["length"] += extent["length"]
+                return
+        extents.append(extent)
+
+    @classmethod
+    def is_block_device(cls, path: str) -> bool:
+        return os.path.exists(path) and stat.S_ISBLK(os.stat(path).st_mode)
+
+    @classmethod
+    def copy_extents(cls, src_path: str, dst_path: str, data_extents: list[dict[str, int]],
+                     hole_extents: list[dict[str, int]], hole_mode: str = "discard",
+                     buffer_size: int = 8 * 1024 * 1024) -> dict[str, int]:
+        """只拷贝数据区间到目标设备或文件，空洞按hole_mode处理
+        hole_mode:
+            discard 对块设备下发BLKDISCARD，不支持时退化为zeroout
+            zeroout 对块设备下发BLKZEROOUT，不支持时写零
+            none    不处理空洞，目标为新建的空卷时使用
+        目标为普通文件时空洞保持为文件空洞，无需处理
+        Note:discard依赖目标卷在discard后读出零（精简置备卷），不满足时请使用zeroout
+        对齐的区间使用O_DIRECT写入，绕过页缓存
+        """
+        buffer_size = max(DIRECT_IO_ALIGNMENT, buffer_size - buffer_size % DIRECT_IO_ALIGNMENT)
+        is_block_device = cls.is_block_device(dst_path)
+        # mmap分配的内存按页对齐，满足O_DIRECT对缓冲区地址的要求
+        buffer = mmap.mmap(-1, buffer_size)
+        src_fd = os.open(src_path, os.O_RDONLY)
+        dst_fd = os.open(dst_path, os.O_WRONLY if is_block_device else os.O_WRONLY | os.O_CREAT)
+        direct_fd = cls._open_direct(dst_path)
+        stats = dict(data_bytes=0, hole_bytes=0, direct_bytes=0)
+        try:
+            for extent in data_extents:
+                cls._copy_extent(src_fd, dst_fd, direct_fd, buffer, extent, stats)
+
+            if is_block_device and hole_mode != "none":
+                for extent in hole_extents:
+                    cls._fill_hole(dst_fd, extent["start"], extent["length"], hole_mode)
+                    stats["hole_bytes"] += extent["length"]
+            elif not is_block_device and hole_extents:
+                # 普通文件的空洞只需保证文件大小正确
+                last = hole_extents[-1]
+                os.ftruncate(dst_fd, max(os.fstat(dst_fd).st_size, last["start"] + last["length"]))
+
+            os.fsync(dst_fd)
+        finally:
+            os.close(src_fd)
+            os.close(dst_fd)
+            if direct_fd is not None:
+                os.close(direct_fd)
+            buffer.close()
+        return stats
+
+    @classmethod
+    def _open_direct(cls, dst_path: str) -> Optional[int]:
+        """以O_DIRECT打开目标，文件系统不支持时返回None"""
+        if not hasattr(os, "O_DIRECT"):
+            return None
+        try:
+            return os.open(dst_path, os.O_WRONLY | os.O_DIRECT)
+        except OSError:
+            return None
+
+    @classmethod
+    def _copy_extent(cls, src_fd: int, dst_fd: int, direct_fd: Optional[int], buffer: mmap.mmap,
+                     extent: dict[str, int], stats: dict[str, int]) -> None:
+        buffer_size = len(buffer)
+        view = memoryview(buffer)
+        copied = 0
+        try:
+            while copied < extent["length"]:
+                size = min(buffer_size, extent["length"] - copied)
+                read_size = os.preadv(src_fd, [view[:size]], extent["offset"] + copied)
+                if read_size != size:
+                    raise EOFError(f"unexpected end of image, offset: {extent['offset'] + copied}, size: {size}")
+
+                dst_offset = extent["start"] + copied
+                aligned = dst_offset % DIRECT_IO_ALIGNMENT == 0 and size % DIRECT_IO_ALIGNMENT == 0
+                if direct_fd is not None and aligned:
+                    cls._pwrite_all(direct_fd, view[:size], dst_offset)
+                    stats["direct_bytes"] += size
+                else:
+                    cls._pwrite_all(dst_fd, view[:size], dst_offset)
+                copied += size
+        finally:
+            view.release()
+        stats["data_bytes"] += copied
+
+    @classmethod
+    def _pwrite_all(cls, fd: int, data: memoryview, offset: int) -> None:
+        written = 0
+        while written < len(data):
+            written += os.pwrite(fd, data[written:], offset + written)
+
+    @classmethod
+    def _fill_hole(cls, dst_fd: int, start: int, length: int, hole_mode: str) -> None:
+        """处理块设备上的空洞，保证读取结果为零"""
+        if hole_mode == "discard":
+            try:
+                fcntl.ioctl(dst_fd, BLKDISCARD, struct.pack("QQ", start, length))
+                return
+            except OSError:
+                pass
+        try:
+            fcntl.ioctl(dst_fd, BLKZEROOUT, struct.pack("QQ", start, length))
+            return
+        except OSError:
+            pass
+
+        zero_size = 1024 * 1024
+        zero = bytes(zero_size)
+        written = 0
+        while written < length:
+            size = min(zero_size, length - written)
+            written += os.pwrite(dst_fd, zero[:size], start + written)
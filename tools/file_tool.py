@@ -2,10 +2,19 @@
 # -*- coding: utf-8 -*-
 
 import os
+import re
 import json
 import yaml
+import errno
+import fcntl
 import hashlib
-from typing import Optional, Any, Union
+from typing import Optional, Any, BinaryIO, Union
+
+# linux/fs.h，整个文件共享数据块（reflink），XFS、Btrfs等文件系统支持
+FICLONE = 0x40049409
+
+# 跨文件系统拷贝时不支持对应系统调用的错误码，遇到时退化为下一种方式
+COPY_FALLBACK_ERRNOS = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF)
 
 
 class FileTool:
@@ -159,6 +168,147 @@ class FileTool:
             sha256=sha256_hash.hexdigest()
         )
 
+    @classmethod
+    def calculate_range_hash(cls, file_path: str, offset: int, size: int, algorithms: tuple[str, ...] = ("sha256",),
+                             buffer_size: int = 1024 * 1024) -> dict[str, str]:
+        """计算文件指定区间的哈希值，可在不解压的情况下校验tar成员"""
+        hashes = {algorithm: hashlib.new(algorithm) for algorithm in algorithms}
+
+        with open(file_path, 'rb') as file:
+            file.seek(offset)
+            remain = size
+            while remain > 0:
+                chunk = file.read(min(buffer_size, remain))
+                if not chunk:
+                    raise EOFError(f"unexpected end of file: {file_path}, offset: {offset}, size: {size}")
+                for hash_obj in hashes.values():
+                    hash_obj.update(chunk)
+                remain -= len(chunk)
+
+        return {algorithm: hash_obj.hexdigest() for algorithm, hash_obj in hashes.items()}
+
+    @classmethod
+    def copy_fileobj_with_hash(cls, src_file: BinaryIO, dst_path: str, algorithms: tuple[str, ...] = ("sha256",),
+                               buffer_size: int = 1024 * 1024) -> dict[str, str]:
+        """拷贝文件对象到本地文件，拷贝的同时计算哈希值，数据只需读取一遍"""
+        hashes = {algorithm: hashlib.new(algorithm) for algorithm in algorithms}
+
+        with open(dst_path, 'wb') as dst_file:
+            while chunk := src_file.read(buffer_size):
+                for hash_obj in hashes.values():
+                    hash_obj.update(chunk)
+                dst_file.write(chunk)
+
+        return {algorithm: hash_obj.hexdigest() for algorithm, hash_obj in hashes.items()}
+
+    @classmethod
+    def get_data_extents(cls, fd: int) -> list[dict[str, int]]:
+        """通过SEEK_DATA/SEEK_HOLE获取稀疏文件中已分配的区间，文件系统不支持时返回整个文件"""
+        size = os.fstat(fd).st_size
+        extents: list[dict[str, int]] = list()
+        offset = 0
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    break
+                return [dict(start=0, length=size)] if size else list()
+            end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+            extents.append(dict(start=start, length=end - start))
+            offset = end
+        return extents
+
+    @classmethod
+    def move_file(cls, src_path: str, dst_path: str) -> str:
+        """移动文件，返回实际使用的方式
+        同一文件系统内直接重命名；跨文件系统时先拷贝为目标目录下的临时文件，再原子替换并删除源文件，拷贝方式见copy_file
+        """
+        try:
+            os.rename(src_path, dst_path)
+            return "rename"
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+
+        tmp_path = f"{dst_path}.{os.getpid()}.tmp"
+        try:
+            method = cls.copy_file(src_path, tmp_path)
+            os.replace(tmp_path, dst_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        os.remove(src_path)
+        return method
+
+    @classmethod
+    def copy_file(cls, src_path: str, dst_path: str) -> str:
+        """拷贝文件并保留空洞，返回实际使用的方式，按速度从快到慢依次尝试：
+            reflink          FICLONE共享数据块，不拷贝数据，要求同一个支持reflink的文件系统
+            copy_file_range  在内核中拷贝数据区间，不经过用户态
+            sendfile         不支持copy_file_range时（例如较早的内核跨文件系统拷贝）在内核中拷贝数据区间
+        """
+        with open(src_path, 'rb') as src_file, open(dst_path, 'wb') as dst_file:
+            src_fd, dst_fd = src_file.fileno(), dst_file.fileno()
+            try:
+                fcntl.ioctl(dst_fd, FICLONE, src_fd)
+                return "reflink"
+            except OSError as e:
+                if e.errno not in COPY_FALLBACK_ERRNOS:
+                    raise
+
+            method = "copy_file_range" if hasattr(os, "copy_file_range") else "sendfile"
+            for extent in cls.get_data_extents(src_fd):
+                method = cls._copy_range(src_fd, dst_fd, extent["start"], extent["length"], method)
+            # 末尾的空洞只需保证文件大小正确
+            os.ftruncate(dst_fd, os.fstat(src_fd).st_size)
+            os.fsync(dst_fd)
+        return method
+
+    @classmethod
+    def _copy_range(cls, src_fd: int, dst_fd: int, offset: int, length: int, method: str) -> str:
+        """在内核中拷贝区间，copy_file_range不可用时退化为sendfile，返回实际使用的方式"""
+        end = offset + length
+        while offset < end:
+            if method == "copy_file_range":
+                try:
+                    copied = os.copy_file_range(src_fd, dst_fd, end - offset, offset, offset)
+                except OSError as e:
+                    if e.errno not in COPY_FALLBACK_ERRNOS:
+                        raise
+                    method = "sendfile"
+                    continue
+            else:
+                os.lseek(dst_fd, offset, os.SEEK_SET)
+                copied = os.sendfile(dst_fd, src_fd, offset, end - offset)
+            if not copied:
+                raise EOFError(f"unexpected end of file, offset: {offset}, length: {end - offset}")
+            offset += copied
+        return method
+
+    @classmethod
+    def parse_manifest_file(cls, file_path: str) -> dict[str, tuple[str, str]]:
+        """解析OVF的mf清单文件，返回文件名和(哈希算法, 哈希值)的映射
+        eg: SHA256(xxxx.ovf)= 5a1b...  ->  {"xxxx.ovf": ("sha256", "5a1b...")}
+        Note:老版本vCenter导出的mf文件使用SHA1
+        """
+        manifest: dict[str, tuple[str, str]] = dict()
+        with open(file_path, encoding="utf-8") as f:
+            for line in f:
+                match = re.match(r"^\s*(\w+)\((.+)\)\s*=\s*([0-9a-fA-F]+)\s*$", line)
+                if match:
+                    algorithm, file_name, digest = match.groups()
+                    manifest.setdefault(file_name, (algorithm.lower(), digest.lower()))
+        return manifest
+
+    @classmethod
+    def write_manifest_file(cls, file_path: str, manifest: dict[str, tuple[str, str]]) -> None:
+        """写入OVF的mf清单文件，格式与parse_manifest_file一致"""
+        with open(file_path, 'w', encoding="utf-8") as f:
+            for file_name, (algorithm, digest) in manifest.items():
+                f.write(f"{algorithm.upper()}({file_name})= {digest}\n")
+
 
 if __name__ == '__main__':
     print(FileTool.calculate_hash("text_tool.py"))
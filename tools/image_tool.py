@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import abc
+import os
+import zlib
+import struct
+from typing import Optional, Protocol
+
+from tools.vmdk_tool import VmdkTool
+
+SECTOR_SIZE = 512
+
+QCOW2_MAGIC = b"QFI\xfb"
+VMDK_SPARSE_MAGIC = b"KDMV"
+VMDK_DESCRIPTOR_MAGIC = b"# Disk DescriptorFile"
+
+
+class ImageSource(Protocol):
+    """本地文件之外的镜像数据源，按偏移读取，例如NFS上的源镜像"""
+
+    size: int
+
+    def pread(self, offset: int, length: int) -> bytes:
+        ...
+
+
+class ImageReader(abc.ABC):
+    """镜像只读访问的基类，按虚拟磁盘的偏移读取数据，未分配的区域读出零
+    Note:只用于读取分区表、引导扇区等少量数据，不追求大块读取的性能
+    """
+
+    def __init__(self, path: str, offset: int = 0, size: Optional[int] = None,
+                 source: Optional[ImageSource] = None) -> None:
+        self.path = path
+        self.offset = offset
+        self.source = source
+        self.fd = os.open(path, os.O_RDONLY) if source is None else None
+        file_size = source.size if source is not None else os.fstat(self.fd).st_size
+        self.file_size = size if size is not None else file_size - offset
+        self.size = 0
+
+    def __enter__(self) -> "ImageReader":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def read(self, offset: int, length: int) -> bytes:
+        """读取虚拟磁盘中的数据，超出磁盘容量的部分被截断"""
+        length = max(0, min(length, self.size - offset))
+        return self._read(offset, length) if length else b""
+
+    @abc.abstractmethod
+    def _read(self, offset: int, length: int) -> bytes:
+        """读取虚拟磁盘中的数据，调用方已保证不超出磁盘容量"""
+
+    def _pread(self, offset: int, length: int) -> bytes:
+        """读取镜像文件中的数据，偏移相对于镜像在文件中的起始位置（例如OVA中的tar成员）"""
+        length = max(0, min(length, self.file_size - offset))
+        if not length:
+            data = b""
+        elif self.source is not None:
+            data = self.source.pread(self.offset + offset, length)
+        else:
+            data = os.pread(self.fd, length, self.offset + offset)
+        if len(data) != length:
+            raise EOFError(f"unexpected end of image, path: {self.path}, offset: {offset}, length: {length}")
+        return data
+
+
+class RawImageReader(ImageReader):
+    """raw镜像，也用于读取vmdk的FLAT/VMFS extent"""
+
+    def __init__(self, path: str, offset: int = 0, size: Optional[int] = None,
+                 source: Optional[ImageSource] = None) -> None:
+        super(RawImageReader, self).__init__(path, offset, size, source)
+        self.size = self.file_size
+
+    def _read(self, offset: int, length: int) -> bytes:
+        return self._pread(offset, length)
+
+
+class Qcow2ImageReader(ImageReader):
+    """qcow2镜像，支持普通簇、零簇和zlib压缩簇
+    Note:依赖backing file、加密、外部数据文件和扩展L2表的镜像不支持
+    """
+
+    HEADER_FORMAT = ">4sIQIIQIIQQIIQ"
+    OFFSET_MASK = 0x00fffffffffffe00
+    COMPRESSED_FLAG = 1 << 62
+    ZERO_FLAG = 1
+    # 外部数据文件、扩展L2表
+    UNSUPPORTED_INCOMPATIBLE_FEATURES = (1 << 2) | (1 << 4)
+
+    def __init__(self, path: str, offset: int = 0, size: Optional[int] = None,
+                 source: Optional[ImageSource] = None) -> None:
+        super(Qcow2ImageReader, self).__init__(path, offset, size, source)
+        try:
+            self._parse_header()
+        except Exception:
+            self.close()
+            raise
+        self.l2_cache: dict[int, tuple[int, ...]] = dict()
+
+    def _parse_header(self) -> None:
+        header = self._pread(0, 112)
+        (magic, version, backing_file_offset, _, cluster_bits, size, crypt_method, l1_size,
+         l1_table_offset, _, _, _, _) = struct.unpack_from(self.HEADER_FORMAT, header)
+        if magic != QCOW2_MAGIC:
+            raise ValueError(f"invalid qcow2 image, path: {self.path}")
+        if backing_file_offset or crypt_method:
+            raise ValueError(f"qcow2 image with backing file or encryption is not supported, path: {self.path}")
+        if version >= 3:
+            incompatible_features = struct.unpack_from(">Q", header, 72)[0]
+            header_length = struct.unpack_from(">I", header, 100)[0]
+            compression_type = header[104] if header_length > 104 else 0
+            if incompatible_features & self.UNSUPPORTED_INCOMPATIBLE_FEATURES or compression_type:
+                raise ValueError(f"qcow2 image features are not supported, path: {self.path}")
+
+        self.version = version
+        self.cluster_bits = cluster_bits
+        self.cluster_size = 1 << cluster_bits
+        self.l2_entries = self.cluster_size // 8
+        self.size = size
+        l1_data = self._pread(l1_table_offset, l1_size * 8)
+        self.l1_table = struct.unpack(f">{l1_size}Q", l1_data)
+
+    def _get_l2_entry(self, cluster_index: int) -> int:
+        l1_index, l2_index = divmod(cluster_index, self.l2_entries)
+        if l1_index >= len(self.l1_table):
+            return 0
+        l2_offset = self.l1_table[l1_index] & self.OFFSET_MASK
+        if not l2_offset:
+            return 0
+        if l2_offset not in self.l2_cache:
+            self.l2_cache[l2_offset] = struct.unpack(
+                f">{self.l2_entries}Q", self._pread(l2_offset, self.cluster_size)
+            )
+        return self.l2_cache[l2_offset][l2_index]
+
+    def _read_cluster(self, cluster_index: int) -> bytes:
+        entry = self._get_l2_entry(cluster_index)
+        if entry & self.COMPRESSED_FLAG:
+            return self._read_compressed_cluster(entry)
+        host_offset = entry & self.OFFSET_MASK
+        if not host_offset or (self.version >= 3 and entry & self.ZERO_FLAG):
+            return bytes(self.cluster_size)
+        return self._pread(host_offset, self.cluster_size)
+
+    def _read_compressed_cluster(self, entry: int) -> bytes:
+        """压缩簇的描述符由主机偏移和占用的扇区数组成，数据为不带头部的deflate流"""
+        csize_shift = 62 - (self.cluster_bits - 8)
+        csize_mask = (1 << (self.cluster_bits - 8)) - 1
+        host_offset = entry & ((1 << csize_shift) - 1)
+        nb_sectors = ((entry >> csize_shift) & csize_mask) + 1
+        length = nb_sectors * SECTOR_SIZE - (host_offset % SECTOR_SIZE)
+        data = self._pread(host_offset, min(length, self.file_size - host_offset))
+        cluster = zlib.decompressobj(-12).decompress(data, self.cluster_size)
+        return cluster.ljust(self.cluster_size, b"\0")
+
+    def _read(self, offset: int, length: int) -> bytes:
+        chunks: list[bytes] = list()
+        end = offset + length
+        while offset < end:
+            cluster_index, cluster_offset = divmod(offset, self.cluster_size)
+            size = min(self.cluster_size - cluster_offset, end - offset)
+            chunks.append(self._read_cluster(cluster_index)[cluster_offset:cluster_offset + size])
+            offset += size
+        return b"".join(chunks)
+
+
+class VmdkSparseImageReader(ImageReader):
+    """vmdk的hosted sparse extent，包括monolithicSparse和OVA中的streamOptimized
+    streamOptimized的头部不含grain directory的位置，需要读取文件末尾的footer
+    Note:快照的差异磁盘中未分配的grain读出零，不会读取父磁盘
+    """
+
+    HEADER_FORMAT = "<4sIIQQQQIQQQB4sH"
+    GD_AT_END = 0xffffffffffffffff
+    FLAG_ZEROED_GRAIN = 1 << 2
+    FLAG_COMPRESSED = 1 << 16
+    MARKER_FORMAT = "<QI"
+
+    def __init__(self, path: str, offset: int = 0, size: Optional[int] = None,
+                 source: Optional[ImageSource] = None) -> None:
+        super(VmdkSparseImageReader, self).__init__(path, offset, size, source)
+        try:
+            self._parse_header()
+        except Exception:
+            self.close()
+            raise
+        self.gt_cache: dict[int, tuple[int, ...]] = dict()
+
+    def _unpack_header(self, data: bytes) -> tuple:
+        header = struct.unpack_from(self.HEADER_FORMAT, data)
+        if header[0] != VMDK_SPARSE_MAGIC:
+            raise ValueError(f"invalid vmdk sparse extent, path: {self.path}")
+        return header
+
+    def _parse_header(self) -> None:
+        (_, _, flags, capacity, grain_size, _, _, num_gtes_per_gt,
+         _, gd_offset, _, _, _, _) = self._unpack_header(self._pread(0, SECTOR_SIZE))
+        if gd_offset == self.GD_AT_END:
+            # 文件末尾依次为footer marker、footer和end-of-stream marker，各占一个扇区
+            footer = self._unpack_header(self._pread(self.file_size - 2 * SECTOR_SIZE, SECTOR_SIZE))
+            flags, gd_offset = footer[2], footer[9]
+
+        self.flags = flags
+        self.size = capacity * SECTOR_SIZE
+        self.grain_size = grain_size * SECTOR_SIZE
+        self.num_gtes_per_gt = num_gtes_per_gt
+        grain_count = (capacity + grain_size - 1) // grain_size
+        gd_count = (grain_count + num_gtes_per_gt - 1) // num_gtes_per_gt
+        self.gd = struct.unpack(f"<{gd_count}I", self._pread(gd_offset * SECTOR_SIZE, gd_count * 4))
+
+    def _get_gte(self, grain_index: int) -> int:
+        gd_index, gt_index = divmod(grain_index, self.num_gtes_per_gt)
+        gt_sector = self.gd[gd_index] if gd_index < len(self.gd) else 0
+        if not gt_sector:
+            return 0
+        if gt_sector not in self.gt_cache:
+            self.gt_cache[gt_sector] = struct.unpack(
+                f"<{self.num_gtes_per_gt}I", self._pread(gt_sector * SECTOR_SIZE, self.num_gtes_per_gt * 4)
+            )
+        return self.gt_cache[gt_sector][gt_index]
+
+    def _read_grain(self, grain_index: int) -> bytes:
+        gte = self._get_gte(grain_index)
+        if not gte or (gte == 1 and self.flags & self.FLAG_ZEROED_GRAIN):
+            return bytes(self.grain_size)
+        if not self.flags & self.FLAG_COMPRESSED:
+            return self._pread(gte * SECTOR_SIZE, self.grain_size)
+
+        # 压缩的grain以marker开头：lba（8字节）和压缩数据长度（4字节），数据为zlib格式
+        _, data_size = struct.unpack(self.MARKER_FORMAT, self._pread(gte * SECTOR_SIZE, 12))
+        data = self._pread(gte * SECTOR_SIZE + 12, data_size)
+        return zlib.decompress(data).ljust(self.grain_size, b"\0")
+
+    def _read(self, offset: int, length: int) -> bytes:
+        chunks: list[bytes] = list()
+        end = offset + length
+        while offset < end:
+            grain_index, grain_offset = divmod(offset, self.grain_size)
+            size = min(self.grain_size - grain_offset, end - offset)
+            chunks.append(self._read_grain(grain_index)[grain_offset:grain_offset + size])
+            offset += size
+        return b"".join(chunks)
+
+
+class VmdkDescriptorImageReader(ImageReader):
+    """vmdk描述文件，按extent拼接各数据文件，例如按硬盘下载的描述文件和flat文件"""
+
+    def __init__(self, path: str, offset: int = 0, size: Optional[int] = None) -> None:
+        super(VmdkDescriptorImageReader, self).__init__(path, offset, size)
+        self.extents: list[tuple[int, int, Optional[ImageReader]]] = list()
+        try:
+            self._parse_descriptor()
+        except Exception:
+            self.close()
+            raise
+
+    def _parse_descriptor(self) -> None:
+        descriptor = self._pread(0, min(self.file_size, 64 * 1024)).decode("utf-8", "replace")
+        if VmdkTool.get_descriptor_parent(descriptor):
+            raise ValueError(f"vmdk with parent disk is not supported, path: {self.path}")
+
+        start = 0
+        extent_dir = os.path.dirname(self.path)
+        for extent in VmdkTool.parse_descriptor_extents(descriptor):
+            length = extent["sectors"] * SECTOR_SIZE
+            extent_path = os.path.join(extent_dir, extent["file_name"])
+            if extent["type"] in ("FLAT", "VMFS"):
+                reader = RawImageReader(extent_path, extent["offset"] * SECTOR_SIZE, length)
+            elif extent["type"] in ("SPARSE", "VMFSSPARSE"):
+                reader = VmdkSparseImageReader(extent_path)
+            elif extent["type"] == "ZERO":
+                reader = None
+            else:
+                raise ValueError(f"vmdk extent type is not supported, path: {self.path}, type: {extent['type']}")
+            self.extents.append((start, length, reader))
+            start += length
+        self.size = start
+
+    def close(self) -> None:
+        for _, _, reader in getattr(self, "extents", list()):
+            if reader:
+                reader.close()
+        super(VmdkDescriptorImageReader, self).close()
+
+    def _read(self, offset: int, length: int) -> bytes:
+        chunks: list[bytes] = list()
+        end = offset + length
+        for start, extent_length, reader in self.extents:
+            if start + extent_length <= offset or start >= end:
+                continue
+            read_offset = max(offset, start) - start
+            size = min(end, start + extent_length) - start - read_offset
+            chunks.append(reader.read(read_offset, size).ljust(size, b"\0") if reader else bytes(size))
+        return b"".join(chunks)
+
+
+class ImageTool:
+
+    @classmethod
+    def open_image(cls, path: str, offset: int = 0, size: Optional[int] = None,
+                   source: Optional[ImageSource] = None) -> ImageReader:
+        """依据文件头识别镜像格式并打开，offset和size用于读取OVA中的tar成员
+        指定source时从source读取，path只用于日志，描述文件引用的extent无法从source读取，不支持
+        """
+        if source is not None:
+            magic = source.pread(offset, len(VMDK_DESCRIPTOR_MAGIC))
+        else:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                magic = os.pread(fd, len(VMDK_DESCRIPTOR_MAGIC), offset)
+            finally:
+                os.close(fd)
+
+        if magic.startswith(QCOW2_MAGIC):
+            return Qcow2ImageReader(path, offset, size, source)
+        if magic.startswith(VMDK_SPARSE_MAGIC):
+            return VmdkSparseImageReader(path, offset, size, source)
+        if magic.startswith(VMDK_DESCRIPTOR_MAGIC) and not offset:
+            if source is not None:
+                raise ValueError(f"vmdk descriptor from image source is not supported, path: {path}")
+            return VmdkDescriptorImageReader(path)
+        return RawImageReader(path, offset, size, source)
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import re
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass, field
+from decimal import Decimal, InvalidOperation
+from fractions import Fraction
+from typing import Optional
+
+# CIM资源类型，见DMTF CIM_ResourceAllocationSettingData
+RESOURCE_TYPE_CPU = 3
+RESOURCE_TYPE_MEMORY = 4
+RESOURCE_TYPE_ETHERNET = 10
+RESOURCE_TYPE_CD_DRIVE = 15
+RESOURCE_TYPE_DISK_DRIVE = 17
+
+# 早期OVF和部分工具使用的容量单位名称
+NAMED_UNIT_MAP = {
+    "byte": 1,
+    "kilobyte": 2 ** 10,
+    "megabyte": 2 ** 20,
+    "gigabyte": 2 ** 30,
+    "terabyte": 2 ** 40,
+}
+
+
+@dataclass
+class OvfFile:
+    id: str
+    href: str
+    size: Optional[int] = None
+    compression: str = ""
+
+
+@dataclass
+class OvfDisk:
+    disk_id: str
+    file_ref: str
+    capacity: str
+    capacity_units: str = "byte"
+    populated_size: Optional[int] = None
+
+    @property
+    def capacity_bytes(self) -> int:
+        """精确的容量字节数，不足1字节的部分向上取整"""
+        try:
+            capacity = Fraction(Decimal(self.capacity.strip()))
+        except InvalidOperation:
+            raise ValueError(f"invalid disk capacity, disk id: {self.disk_id}, capacity: {self.capacity}")
+        capacity *= OvfTool.parse_allocation_units(self.capacity_units)
+        return -(-capacity.numerator // capacity.denominator)
+
+
+@dataclass
+class OvfNetwork:
+    name: str
+    description: str = ""
+
+
+@dataclass
+class OvfItem:
+    """虚拟硬件，rasd字段按去掉命名空间的名称保存，HostResource、Connection可能出现多次，保存为列表"""
+    resource_type: int
+    instance_id: str = ""
+    element_name: str = ""
+    fields: dict[str, str] = field(default_factory=dict)
+    host_resource: list[str] = field(default_factory=list)
+    connection: list[str] = field(default_factory=list)
+    # vmw:Config/vmw:ExtraConfig的键值
+    config: dict[str, str] = field(default_factory=dict)
+
+    @property
+    def resource_ref(self) -> str:
+        """HostResource引用的磁盘或文件id，eg: "ovf:/disk/vmdisk1" -> "vmdisk1" """
+        return self.host_resource[0].rstrip("/").split("/")[-1] if self.host_resource else ""
+
+
+@dataclass
+class OvfOperatingSystem:
+    id: str = ""
+    os_type: str = ""
+    description: str = ""
+
+
+@dataclass
+class OvfVirtualSystem:
+    id: str
+    name: str = ""
+    operating_system: OvfOperatingSystem = field(default_factory=OvfOperatingSystem)
+    items: list[OvfItem] = field(default_factory=list)
+    disk_item_map: dict[str, OvfItem] = field(default_factory=dict)
+
+    def add_item(self, item: OvfItem) -> None:
+        self.items.append(item)
+        if item.resource_type == RESOURCE_TYPE_DISK_DRIVE and item.resource_ref:
+            self.disk_item_map[item.resource_ref] = item
+
+    def get_items(self, resource_type: int) -> list[OvfItem]:
+        return [item for item in self.items if item.resource_type == resource_type]
+
+    @property
+    def nics(self) -> list[OvfItem]:
+        return self.get_items(RESOURCE_TYPE_ETHERNET)
+
+    @property
+    def cpu_count(self) -> int:
+        return sum(int(item.fields.get("VirtualQuantity", 0)) for item in self.get_items(RESOURCE_TYPE_CPU))
+
+    @property
+    def memory_mb(self) -> int:
+        """内存大小，单位MB，不足1MB的部分向上取整，eg: AllocationUnits为"byte * 2^20"、"byte * 2^30"、"GigaBytes" """
+        memory = Fraction(0)
+        for item in self.get_items(RESOURCE_TYPE_MEMORY):
+            quantity = int(item.fields.get("VirtualQuantity", 0))
+            memory += quantity * OvfTool.parse_allocation_units(item.fields.get("AllocationUnits", "byte * 2^20"))
+        memory /= 2 ** 20
+        return -(-memory.numerator // memory.denominator)
+
+
+@dataclass
+class OvfEnvelope:
+    files: list[OvfFile] = field(default_factory=list)
+    disks: list[OvfDisk] = field(default_factory=list)
+    networks: list[OvfNetwork] = field(default_factory=list)
+    virtual_systems: list[OvfVirtualSystem] = field(default_factory=list)
+    file_map: dict[str, OvfFile] = field(default_factory=dict)
+    file_href_map: dict[str, OvfFile] = field(default_factory=dict)
+    disk_map: dict[str, OvfDisk] = field(default_factory=dict)
+    disk_file_ref_map: dict[str, OvfDisk] = field(default_factory=dict)
+
+    def add_file(self, ovf_file: OvfFile) -> None:
+        self.files.append(ovf_file)
+        self.file_map[ovf_file.id] = ovf_file
+        self.file_href_map[ovf_file.href] = ovf_file
+
+    def add_disk(self, disk: OvfDisk) -> None:
+        self.disks.append(disk)
+        self.disk_map[disk.disk_id] = disk
+        if disk.file_ref:
+            self.disk_file_ref_map[disk.file_ref] = disk
+
+    @property
+    def virtual_system(self) -> OvfVirtualSystem:
+        """单虚拟机的OVF中唯一的虚拟机"""
+        return self.virtual_systems[0]
+
+
+class OvfTool:
+
+    # 单位表达式中的乘数项，eg: "2^30"、"10^9"、"1024"
+    UNIT_TERM_PATTERN = re.compile(r"^(\d+)(?:\^(-?\d+))?$")
+
+    @classmethod
+    def parse_allocation_units(cls, units: str) -> Fraction:
+        """解析DMTF DSP0004的编程单位，返回相对于字节的倍数
+        eg: "byte" -> 1, "byte * 2^30" -> 2^30, "byte * 10^9" -> 10^9, "byte * 1024 * 1024" -> 2^20,
+            "MegaBytes" -> 2^20
+        """
+        multiple = Fraction(1)
+        tokens = re.split(r"\s*([*/])\s*", units.strip().lower())
+        base = tokens[0].rstrip("s")
+        if base not in NAMED_UNIT_MAP:
+            raise ValueError(f"unsupported allocation units: {units}")
+        multiple *= NAMED_UNIT_MAP[base]
+
+        for operator, term in zip(tokens[1::2], tokens[2::2]):
+            match = cls.UNIT_TERM_PATTERN.match(term)
+            if not match:
+                raise ValueError(f"unsupported allocation units: {units}")
+            value = Fraction(int(match.group(1))) ** int(match.group(2) or 1)
+            multiple = multiple * value if operator == "*" else multiple / value
+        return multiple
+
+    @staticmethod
+    def _local_name(tag: str) -> str:
+        """去掉命名空间，eg: "{http://schemas.dmtf.org/ovf/envelope/1}File" -> "File" """
+        return tag.rsplit("}", 1)[-1]
+
+    @classmethod
+    def _get_attrs(cls, elem: ET.Element) -> dict[str, str]:
+        return {cls._local_name(key): value for key, value in elem.attrib.items()}
+
+    @classmethod
+    def parse(cls, ovf_path: str) -> OvfEnvelope:
+        """流式解析OVF描述文件
+        使用iterparse逐个处理元素，处理完的元素立即清空，多虚拟机的大文件也无需构建完整的DOM
+        """
+        envelope = OvfEnvelope()
+        tag_stack: list[str] = list()
+        system_stack: list[OvfVirtualSystem] = list()
+        for event, elem in ET.iterparse(ovf_path, events=("start", "end")):
+            tag = cls._local_name(elem.tag)
+            if event == "start":
+                tag_stack.append(tag)
+                if tag == "VirtualSystem":
+                    system_stack.append(OvfVirtualSystem(id=cls._get_attrs(elem).get("id", "")))
+                continue
+
+            tag_stack.pop()
+            parent = tag_stack[-1] if tag_stack else ""
+            system = system_stack[-1] if system_stack else None
+            if tag == "File" and parent == "References":
+                envelope.add_file(cls._parse_file(elem))
+            elif tag == "Disk" and parent == "DiskSection":
+                envelope.add_disk(cls._parse_disk(elem))
+            elif tag == "Network" and parent == "NetworkSection":
+                envelope.networks.append(cls._parse_network(elem))
+            elif tag.endswith("Item") and parent == "VirtualHardwareSection" and system:
+                system.add_item(cls._parse_item(elem))
+            elif tag == "OperatingSystemSection" and system:
+                system.operating_system = cls._parse_operating_system(elem)
+            elif tag == "Name" and parent == "VirtualSystem" and system:
+                system.name = elem.text or ""
+            elif tag == "VirtualSystem":
+                envelope.virtual_systems.append(system_stack.pop())
+            else:
+                # 其余元素由父元素处理，不在此处清空
+                continue
+            elem.clear()
+        return envelope
+
+    @classmethod
+    def _parse_file(cls, elem: ET.Element) -> OvfFile:
+        attrs = cls._get_attrs(elem)
+        size = attrs.get("size")
+        return OvfFile(
+            id=attrs["id"],
+            href=attrs["href"],
+            size=int(size) if size else None,
+            compression=attrs.get("compression", ""),
+        )
+
+    @classmethod
+    def _parse_disk(cls, elem: ET.Element) -> OvfDisk:
+        attrs = cls._get_attrs(elem)
+        populated_size = attrs.get("populatedSize")
+        return OvfDisk(
+            disk_id=attrs["diskId"],
+            file_ref=attrs.get("fileRef", ""),
+            capacity=attrs["capacity"],
+            capacity_units=attrs.get("capacityAllocationUnits", "byte"),
+            populated_size=int(populated_size) if populated_size else None,
+        )
+
+    @classmethod
+    def _parse_network(cls, elem: ET.Element) -> OvfNetwork:
+        description = ""
+        for child in elem:
+            if cls._local_name(child.tag) == "Description":
+                description = child.text or ""
+        return OvfNetwork(name=cls._get_attrs(elem).get("name", ""), description=description)
+
+    @classmethod
+    def _parse_item(cls, elem: ET.Element) -> OvfItem:
+        item = OvfItem(resource_type=0)
+        for child in elem:
+            name = cls._local_name(child.tag)
+            if name in ("Config", "ExtraConfig"):
+                attrs = cls._get_attrs(child)
+                item.config[attrs.get("key", "")] = attrs.get("value", "")
+            elif name == "HostResource":
+                item.host_resource.append(child.text or "")
+            elif name == "Connection":
+                item.connection.append(child.text or "")
+            else:
+                item.fields[name] = child.text or ""
+
+        item.resource_type = int(item.fields.get("ResourceType") or 0)
+        item.instance_id = item.fields.get("InstanceID", "")
+        item.element_name = item.fields.get("ElementName", "")
+        return item
+
+    @classmethod
+    def _parse_operating_system(cls, elem: ET.Element) -> OvfOperatingSystem:
+        attrs = cls._get_attrs(elem)
+        description = ""
+        for child in elem:
+            if cls._local_name(child.tag) == "Description":
+                description = child.text or ""
+        return OvfOperatingSystem(id=attrs.get("id", ""), os_type=attrs.get("osType", ""), description=description)
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import uuid
+import struct
+from typing import Any, Optional
+
+from tools.image_tool import ImageReader
+
+SECTOR_SIZE = 512
+
+# MBR分区类型
+MBR_TYPE_EXTENDED = (0x05, 0x0f, 0x85)
+MBR_TYPE_GPT_PROTECTIVE = 0xee
+MBR_TYPE_EFI = 0xef
+MBR_TYPE_LINUX_SWAP = 0x82
+MBR_TYPE_LINUX_LVM = 0x8e
+MBR_TYPE_WINDOWS_RE = 0x27
+
+# GPT分区类型GUID
+GPT_TYPE_EFI_SYSTEM = "c12a7328-f81f-11d2-ba4b-00a0c93ec93b"
+GPT_TYPE_BIOS_BOOT = "21686148-6449-6e6f-744e-656564454649"
+GPT_TYPE_MICROSOFT_RESERVED = "e3c9e316-0b5c-4db8-817d-f92df00215ae"
+GPT_TYPE_WINDOWS_RECOVERY = "de94bba4-06d1-4d40-a16a-bfd50179d6ac"
+GPT_TYPE_LINUX_SWAP = "0657fd6d-a4ab-43c4-84e5-0933c84b4f4f"
+GPT_TYPE_LINUX_LVM = "e6d6d379-f507-44c2-a23c-238f2a3df928"
+GPT_TYPE_LINUX_BOOT = "bc13c2ff-59e6-4262-a352-b275fd6f7172"
+GPT_TYPE_LINUX_ROOT = (
+    "44479540-f297-41b2-9af7-d131d5f0458a",  # x86
+    "4f68bce3-e8cd-4db1-96e7-fbcaf984b709",  # x86-64
+    "b921b045-1df0-41c3-af44-4c6f280d3fae",  # arm64
+)
+
+# 识别系统盘的依据及其得分
+OS_DISK_SCORE_MAP = {
+    "efi_system_partition": 80,
+    "bios_boot_partition": 80,
+    "linux_root_partition": 60,
+    "linux_boot_partition": 60,
+    "mbr_active_partition": 60,
+    "ext_mounted_on_root": 80,
+    "ext_mounted_on_boot": 80,
+    "grub_boot_code": 40,
+    "windows_recovery_partition": 40,
+    "swap_partition": 30,
+    "lvm_partition": 10,
+    "microsoft_reserved_partition": 10,
+    "ntfs_boot_loader": 40,
+}
+
+# 得分不低于该值才认为可能是系统盘
+OS_DISK_MIN_SCORE = 40
+
+# NTFS引导扇区所在的区域及其引导代码中的引导程序名称，引导代码的提示信息为ASCII，其余部分为UTF-16
+NTFS_BOOT_CODE_SIZE = 16 * SECTOR_SIZE
+NTFS_BOOT_LOADER_LIST = ("BOOTMGR", "NTLDR")
+
+
+class PartitionTool:
+
+    @classmethod
+    def inspect_disk(cls, reader: ImageReader) -> dict[str, Any]:
+        """读取分区表和各分区的文件系统超级块，按系统盘特征打分
+        返回分区表类型、分区列表、命中的特征和总得分
+        """
+        result: dict[str, Any] = dict(partition_table="", partitions=list(), reasons=list(), score=0)
+        mbr = reader.read(0, SECTOR_SIZE)
+        if len(mbr) < SECTOR_SIZE or mbr[510:512] != b"\x55\xaa":
+            # 没有分区表时，文件系统可能直接建在整个硬盘上
+            filesystem = cls.probe_filesystem(reader, 0)
+            if filesystem:
+                result["partitions"].append(dict(index=0, start=0, size=reader.size, type="", bootable=False,
+                                                 **filesystem))
+        else:
+            entries = cls._parse_mbr_entries(mbr)
+            if any(entry["type"] == MBR_TYPE_GPT_PROTECTIVE for entry in entries):
+                result["partition_table"] = "gpt"
+                result["partitions"] = cls._parse_gpt_partitions(reader)
+            else:
+                result["partition_table"] = "mbr"
+                result["partitions"] = cls._parse_mbr_partitions(reader, entries)
+            if b"GRUB" in mbr[:440]:
+                result["reasons"].append("grub_boot_code")
+
+            for partition in result["partitions"]:
+                partition.update(cls.probe_filesystem(reader, partition["start"]))
+
+        for partition in result["partitions"]:
+            result["reasons"].extend(cls._get_partition_reasons(partition))
+        result["reasons"] = sorted(set(result["reasons"]))
+        result["score"] = sum(OS_DISK_SCORE_MAP[reason] for reason in result["reasons"])
+        return result
+
+    @classmethod
+    def rank_os_disk(cls, inspect_result_map: dict[str, dict[str, Any]]) -> Optional[str]:
+        """按得分选出系统盘，最高分不足OS_DISK_MIN_SCORE或并列时无法判断，返回None"""
+        ranked = sorted(inspect_result_map.items(), key=lambda item: item[1]["score"], reverse=True)
+        if not ranked or ranked[0][1]["score"] < OS_DISK_MIN_SCORE:
+            return None
+        if len(ranked) > 1 and ranked[1][1]["score"] == ranked[0][1]["score"]:
+            return None
+        return ranked[0][0]
+
+    @classmethod
+    def probe_filesystem(cls, reader: ImageReader, start: int) -> dict[str, Any]:
+        """依据超级块签名识别分区上的文件系统"""
+        boot_sector = reader.read(start, SECTOR_SIZE)
+        if boot_sector[3:11] == b"NTFS    ":
+            return dict(filesystem="ntfs", boot_loader=cls._probe_ntfs_boot_loader(reader, start))
+        if boot_sector[82:87] == b"FAT32" or boot_sector[54:57] == b"FAT":
+            return dict(filesystem="fat")
+        if boot_sector[0:4] == b"XFSB":
+            return dict(filesystem="xfs")
+
+        lvm_label = reader.read(start + SECTOR_SIZE, 32)
+        if lvm_label[0:8] == b"LABELONE" and lvm_label[24:32] == b"LVM2 001":
+            return dict(filesystem="lvm")
+
+        superblock = reader.read(start + 1024, 1024)
+        if len(superblock) >= 200 and struct.unpack_from("<H", superblock, 56)[0] == 0xef53:
+            last_mounted = superblock[136:200].split(b"\0", 1)[0].decode("utf-8", "replace")
+            return dict(filesystem="ext", last_mounted=last_mounted)
+
+        if reader.read(start + 4086, 10) in (b"SWAPSPACE2", b"SWAP-SPACE"):
+            return dict(filesystem="swap")
+        if reader.read(start + 0x10040, 8) == b"_BHRfS_M":
+            return dict(filesystem="btrfs")
+        return dict()
+
+    @classmethod
+    def _probe_ntfs_boot_loader(cls, reader: ImageReader, start: int) -> str:
+        """在NTFS的引导代码中查找引导程序名称，格式化时写入的引导代码在数据分区上同样存在"""
+        boot_code = reader.read(start, NTFS_BOOT_CODE_SIZE)
+        for boot_loader in NTFS_BOOT_LOADER_LIST:
+            if boot_loader.encode("ascii") in boot_code or boot_loader.encode("utf-16-le") in boot_code:
+                return boot_loader
+        return ""
+
+    @classmethod
+    def _parse_mbr_entries(cls, sector: bytes) -> list[dict[str, Any]]:
+        entries: list[dict[str, Any]] = list()
+        for index in range(4):
+            entry = sector[446 + index * 16:446 + (index + 1) * 16]
+            status, part_type = entry[0], entry[4]
+            lba_start, sectors = struct.unpack_from("<II", entry, 8)
+            if part_type and sectors:
+                entries.append(dict(bootable=status == 0x80, type=part_type, lba_start=lba_start, sectors=sectors))
+        return entries
+
+    @classmethod
+    def _parse_mbr_partitions(cls, reader: ImageReader, entries: list[dict[str, Any]]) -> list[dict[str, Any]]:
+        """解析MBR主分区，并沿EBR链解析扩展分区中的逻辑分区"""
+        partitions: list[dict[str, Any]] = list()
+        for index, entry in enumerate(entries, 1):
+            if entry["type"] not in MBR_TYPE_EXTENDED:
+                partitions.append(cls._make_mbr_partition(index, entry, 0))
+                continue
+
+            extended_start = entry["lba_start"]
+            ebr_lba = extended_start
+            # 最多解析128个逻辑分区，避免EBR链成环
+            for logical_index in range(5, 5 + 128):
+                ebr_entries = cls._parse_mbr_entries(reader.read(ebr_lba * SECTOR_SIZE, SECTOR_SIZE))
+                if not ebr_entries:
+                    break
+                partitions.append(cls._make_mbr_partition(logical_index, ebr_entries[0], ebr_lba))
+                if len(ebr_entries) < 2 or ebr_entries[1]["type"] not in MBR_TYPE_EXTENDED:
+                    break
+                ebr_lba = extended_start + ebr_entries[1]["lba_start"]
+        return partitions
+
+    @classmethod
+    def _make_mbr_partition(cls, index: int, entry: dict[str, Any], base_lba: int) -> dict[str, Any]:
+        return dict(
+            index=index,
+            start=(base_lba + entry["lba_start"]) * SECTOR_SIZE,
+            size=entry["sectors"] * SECTOR_SIZE,
+            type=f"{entry['type']:#04x}",
+            bootable=entry["bootable"],
+        )
+
+    @classmethod
+    def _parse_gpt_partitions(cls, reader: ImageReader) -> list[dict[str, Any]]:
+        """解析GPT分区，头部依次尝试512字节和4K扇区的位置"""
+        for sector_size in (SECTOR_SIZE, 4096):
+            header = reader.read(sector_size, 92)
+            if header[0:8] == b"EFI PART":
+                break
+        else:
+            return list()
+
+        entries_lba, entry_count, entry_size = struct.unpack_from("<QII", header, 72)
+        entry_count = min(entry_count, 256)
+        data = reader.read(entries_lba * sector_size, entry_count * entry_size)
+        partitions: list[dict[str, Any]] = list()
+        for index in range(entry_count):
+            entry = data[index * entry_size:(index + 1) * entry_size]
+            if len(entry) < 56 or not any(entry[0:16]):
+                continue
+            first_lba, last_lba = struct.unpack_from("<QQ", entry, 32)
+            partitions.append(dict(
+                index=index + 1,
+                start=first_lba * sector_size,
+                size=(last_lba - first_lba + 1) * sector_size,
+                type=str(uuid.UUID(bytes_le=entry[0:16])),
+                bootable=False,
+            ))
+        return partitions
+
+    @classmethod
+    def _get_partition_reasons(cls, partition: dict[str, Any]) -> list[str]:
+        """分区类型和文件系统命中的系统盘特征"""
+        part_type, filesystem = partition["type"], partition.get("filesystem", "")
+        reasons: list[str] = list()
+        if partition["bootable"]:
+            reasons.append("mbr_active_partition")
+        if part_type in (GPT_TYPE_EFI_SYSTEM, f"{MBR_TYPE_EFI:#04x}"):
+            reasons.append("efi_system_partition")
+        if part_type == GPT_TYPE_BIOS_BOOT:
+            reasons.append("bios_boot_partition")
+        if part_type in GPT_TYPE_LINUX_ROOT:
+            reasons.append("linux_root_partition")
+        if part_type == GPT_TYPE_LINUX_BOOT:
+            reasons.append("linux_boot_partition")
+        if part_type in (GPT_TYPE_WINDOWS_RECOVERY, f"{MBR_TYPE_WINDOWS_RE:#04x}"):
+            reasons.append("windows_recovery_partition")
+        if part_type == GPT_TYPE_MICROSOFT_RESERVED:
+            reasons.append("microsoft_reserved_partition")
+        if part_type in (GPT_TYPE_LINUX_SWAP, f"{MBR_TYPE_LINUX_SWAP:#04x}") or filesystem == "swap":
+            reasons.append("swap_partition")
+        if part_type in (GPT_TYPE_LINUX_LVM, f"{MBR_TYPE_LINUX_LVM:#04x}") or filesystem == "lvm":
+            reasons.append("lvm_partition")
+        if filesystem == "ext" and partition.get("last_mounted") == "/":
+            reasons.append("ext_mounted_on_root")
+        if filesystem == "ext" and partition.get("last_mounted") == "/boot":
+            reasons.append("ext_mounted_on_boot")
+        # 每个NTFS分区都带有引导代码，只有活动分区或第一个分区上的才可能用于启动
+        if filesystem == "ntfs" and partition.get("boot_loader") and (partition["bootable"] or partition["index"] == 1):
+            reasons.append("ntfs_boot_loader")
+        return reasons
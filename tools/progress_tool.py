@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import abc
+import re
+import threading
+import time
+from typing import Any, Callable, Optional
+
+from core.logger import logger
+from tools.time_tool import TimeTool
+
+
+class ProgressParser(abc.ABC):
+    """ 进度解析器基类
+    增量接收命令输出，按换行/回车切分后逐行解析，返回最新的百分比进度
+    """
+
+    LINE_SEPARATOR = re.compile(rb"[\r\n]")
+
+    def __init__(self) -> None:
+        self._buffer: bytes = b""
+
+    def feed(self, data: bytes) -> Optional[float]:
+        """ 输入新读取到的输出，返回其中最新的进度，没有进度时返回None """
+        lines = self.LINE_SEPARATOR.split(self._buffer + data)
+        self._buffer = lines.pop()
+
+        percent = None
+        for line in lines:
+            line_percent = self.parse_line(line.decode("utf-8", errors="ignore").strip())
+            if line_percent is not None:
+                percent = line_percent
+        return percent
+
+    @abc.abstractmethod
+    def parse_line(self, line: str) -> Optional[float]:
+        """ 解析单行输出，返回其中的百分比进度，没有进度时返回None """
+
+
+class QemuImgProgressParser(ProgressParser):
+    """ qemu-img convert -p 的进度解析器
+    eg: "    (12.34/100%)"
+    """
+
+    PATTERN = re.compile(r"\((\d+(?:\.\d+)?)/100%\)")
+
+    def parse_line(self, line: str) -> Optional[float]:
+        match = self.PATTERN.search(line)
+        if match:
+            return float(match.group(1))
+        return None
+
+
+class OvfToolProgressParser(ProgressParser):
+    """ ovftool --machineOutput 的进度解析器
+    机器输出中进度以"PROGRESS"开头，下一行为"+ <百分比>"
+    eg:
+        PROGRESS
+        + 45
+    同时兼容非机器输出中的"Disk progress: 45%"
+    """
+
+    PERCENT_PATTERN = re.compile(r"^\+\s*(\d{1,3})\s*$")
+    HUMAN_PATTERN = re.compile(r"progress:\s*(\d{1,3})%", re.IGNORECASE)
+
+    def __init__(self) -> None:
+        super(OvfToolProgressParser, self).__init__()
+        self._in_progress_section = False
+
+    def parse_line(self, line: str) -> Optional[float]:
+        if line == "PROGRESS":
+            self._in_progress_section = True
+            return None
+
+        if self._in_progress_section:
+            match = self.PERCENT_PATTERN.match(line)
+            if match:
+                return float(match.group(1))
+            if not line.startswith("+"):
+                self._in_progress_section = False
+
+        match = self.HUMAN_PATTERN.search(line)
+        if match:
+            return float(match.group(1))
+        return None
+
+
+class ProgressReporter:
+    """ 子步骤进度上报器
+    将子步骤的百分比进度映射到迁移进度区间[start_process, end_process]，按时间间隔节流后
+    通过vm_session.update_detail_migrate_status上报，同时计算吞吐量和预计剩余时间
+    支持多个部分（例如多个硬盘并行转换）按权重汇总进度
+    """
+
+    def __init__(self, vm_session: Any, step: str, start_process: int, end_process: int,
+                 total_bytes: Optional[int] = None, weights: Optional[dict[str, int]] = None,
+                 interval: int = 30) -> None:
+        self.vm_session = vm_session
+        self.step = step
+        self.start_process = start_process
+        self.end_process = end_process
+        self.total_bytes = total_bytes
+        self.weights = weights or {"default": 1}
+        self.interval = interval
+
+        self._percent_map: dict[str, float] = {part: 0.0 for part in self.weights}
+        self._start_time = time.monotonic()
+        self._last_report_time: float = 0.0
+        self._last_percent: float = -1.0
+        self._lock = threading.Lock()
+
+    @property
+    def percent(self) -> float:
+        """ 按权重汇总的整体百分比进度 """
+        total_weight = sum(self.weights.values()) or 1
+        weighted = sum(self._percent_map[part] * weight for part, weight in self.weights.items())
+        return weighted / total_weight
+
+    def update(self, percent: float, part: str = "default") -> None:
+        """ 更新某一部分的进度，满足节流条件时上报 """
+        with self._lock:
+            self._percent_map[part] = max(self._percent_map.get(part, 0.0), min(percent, 100.0))
+            total_percent = self.percent
+
+            now = time.monotonic()
+            if total_percent <= self._last_percent:
+                return
+            if total_percent < 100 and now - self._last_report_time < self.interval:
+                return
+            self._last_report_time = now
+            self._last_percent = total_percent
+
+        self._report(total_percent, now - self._start_time)
+
+    def make_output_callback(self, parser: ProgressParser, part: str = "default") -> Callable[[str, bytes], None]:
+        """ 生成命令输出回调，供CMDClient实时解析进度 """
+        def on_output(stream_name: str, data: bytes) -> None:
+            percent = parser.feed(data)
+            if percent is not None:
+                self.update(percent, part)
+        return on_output
+
+    def _report(self, percent: float, elapsed_seconds: float) -> None:
+        process = self.start_process + int((self.end_process - self.start_process) * percent / 100)
+
+        # 预计剩余时间依据已用时间和进度推算
+        eta_seconds = None
+        if percent > 0:
+            eta_seconds = int(elapsed_seconds * (100 - percent) / percent)
+
+        # 吞吐量，单位B/s
+        speed = None
+        if self.total_bytes and elapsed_seconds > 0:
+            speed = int(self.total_bytes * percent / 100 / elapsed_seconds)
+
+        process_detail = dict(
+            step=self.step,
+            percent=round(percent, 2),
+            speed=speed,
+            eta_seconds=eta_seconds,
+            update_time=TimeTool.get_now_datetime_str(),
+        )
+        self.vm_session.update_detail_migrate_status(dict(process=process, process_detail=process_detail))
+        logger.info(
+            f"migrate progress, session id: {self.vm_session.session_id}, step: {self.step}, process: {process}, "
+            f"percent: {percent:.2f}%, speed: {speed}B/s, eta: {eta_seconds}s"
+        )
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from typing import Any, Callable
+
+
+class Registry:
+    """ 按名称注册的实现类，例如存储后端、增量同步读取器、状态存储
+    eg:
+        STORAGE_BACKEND_REGISTRY = Registry("storage backend")
+
+        @STORAGE_BACKEND_REGISTRY.register("file")
+        class FileStorageBackend(StorageBackend): ...
+
+        STORAGE_BACKEND_REGISTRY.create("file", vm_session)
+    """
+
+    def __init__(self, kind: str) -> None:
+        self.kind = kind
+        # key为名称，value为实现类
+        self.cls_map: dict[str, type] = dict()
+
+    def register(self, name: str) -> Callable[[type], type]:
+        """ 注册实现类的装饰器，同时将名称记录在类的name属性上 """
+
+        def decorator(cls: type) -> type:
+            cls.name = name
+            self.cls_map[name] = cls
+            return cls
+
+        return decorator
+
+    def get(self, name: str) -> type:
+        """ 获取实现类，名称未注册时抛出异常 """
+        if name not in self.cls_map:
+            raise Exception(f"unsupported {self.kind}: {name}, supported {self.kind}s: {list(self.cls_map)}")
+        return self.cls_map[name]
+
+    def create(self, name: str, *args: Any, **kwargs: Any) -> Any:
+        """ 按名称创建实例，参数传给实现类的构造函数 """
+        return self.get(name)(*args, **kwargs)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.cls_map
+
+    def __iter__(self):
+        return iter(self.cls_map)
@@ -345,6 +345,12 @@ class TimeTool:
         """ 获取该时间戳当天的结束时间戳 """
         return cls.get_ts_start(ts) + 86400 - 1
 
+    @classmethod
+    def get_backoff_seconds(cls, retry_times: int, base_seconds: float, max_seconds: float) -> float:
+        """ 获取第retry_times次重试前的退避时间，按指数增长并加入随机抖动，避免多个任务同时重试 """
+        backoff_seconds = min(max_seconds, base_seconds * 2 ** max(0, retry_times - 1))
+        return backoff_seconds * random.uniform(0.5, 1)
+
 
 if __name__ == '__main__':
     print(TimeTool.get_weekday_list_by_week_range(
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import re
+from typing import Optional
+
+
+class VmdkTool:
+
+    # 描述文件中的extent行
+    # eg: RW 83886080 VMFS "test-vm-01-flat.vmdk"
+    # eg: RW 8388608 FLAT "test-vm-01-f001.vmdk" 0
+    EXTENT_PATTERN = re.compile(r'^\s*(RW|RDONLY|NOACCESS)\s+(\d+)\s+(\w+)\s+"(.+?)"(?:\s+(\d+))?\s*$')
+
+    @classmethod
+    def parse_descriptor_extents(cls, descriptor: str) -> list[dict[str, object]]:
+        """解析vmdk描述文件中的extent，返回访问权限、扇区数、类型、文件名和偏移"""
+        extents: list[dict[str, object]] = list()
+        for line in descriptor.splitlines():
+            match = cls.EXTENT_PATTERN.match(line)
+            if match:
+                access, sectors, extent_type, file_name, offset = match.groups()
+                extents.append(dict(
+                    access=access,
+                    sectors=int(sectors),
+                    type=extent_type,
+                    file_name=file_name,
+                    offset=int(offset or 0),
+                ))
+        return extents
+
+    @classmethod
+    def get_descriptor_parent(cls, descriptor: str) -> Optional[str]:
+        """获取快照磁盘的父磁盘文件名，没有父磁盘时返回None"""
+        match = re.search(r'^\s*parentFileNameHint\s*=\s*"(.+?)"\s*$', descriptor, re.MULTILINE)
+        return match.group(1) if match else None
+
+    @classmethod
+    def rewrite_descriptor_parent(cls, descriptor: str, parent_file_name: str) -> str:
+        """替换快照磁盘的父磁盘文件名，使其指向本地的父磁盘"""
+        return re.sub(
+            r'^(\s*parentFileNameHint\s*=\s*)".*?"(\s*)$',
+            lambda match: f'{match.group(1)}"{parent_file_name}"{match.group(2)}',
+            descriptor,
+            flags=re.MULTILINE,
+        )
+
+    @classmethod
+    def gen_flat_descriptor(cls, flat_file_name: str, size: int, adapter_type: str = "lsilogic") -> str:
+        """生成单个flat数据文件的描述文件（monolithicFlat），数据文件为raw格式，容量按扇区向上取整"""
+        sectors = -(-size // 512)
+        return "\n".join([
+            "# Disk DescriptorFile",
+            "version=1",
+            "CID=fffffffe",
+            "parentCID=ffffffff",
+            'createType="monolithicFlat"',
+            "",
+            "# Extent description",
+            f'RW {sectors} FLAT "{flat_file_name}" 0',
+            "",
+            "# The Disk Data Base",
+            "#DDB",
+            "",
+            'ddb.virtualHWVersion = "4"',
+            f'ddb.adapterType = "{adapter_type}"',
+        ]) + "\n"
+
+    @classmethod
+    def rewrite_descriptor_extents(cls, descriptor: str, file_name_map: dict[str, str]) -> str:
+        """按映射替换描述文件中extent的文件名"""
+        lines: list[str] = list()
+        for line in descriptor.splitlines():
+            match = cls.EXTENT_PATTERN.match(line)
+            if match and match.group(4) in file_name_map:
+                line = line.replace(f'"{match.group(4)}"', f'"{file_name_map[match.group(4)]}"', 1)
+            lines.append(line)
+        return "\n".join(lines) + "\n"
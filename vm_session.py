@@ -5,6 +5,7 @@
 from core.logger import logger
 
 from tools.time_tool import TimeTool
+from status_writer import status_writer
 
 from constants.enum import (
     MigratePattern,
@@ -13,7 +14,8 @@ from constants.enum import (
 
 from migration import (
     ExportImageMigration,
-    UploadImageMigration
+    UploadImageMigration,
+    DeltaSyncMigration,
 )
 
 
@@ -51,6 +53,8 @@ class VMSession(VMSessionBase):
             return ExportImageMigration(self)
         if self.task.task_pattern == MigratePattern.UPLOAD_IMAGE.value:
             return UploadImageMigration(self)
+        if self.task.task_pattern == MigratePattern.DELTA_SYNC.value:
+            return DeltaSyncMigration(self)
 
     def checker(self):
         """检查器"""
@@ -207,11 +211,13 @@ class VMSession(VMSessionBase):
         return ""
 
     def migrate(self):
-        """源主机迁移"""
+        """源主机迁移，返回迁移是否成功"""
         try:
             self.migration().migrate()
         except Exception as e:
             logger.error(f"vm migrate failed, session id: {self.session_id}, err: {e}")
+            return False
+        return True
 
     def update_to_mem(self, data):
         """更新虚拟机任务信息到内存"""
@@ -222,14 +228,15 @@ class VMSession(VMSessionBase):
         # 更新虚拟机任务信息到内存
         self.update_to_mem(data)
 
-        # 更新虚拟机任务信息到数据库
-        # self.update_to_pg(data)
+        # 更新虚拟机任务信息到数据库，由后台线程批量写入，不阻塞迁移流程
+        status_writer.submit(self.session_id, data)
 
     def update_detail_migrate_status(self, detail_status):
-        """更新详细的迁移状态到内存和数据库"""
+        """更新详细的迁移状态到内存和数据库，不修改传入的字典"""
+        detail_status = dict(detail_status)
         status = ""
         if "status" in detail_status:
             status = detail_status["status"]
         if status in MigrateStatus.list_end_migrate_status():
             detail_status["end_time"] = TimeTool.get_now_datetime()
-        # self.update_to_mem_and_pg(detail_status)
+        self.update_to_mem_and_pg(detail_status)